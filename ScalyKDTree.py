@@ -1,16 +1,290 @@
+import array
+import bisect
+import collections
+import ctypes
+import functools
+import heapq
+import itertools
 import math
+import mmap as mmap_module
+import multiprocessing
+import multiprocessing.sharedctypes
+import struct
+import sys
+import threading
+import timeit
+
+# Only "AsyncKDTreeService" needs asyncio, which Python 2 lacks.
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+class Metric(object):
+    """A distance between points, as used by the nearest neighbour searches.
+
+    Searches compare "reduced" distances, any quantity increasing with the distance
+    which is cheaper to compute, such as the squared distance for "Euclidean". The
+    "distance" method gives the reduced distance between two points, and may give up
+    and return anything larger than "bound" once the distance is known to exceed it.
+    The "axis_distance" method gives the reduced distance between two points differing
+    by "diff" along "axis" alone, which bounds from below the distance from a query to
+    every point across a splitting plane. The "reduce" and "expand" methods convert
+    true distances to reduced ones and back."""
+
+    def fits(self,size):
+        return True
+
+    def reduce(self,distance):
+        return distance
+
+    def expand(self,distance):
+        return distance
+
+class Euclidean(Metric):
+    def __repr__(self):
+        return 'Euclidean()'
+
+    def distance(self,a,b,bound):
+        total = 0.0
+
+        for (x,y) in zip(a,b):
+            d = x - y
+            total += d * d
+
+            if total > bound:
+                break
+
+        return total
+
+    def axis_distance(self,axis,diff):
+        return diff * diff
+
+    def reduce(self,distance):
+        return distance * distance
+
+    def expand(self,distance):
+        return math.sqrt(distance)
+
+class Manhattan(Metric):
+    def __repr__(self):
+        return 'Manhattan()'
+
+    def distance(self,a,b,bound):
+        total = 0.0
+
+        for (x,y) in zip(a,b):
+            total += x - y if x > y else y - x
+
+            if total > bound:
+                break
+
+        return total
+
+    def axis_distance(self,axis,diff):
+        return diff if diff > 0 else -diff
+
+class Chebyshev(Metric):
+    def __repr__(self):
+        return 'Chebyshev()'
+
+    def distance(self,a,b,bound):
+        total = 0.0
+
+        for (x,y) in zip(a,b):
+            d = x - y if x > y else y - x
+
+            if d > total:
+                total = d
+
+                if total > bound:
+                    break
+
+        return total
+
+    def axis_distance(self,axis,diff):
+        return diff if diff > 0 else -diff
+
+class WeightedEuclidean(Euclidean):
+    def __init__(self,weights):
+        weights = tuple(weights)
+
+        assert all(isinstance(w,(int,float)) and w > 0 for w in weights)
+
+        self.weights = weights
+
+    def __repr__(self):
+        return 'WeightedEuclidean(' + str(self.weights) + ')'
+
+    def fits(self,size):
+        return len(self.weights) == size
+
+    def distance(self,a,b,bound):
+        total = 0.0
+
+        for (w,x,y) in zip(self.weights,a,b):
+            d = x - y
+            total += w * d * d
+
+            if total > bound:
+                break
+
+        return total
+
+    def axis_distance(self,axis,diff):
+        return self.weights[axis] * diff * diff
+
+class Minkowski(Metric):
+    def __init__(self,p):
+        assert isinstance(p,(int,float))
+        assert p >= 1 and p != float("inf")
+
+        self.p = p
+
+    def __repr__(self):
+        return 'Minkowski(' + str(self.p) + ')'
+
+    def distance(self,a,b,bound):
+        p = self.p
+        total = 0.0
+
+        for (x,y) in zip(a,b):
+            total += math.fabs(x - y) ** p
+
+            if total > bound:
+                break
+
+        return total
+
+    def axis_distance(self,axis,diff):
+        return math.fabs(diff) ** self.p
+
+    def reduce(self,distance):
+        return distance ** self.p
+
+    def expand(self,distance):
+        return distance ** (1.0 / self.p)
+
+class _IdStore(object):
+    """The ids of the points of a tree, in "ids" at the insertion index of each point.
+
+    It is a compact array of machine integers until some id is not one, and a list of
+    references from then on. Queries asked for ids return each point as a pair of the
+    point and its id."""
+
+    def _append_id(self,id):
+        ids = self.ids
+
+        if isinstance(ids,array.array):
+            try:
+                if isinstance(id,int) and not isinstance(id,bool):
+                    ids.append(id)
+                    return
+            except OverflowError:
+                pass
+
+            ids = self.ids = list(ids)
+
+        ids.append(id)
+
+    def _remove_id(self,index):
+        if isinstance(self.ids,list):
+            self.ids[index] = None
+
+    def _result(self,node,with_ids):
+        if node == None:
+            return None
+        elif with_ids:
+            return (node.point,self.ids[node.index])
+        else:
+            return node.point
+
+    def _results(self,nodes,with_ids):
+        if with_ids:
+            ids = self.ids
+            return [(node.point,ids[node.index]) for node in nodes]
+
+        return [node.point for node in nodes]
+
+    def _arrays(self,entries):
+        entries = sorted(entries,key=lambda e: e.index)
+        (ids,coords) = (self.ids,array.array('d'))
+
+        for entry in entries:
+            coords.extend(entry.point)
+
+        if isinstance(ids,array.array):
+            return (array.array(ids.typecode,[ids[entry.index] for entry in entries]),coords)
+
+        return ([ids[entry.index] for entry in entries],coords)
+
+class KDTree(_IdStore):
+    """A KD tree over points of a fixed dimension.
+
+    Queries may run concurrently from many threads while a single thread writes.
+    Writers ("insert" and "remove") serialize on "lock", so several writer threads are
+    also safe. Readers take no lock: each write publishes its change with one reference
+    assignment, and rebuilds construct a fresh subtree before swapping it in, so a
+    reader always sees a consistent tree, with or without the point being written.
+    Query statistics are gathered per call, into an optional "QueryStats" object owned
+    by the caller. Nearest neighbour queries measure distance with the tree's "metric",
+    Euclidean unless another "Metric" is given, which each query may override."""
+
+    # A subtree is rebuilt when one of its children holds more than this fraction of
+    # its entries, and an insert is checked when it lands deeper than log base 1/alpha
+    # of the number of entries in the tree.
+    alpha = 0.7
+
+    # The cost of checking a candidate from a per-axis index, relative to that of
+    # visiting a node in a tree walk, for the "find_with_mask" planner.
+    index_cost = 0.25
+
+    # "find_nearest_batch" routes its queries down the tree together only for trees of
+    # at least "batch_points" points, and with at least one query for every
+    # "batch_spread" of them. Below that it answers them one at a time, since the
+    # descents are too short, or the queries too far apart, for their shared routes to
+    # pay for routing them.
+    batch_points = 128
+    batch_spread = 16
+
+    # The query methods instrumented while hooks are installed, each with the position
+    # of its "stats" argument. "iter_nearest" is left out, since it only returns a
+    # generator and does its work as that is consumed, after any hook would be called.
+    traced = (('find_exact',1),('find_with_mask',2),('find_in_range',2),('count_in_range',2),('find_nearest',3),
+              ('find_k_nearest',2),('find_within_radius',2),('find_nearest_batch',1))
+
+    # The policies for choosing the axis a node splits along. "cycle" takes the axes in
+    # turn, "max_spread" the one along which the node's points spread the widest, and
+    # "max_variance" the one along which they vary the most. "sliding_midpoint" takes
+    # the axis of widest spread too, but splits at the point closest to the middle of
+    # the spread rather than at the median, no further from the median than "alpha"
+    # allows. Incremental inserts only know the box of the parent of a new leaf, so
+    # every policy but "cycle" picks its axis of widest spread there.
+    splits = ('cycle','max_spread','max_variance','sliding_midpoint')
 
-class KDTree(object):
     class KDNode(object):
-        def __init__(self,point,disc):
+        # Besides its own point, a node keeps a bounding box of every entry in its
+        # subtree, tombstones included, as the tuples "lo" and "hi", and the number of
+        # live entries in it as "live".
+        __slots__ = ('point','disc','index','left','right','bucket','size','deleted','lo','hi','live')
+
+        def __init__(self,point,disc,index=None):
             assert isinstance(point,tuple)
             assert isinstance(disc,int)
             assert disc >= 0 and disc < len(point)
+            assert index == None or isinstance(index,int)
 
             self.point = point
             self.disc = disc
+            self.index = index
             self.left = None
             self.right = None
+            self.bucket = None
+            self.size = 1
+            self.deleted = False
+            self.lo = point
+            self.hi = point
+            self.live = 1
 
         def __repr__(self):
             return 'KDTree.KDNode(' + str(self.point) + ',' + str(self.disc) + ')'
@@ -26,6 +300,129 @@ class KDTree(object):
             else:
                 return False
 
+    class QueryStats(object):
+        # Besides the counters, "plan" records how the last "find_with_mask" call was
+        # answered, by a "tree" walk or from the per-axis indexes, as "index".
+        __slots__ = ('nodes_visited','distance_evaluations','subtrees_pruned','plan')
+
+        def __init__(self):
+            self.nodes_visited = 0
+            self.distance_evaluations = 0
+            self.subtrees_pruned = 0
+            self.plan = None
+
+        def __repr__(self):
+            return 'KDTree.QueryStats(' + ','.join(name + '=' + str(getattr(self,name)) for name in self.__slots__) + ')'
+
+        def merge(self,other):
+            self.nodes_visited += other.nodes_visited
+            self.distance_evaluations += other.distance_evaluations
+            self.subtrees_pruned += other.subtrees_pruned
+
+            if other.plan != None:
+                self.plan = other.plan
+
+            return self
+
+    class TreeShape(object):
+        # The shape of a tree, as found by "shape": the number of nodes, not counting
+        # the entries held in leaf buckets, and of entries, counting those and any
+        # tombstones, the depth, the number of nodes at each depth from the root down,
+        # the ratio of the depth to the least depth possible for as many nodes, and an
+        # estimate of the bytes the tree takes up.
+        __slots__ = ('nodes','entries','depth','histogram','balance','memory')
+
+        def __init__(self,nodes,entries,depth,histogram,balance,memory):
+            self.nodes = nodes
+            self.entries = entries
+            self.depth = depth
+            self.histogram = histogram
+            self.balance = balance
+            self.memory = memory
+
+        def __repr__(self):
+            return 'KDTree.TreeShape(' + ','.join(name + '=' + str(getattr(self,name)) for name in self.__slots__) + ')'
+
+    class NearestResult(object):
+        # The answer to an approximate "find_nearest": the point found, its insertion
+        # index and its distance, and whether the search ran to completion, rather than
+        # being cut short by its visit budget, so that the distance is guaranteed.
+        __slots__ = ('point','index','distance','exhausted')
+
+        def __init__(self,point,index,distance,exhausted):
+            self.point = point
+            self.index = index
+            self.distance = distance
+            self.exhausted = exhausted
+
+        def __repr__(self):
+            return 'KDTree.NearestResult(' + ','.join(name + '=' + str(getattr(self,name)) for name in self.__slots__) + ')'
+
+    class QueryCache(object):
+        # Query results, keyed by query, evicting the least recently used beyond
+        # "capacity". Each entry also keeps the region its result depends on, the ball
+        # around the query reaching its farthest result under "metric", given as a
+        # reduced "radius", or for "find_with_mask" the points agreeing with the query
+        # on the masked axes. A write drops just the entries whose region holds the
+        # point written, and advances "version", so that a result computed while a
+        # write went on, which may predate it, is not stored. The entries are only
+        # touched under the cache's own "lock".
+        __slots__ = ('capacity','hits','misses','version','entries','lock')
+
+        def __init__(self,capacity):
+            self.capacity = capacity
+            self.hits = 0
+            self.misses = 0
+            self.version = 0
+            self.entries = collections.OrderedDict()
+            self.lock = threading.Lock()
+
+        def __repr__(self):
+            return 'KDTree.QueryCache(' + ','.join(name + '=' + str(getattr(self,name)) for name in self.__slots__[:4]) + ')'
+
+        def __len__(self):
+            return len(self.entries)
+
+        def lookup(self,key):
+            # Returns whether the result was cached, the result, and the version to
+            # store a fresh result under.
+            with self.lock:
+                entry = self.entries.pop(key,None)
+
+                if entry == None:
+                    self.misses += 1
+                    return (False,None,self.version)
+
+                self.entries[key] = entry
+                self.hits += 1
+
+                return (True,entry[0],self.version)
+
+        def store(self,key,version,result,query,mask,radius):
+            with self.lock:
+                if version != self.version:
+                    return
+
+                self.entries[key] = (result,query,mask,radius)
+
+                if len(self.entries) > self.capacity:
+                    self.entries.popitem(last=False)
+
+        def invalidate(self,point,metric):
+            with self.lock:
+                self.version += 1
+                stale = []
+
+                for (key,(_,query,mask,radius)) in self.entries.items():
+                    if mask != None:
+                        if all(point[j] == query[j] for j in range(0,len(mask)) if mask[j]):
+                            stale.append(key)
+                    elif metric.distance(point,query,radius) <= radius:
+                        stale.append(key)
+
+                for key in stale:
+                    del self.entries[key]
+
     @staticmethod
     def _node_equal(node,point):
         for i in range(0,len(node.point)):
@@ -44,156 +441,2340 @@ class KDTree(object):
 
     @staticmethod
     def _node_point_distance(node,point):
-        return math.sqrt(sum(map(lambda (x,y): (x - y)*(x - y),zip(node.point,point))))
+        return math.sqrt(Euclidean().distance(node.point,point,float("inf")))
 
     @staticmethod
     def _node_to_str(node,level,mode):
-        if node != None:
-            c_str = ' ' * level + mode + ':' + str(node)
-            l_str = KDTree._node_to_str(node.left,level + 2,'l')
-            r_str = KDTree._node_to_str(node.right,level + 2,'r')
+        lines = []
+        stack = [(node,level,mode)] if node != None else []
+
+        while stack:
+            (node,level,mode) = stack.pop()
+            lines.append(' ' * level + mode + ':' + str(node) +
+                         (''.join(map(str,node.bucket)) if node.bucket else ''))
+
+            if node.right != None:
+                stack.append((node.right,level + 2,'r'))
+            if node.left != None:
+                stack.append((node.left,level + 2,'l'))
+
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _node_size(node):
+        return node.size if node != None else 0
+
+    @staticmethod
+    def _entries(node):
+        entries = []
+        stack = [node] if node != None else []
+
+        while stack:
+            node = stack.pop()
+            entries.append(node)
 
-            return c_str + ('\n' + l_str if l_str != '' else '') + \
-                           ('\n' + r_str if r_str != '' else '')
+            if node.bucket:
+                entries.extend(node.bucket)
+            if node.right != None:
+                stack.append(node.right)
+            if node.left != None:
+                stack.append(node.left)
+
+        return entries
+
+    @staticmethod
+    def _split_axis(size,split,disc,lo,hi,points):
+        # The round robin axis "disc" is kept when the points do not spread at all.
+        best = (0,disc)
+
+        if split == 'cycle':
+            return disc
+        elif split == 'max_variance' and points != None and len(points) > 1:
+            for j in range(0,size):
+                values = [point[j] for point in points]
+                mean = float(sum(values)) / len(values)
+                variance = sum((value - mean) * (value - mean) for value in values)
+
+                if variance > best[0]:
+                    best = (variance,j)
         else:
-            return ''
-        
+            for j in range(0,size):
+                if hi[j] - lo[j] > best[0]:
+                    best = (hi[j] - lo[j],j)
+
+        return best[1]
+
     @staticmethod
-    def _insert(size,node,point):
-        if point[node.disc] <= node.point[node.disc]:
-            if node.left == None:
-                node.left = KDTree.KDNode(point,(node.disc + 1) % size)
-            else:
-                KDTree._insert(size,node.left,point)
+    def _leaf_disc(size,split,node,entries):
+        points = [entry.point for entry in entries]
+
+        if len(points) > 1:
+            (lo,hi) = (tuple(map(min,*points)),tuple(map(max,*points)))
+        else:
+            (lo,hi) = (node.lo,node.hi)
+
+        return KDTree._split_axis(size,split,(node.disc + 1) % size,lo,hi,points)
+
+    @staticmethod
+    def _make_leaf(size,entry,disc,leaf_size,bucket=()):
+        entry.disc = disc
+        entry.size = 1 + len(bucket)
+        entry.live = 1 - entry.deleted
+
+        if len(bucket) > 0:
+            entry.live += sum(not moved.deleted for moved in bucket)
+            entry.lo = tuple(map(min,entry.point,*[moved.point for moved in bucket]))
+            entry.hi = tuple(map(max,entry.point,*[moved.point for moved in bucket]))
         else:
-            if node.right == None:
-                node.right = KDTree.KDNode(point,(node.disc + 1) % size)
+            entry.lo = entry.point
+            entry.hi = entry.point
+
+        if leaf_size > 1:
+            for moved in bucket:
+                moved.left = None
+                moved.right = None
+                moved.bucket = None
+
+            entry.bucket = list(bucket)
+
+        return entry
+
+    @staticmethod
+    def _insert(size,node,entry,leaf_size,split='cycle'):
+        path = []
+
+        # Every node the entry passes through counts it in its "size" and "live" and
+        # grows its box to cover it, before the entry is linked in. Boxes are replaced
+        # by larger ones, never updated in place, so readers see consistent boxes. The
+        # path taken is returned, so the caller can look for a scapegoat on it.
+        point = entry.point
+        axes = range(0,size)
+
+        while True:
+            (lo,hi) = (node.lo,node.hi)
+
+            for j in axes:
+                if point[j] < lo[j] or point[j] > hi[j]:
+                    node.lo = tuple(map(min,lo,point))
+                    node.hi = tuple(map(max,hi,point))
+                    break
+
+            node.size += 1
+            node.live += 1
+            path.append(node)
+
+            if node.bucket != None:
+                if len(node.bucket) + 1 < leaf_size:
+                    node.bucket.append(entry)
+                    break
+
+                # The leaf overflowed. Its own point becomes the splitter and the rest
+                # of its points move down into fresh leaves on either side. The leaves
+                # are linked in before the bucket is dropped, so concurrent readers see
+                # either the old leaf or the new subtrees, never neither.
+                entries = node.bucket + [entry]
+                value = node.point[node.disc]
+                left = [e for e in entries if e.point[node.disc] < value]
+                right = [e for e in entries if e.point[node.disc] > value]
+
+                for e in entries:
+                    if e.point[node.disc] == value:
+                        (left if len(left) <= len(right) else right).append(e)
+
+                if len(left) > 0:
+                    disc = (node.disc + 1) % size if split == 'cycle' else KDTree._leaf_disc(size,split,node,left)
+                    node.left = KDTree._make_leaf(size,left[0],disc,leaf_size,left[1:])
+                if len(right) > 0:
+                    disc = (node.disc + 1) % size if split == 'cycle' else KDTree._leaf_disc(size,split,node,right)
+                    node.right = KDTree._make_leaf(size,right[0],disc,leaf_size,right[1:])
+
+                node.bucket = None
+                path.append(node.left if any(e is entry for e in left) else node.right)
+                break
+
+            # Points equal to the splitting point along its axis may go either way, and
+            # go to the lighter side, so that duplicates do not pile up on one side.
+            value = node.point[node.disc]
+
+            if point[node.disc] < value or (point[node.disc] == value and
+                                            KDTree._node_size(node.left) <= KDTree._node_size(node.right)):
+                if node.left == None:
+                    disc = (node.disc + 1) % size if split == 'cycle' else KDTree._leaf_disc(size,split,node,(entry,))
+                    node.left = KDTree._make_leaf(size,entry,disc,leaf_size)
+                    break
+
+                node = node.left
             else:
-                KDTree._insert(size,node.right,point)
+                if node.right == None:
+                    disc = (node.disc + 1) % size if split == 'cycle' else KDTree._leaf_disc(size,split,node,(entry,))
+                    node.right = KDTree._make_leaf(size,entry,disc,leaf_size)
+                    break
+
+                node = node.right
+
+        return path
 
     @staticmethod
-    def _find_exact(size,node,point):
-        if node == None:
+    def _build(size,nodes,disc,leaf_size,split='cycle'):
+        if len(nodes) == 0:
             return None
-        elif node.point == point:
-            return node
-        else:
-            if point[node.disc] <= node.point[node.disc]:
-                return KDTree._find_exact(size,node.left,point)
+
+        orders = [sorted(range(0,len(nodes)),key=lambda i,axis=axis: nodes[i].point[axis])
+                  for axis in range(0,size)]
+
+        return KDTree._build_presorted(size,nodes,orders,disc,leaf_size,split)
+
+    @staticmethod
+    def _build_presorted(size,nodes,orders,disc,leaf_size,split='cycle'):
+        side = [0] * len(nodes)
+        root = None
+        stack = [(orders,disc,None,None)]
+
+        # Each task builds the subtree for one subset of "nodes", given as one list of
+        # indices per axis, each sorted along its axis, and links it under "parent". The
+        # ends of the lists give the subtree's box. All of "nodes" are taken to be live.
+        # The task carries the axis "cycle" would split along, which the other policies
+        # replace by their own choice.
+        while stack:
+            (orders,disc,parent,links_left) = stack.pop()
+
+            if len(orders[0]) == 0:
+                continue
+
+            lo = tuple(nodes[orders[axis][0]].point[axis] for axis in range(0,size))
+            hi = tuple(nodes[orders[axis][-1]].point[axis] for axis in range(0,size))
+
+            if split != 'cycle':
+                points = [nodes[i].point for i in orders[0]] if split == 'max_variance' else None
+                disc = KDTree._split_axis(size,split,disc,lo,hi,points)
+
+            order = orders[disc]
+
+            if leaf_size > 1 and len(order) <= leaf_size:
+                median = len(order) // 2
+                node = KDTree._make_leaf(size,nodes[order[median]],disc,leaf_size)
+                node.left = None
+                node.right = None
+                node.size = len(order)
+
+                for i in order[:median] + order[median + 1:]:
+                    nodes[i].left = None
+                    nodes[i].right = None
+                    nodes[i].bucket = None
+                    node.bucket.append(nodes[i])
+            else:
+                # Points equal to the median along "disc" go to whichever side their
+                # place in "order" puts them, so duplicates split evenly instead of
+                # piling up on one side. Searches for such a point look on both sides.
+                median = len(order) // 2
+
+                if split == 'sliding_midpoint':
+                    values = [nodes[i].point[disc] for i in order]
+                    median = bisect.bisect_right(values,(lo[disc] + hi[disc]) / 2.0) - 1
+                    median = min(max(median,int(math.ceil((1 - KDTree.alpha) * len(order) - 1))),
+                                 int(KDTree.alpha * len(order)))
+
+                for i in order[:median]:
+                    side[i] = -1
+                side[order[median]] = 0
+                for i in order[median + 1:]:
+                    side[i] = 1
+
+                node = nodes[order[median]]
+                node.disc = disc
+                node.bucket = None
+                node.left = None
+                node.right = None
+                node.size = len(order)
+
+                stack.append(([[i for i in o if side[i] > 0] for o in orders],(disc + 1) % size,node,False))
+                stack.append(([[i for i in o if side[i] < 0] for o in orders],(disc + 1) % size,node,True))
+
+            node.live = len(order)
+            node.lo = lo
+            node.hi = hi
+
+            if parent == None:
+                root = node
+            elif links_left:
+                parent.left = node
             else:
-                return KDTree._find_exact(size,node.right,point)
+                parent.right = node
+
+        return root
+
+    # Readers take a single look at "node.bucket". A node with a bucket is a leaf and
+    # has no children worth visiting, even if a concurrent insert is just splitting it.
 
     @staticmethod
-    def _find_with_mask(size,node,point,mask,result):
-        if node == None:
-            return result
-        else:
-            if KDTree._node_equal_with_mask(node,point,mask):
+    def _find_exact(size,node,point,stats):
+        return KDTree._find_exact_path(size,node,point,stats)[0]
+
+    @staticmethod
+    def _find_exact_path(size,node,point,stats):
+        (visited,found,link) = (0,None,None)
+        stack = [(node,None)] if node != None else []
+
+        # A point equal to a node's point along its axis may lie on either side, so the
+        # search follows both children then, the left one first. Each stack entry links
+        # back to the one its node was reached from, which gives the route to the entry
+        # found, from the root down to the node holding it.
+        while stack and found == None:
+            (node,parent) = stack.pop()
+            link = (node,parent)
+            bucket = node.bucket
+            visited += 1
+
+            if node.point == point and not node.deleted:
+                found = node
+            elif bucket != None:
+                for entry in bucket:
+                    if entry.point == point and not entry.deleted:
+                        found = entry
+                        break
+            else:
+                value = node.point[node.disc]
+
+                if point[node.disc] >= value and node.right != None:
+                    stack.append((node.right,link))
+                if point[node.disc] <= value and node.left != None:
+                    stack.append((node.left,link))
+
+        if stats != None:
+            stats.nodes_visited += visited
+
+        path = []
+
+        while found != None and link != None:
+            path.append(link[0])
+            link = link[1]
+
+        path.reverse()
+
+        return (found,path)
+
+    @staticmethod
+    def _find_with_mask(size,node,point,mask,result,stats):
+        (visited,pruned) = (0,0)
+        stack = [node] if node != None else []
+
+        while stack:
+            node = stack.pop()
+            bucket = node.bucket
+            visited += 1
+
+            if not node.deleted and KDTree._node_equal_with_mask(node,point,mask):
                 result.append(node)
 
+            if bucket != None:
+                result.extend(entry for entry in bucket
+                              if not entry.deleted and KDTree._node_equal_with_mask(entry,point,mask))
+                continue
+
+            (left,right) = (node.left,node.right)
+
             if mask[node.disc]:
                 if point[node.disc] < node.point[node.disc]:
-                    KDTree._find_with_mask(size,node.left,point,mask,result)
+                    (right,pruned) = (None,pruned + (right != None))
                 elif point[node.disc] > node.point[node.disc]:
-                    KDTree._find_with_mask(size,node.right,point,mask,result)
-                else:
-                    KDTree._find_with_mask(size,node.left,point,mask,result)
-                    KDTree._find_with_mask(size,node.right,point,mask,result)
-            else:
-                KDTree._find_with_mask(size,node.left,point,mask,result)
-                KDTree._find_with_mask(size,node.right,point,mask,result)
+                    (left,pruned) = (None,pruned + (left != None))
 
-            return result
+            # Push the right subtree first so the left one is reported first.
+            if right != None:
+                stack.append(right)
+            if left != None:
+                stack.append(left)
+
+        if stats != None:
+            stats.nodes_visited += visited
+            stats.subtrees_pruned += pruned
+
+        return result
 
     @staticmethod
-    def _find_nearest(size,node,point,debug_path):
-        if node == None:
-            return (None,float("inf"))
-        else:
-            if debug_path:
-                print node
+    def _find_in_range(size,node,lo,hi,result,stats):
+        (visited,pruned) = (0,0)
+        stack = [node] if node != None else []
 
-            KDTree.nearest_count += 1
+        # A subtree whose box lies inside the range is reported whole, and one whose box
+        # misses the range is skipped. With "result" set to None, only the number of
+        # points is found, from the "live" counts of the subtrees reported whole.
+        count = 0
 
-            if KDTree._node_equal(node,point):
-                return (node,0)
-            elif point[node.disc] < node.point[node.disc]:
-                (best,distance) = KDTree._find_nearest(size,node.left,point,debug_path)
-                direction = 0
-            else:
-                (best,distance) = KDTree._find_nearest(size,node.right,point,debug_path)
-                direction = 1
+        while stack:
+            node = stack.pop()
+            live = node.live
+            (node_lo,node_hi) = (node.lo,node.hi)
+            visited += 1
 
-            if KDTree._node_point_distance(node,point) < distance:
-                (best,distance) = (node,KDTree._node_point_distance(node,point))
+            (inside,outside) = (True,False)
 
-            if math.fabs(node.point[node.disc] - point[node.disc]) < distance:
-                if direction == 0:
-                    (alt_best,alt_distance) = KDTree._find_nearest(size,node.right,point,debug_path)
-                else:
-                    (alt_best,alt_distance) = KDTree._find_nearest(size,node.left,point,debug_path)
+            for j in range(0,size):
+                if node_hi[j] < lo[j] or node_lo[j] > hi[j]:
+                    outside = True
+                    break
+                elif node_lo[j] < lo[j] or node_hi[j] > hi[j]:
+                    inside = False
+
+            if outside:
+                pruned += 1
+                continue
+            elif inside:
+                if result == None:
+                    count += live
+                    continue
+
+                # The box is read before the entries, and an insert grows it before
+                # linking its entry, so an unchanged box means no entry outside the
+                # range was seen.
+                entries = [entry for entry in KDTree._entries(node) if not entry.deleted]
+
+                if node.lo is node_lo and node.hi is node_hi:
+                    result.extend(entries)
+                    continue
 
-                if alt_distance < distance:
-                    return (alt_best,alt_distance)
+            bucket = node.bucket
+
+            for entry in [node] + bucket if bucket else (node,):
+                if entry.deleted:
+                    continue
+
+                point = entry.point
+
+                for j in range(0,size):
+                    if point[j] < lo[j] or point[j] > hi[j]:
+                        break
                 else:
-                    return (best,distance)
+                    if result == None:
+                        count += 1
+                    else:
+                        result.append(entry)
+
+            if bucket != None:
+                continue
+
+            if node.right != None:
+                stack.append(node.right)
+            if node.left != None:
+                stack.append(node.left)
+
+        if stats != None:
+            stats.nodes_visited += visited
+            stats.subtrees_pruned += pruned
+
+        return count if result == None else result
+
+    @staticmethod
+    def _find_nearest(size,node,point,best,distance,metric,debug_path,stats,route=None):
+        (visited,evaluated,pruned) = (0,0,0)
+        (node_distance,axis_distance) = (metric.distance,metric.axis_distance)
+        stack = [(node,0.0,False)] if node != None else []
+
+        # Each stack entry carries a lower bound on the distance from "point" to any
+        # point in its subtree: the farthest splitting plane crossed to reach it. A
+        # node is entered once on the way down and evaluated once its near subtree is
+        # done. Leaves are evaluated as soon as they are entered. A node whose own
+        # plane is farther than the best distance is not evaluated, since neither its
+        # point, which lies on the plane, nor its far subtree can do better. Ties go to
+        # the point inserted first, wherever it sits, as in "_find_k_nearest", so
+        # subtrees that could hold a tie are visited too and the answer does not depend
+        # on where the search starts or what it is seeded with. A node equal to
+        # "point" is taken without measuring it, and the best so far is not measured
+        # again. The search may be seeded with a candidate whose distance already
+        # bounds it, and with the "route" from "node" down to where "point" falls off
+        # the tree, already walked, it starts there as if it had just descended it.
+        # Bounds and distances are all reduced distances of "metric".
+        if route != None:
+            stack = [(node,0.0,True) for node in route[:-1]] + [(route[-1],0.0,False)]
+
+        while stack:
+            (node,bound,entered) = stack.pop()
+
+            if bound > distance:
+                pruned += 1
+                continue
+
+            diff = point[node.disc] - node.point[node.disc]
+
+            if not entered:
+                if debug_path:
+                    print(node)
+
+                visited += 1
+                bucket = node.bucket
+
+                if not node.deleted and KDTree._node_equal(node,point) and (distance > 0 or node.index < best.index):
+                    (best,distance) = (node,0)
+
+                if bucket == None:
+                    stack.append((node,bound,True))
+                    near = node.left if diff < 0 else node.right
+
+                    if near != None:
+                        stack.append((near,bound,False))
+
+                    continue
+
+                entries = [node] + bucket
             else:
-                return (best,distance)
+                plane = axis_distance(node.disc,diff)
 
+                if plane > distance:
+                    pruned += 1
+                    continue
 
-    def __init__(self,size):
-        assert isinstance(size,int)
-        assert size > 1
+                entries = (node,)
 
-        self.root = None
-        self.size = size
+            for entry in entries:
+                if entry.deleted or entry is best:
+                    continue
 
-    def __str__(self):
-        return KDTree._node_to_str(self.root,0,'*')
+                evaluated += 1
+                entry_distance = node_distance(entry.point,point,distance)
 
-    def insert(self,point):
-        assert isinstance(point,tuple)
-        assert len(point) == self.size
+                if entry_distance < distance or (entry_distance == distance and entry.index < best.index):
+                    (best,distance) = (entry,entry_distance)
 
-        if self.root == None:
-            self.root = KDTree.KDNode(point,0)
-        else:
-            KDTree._insert(self.size,self.root,point)
+            far = node.right if diff < 0 else node.left
 
-        return self
+            if entered and far != None:
+                stack.append((far,max(bound,plane),False))
 
-    def find_exact(self,point):
-        assert isinstance(point,tuple)
-        assert len(point) == self.size
+        if stats != None:
+            stats.nodes_visited += visited
+            stats.distance_evaluations += evaluated
+            stats.subtrees_pruned += pruned
 
-        found = KDTree._find_exact(self.size,self.root,point)
+        return (best,distance)
 
-        if found:
-            return found.point
-        else:
-            return None
+    @staticmethod
+    def _find_nearest_approximate(size,node,point,eps,max_visits,metric,debug_path,stats):
+        (visited,charged,evaluated,pruned) = (0,0,0,0)
+        (node_distance,axis_distance) = (metric.distance,metric.axis_distance)
+        (best,distance,limit) = (None,float("inf"),float("inf"))
+        queue = [(0.0,0,node)] if node != None else []
+        pushed = 1
 
-    def find_with_mask(self,point,mask):
-        assert isinstance(point,tuple)
-        assert isinstance(mask,tuple)
-        assert len(point) == self.size
-        assert len(mask) == self.size
-        assert all(map(lambda x: isinstance(x,bool),mask))
+        # Subtrees are visited best bin first, in increasing order of the lower bound on
+        # their distance from "point". A subtree is only worth visiting if it could hold
+        # a point closer than the best so far by a factor of 1+eps, so once the closest
+        # subtree left is no closer than "limit", the best is within that factor of the
+        # true nearest and the search is over. Distances are reduced distances.
+        #
+        # Only nodes holding a live entry are charged to the "max_visits" budget, and
+        # subtrees without any are never queued, so tombstones left by removals cannot
+        # use it up before a live point is found.
+        while queue:
+            (bound,_,node) = queue[0]
 
-        return map(lambda x: x.point,KDTree._find_with_mask(self.size,self.root,point,mask,[]))
+            if bound >= limit:
+                pruned += len(queue)
+                queue = []
+                break
+            elif max_visits != None and charged >= max_visits:
+                break
 
-    def find_nearest(self,point,debug_path=False,count_nodes=False):
-        assert isinstance(point,tuple)
-        assert isinstance(debug_path,bool)
-        assert len(point) == self.size
+            heapq.heappop(queue)
 
-        KDTree.nearest_count = 0
-        found = KDTree._find_nearest(self.size,self.root,point,debug_path)[0].point
+            if debug_path:
+                print(node)
 
-        if count_nodes == True:
-            return (found,KDTree.nearest_count)
+            visited += 1
+            bucket = node.bucket
 
-        return found
+            for entry in [node] + bucket if bucket else (node,):
+                if entry.deleted:
+                    continue
+
+                evaluated += 1
+                entry_distance = node_distance(entry.point,point,distance)
+
+                if entry_distance < distance:
+                    (best,distance) = (entry,entry_distance)
+                    limit = metric.reduce(metric.expand(distance) / (1 + eps)) if eps > 0 else distance
+
+            if not node.deleted or any(not entry.deleted for entry in bucket or ()):
+                charged += 1
+
+            if bucket != None or distance == 0:
+                continue
+
+            diff = point[node.disc] - node.point[node.disc]
+
+            if diff < 0:
+                (near,far) = (node.left,node.right)
+            else:
+                (near,far) = (node.right,node.left)
+
+            if near != None and near.live == 0:
+                (near,pruned) = (None,pruned + 1)
+            if far != None and far.live == 0:
+                (far,pruned) = (None,pruned + 1)
+
+            if near != None:
+                heapq.heappush(queue,(bound,pushed,near))
+                pushed += 1
+            if far != None:
+                heapq.heappush(queue,(max(bound,axis_distance(node.disc,diff)),pushed,far))
+                pushed += 1
+
+        if stats != None:
+            stats.nodes_visited += visited
+            stats.distance_evaluations += evaluated
+            stats.subtrees_pruned += pruned
+
+        return (best,distance,len(queue) == 0)
+
+    @staticmethod
+    def _find_k_nearest(size,node,point,k,metric,heap,stats):
+        (visited,evaluated,pruned) = (0,0,0)
+        (node_distance,axis_distance) = (metric.distance,metric.axis_distance)
+        stack = [(node,0.0)] if node != None else []
+
+        while stack:
+            (node,bound) = stack.pop()
+
+            # The heap holds the k best candidates so far, keyed on negated reduced
+            # distance and then negated insertion index, so that the current k-th best
+            # is always at the top. Ties go to the point inserted first, wherever it
+            # sits, so subtrees that could hold a tie are visited too.
+            if len(heap) == k and bound > -heap[0][0]:
+                pruned += 1
+                continue
+
+            visited += 1
+            bucket = node.bucket
+
+            for entry in [node] + bucket if bucket else (node,):
+                if entry.deleted:
+                    continue
+
+                evaluated += 1
+                distance = node_distance(entry.point,point,-heap[0][0] if len(heap) == k else float("inf"))
+
+                if len(heap) < k:
+                    heapq.heappush(heap,(-distance,-entry.index,entry))
+                elif distance < -heap[0][0] or (distance == -heap[0][0] and entry.index < -heap[0][1]):
+                    heapq.heapreplace(heap,(-distance,-entry.index,entry))
+
+            if bucket != None:
+                continue
+
+            diff = point[node.disc] - node.point[node.disc]
+
+            if diff < 0:
+                (near,far) = (node.left,node.right)
+            else:
+                (near,far) = (node.right,node.left)
+
+            if far != None:
+                stack.append((far,max(bound,axis_distance(node.disc,diff))))
+            if near != None:
+                stack.append((near,bound))
+
+        if stats != None:
+            stats.nodes_visited += visited
+            stats.distance_evaluations += evaluated
+            stats.subtrees_pruned += pruned
+
+        return heap
+
+    @staticmethod
+    def _find_within_radius(size,node,point,radius,metric,result,stats):
+        (visited,evaluated,pruned) = (0,0,0)
+        (node_distance,axis_distance) = (metric.distance,metric.axis_distance)
+        stack = [node] if node != None else []
+
+        while stack:
+            node = stack.pop()
+            bucket = node.bucket
+            visited += 1
+
+            for entry in [node] + bucket if bucket else (node,):
+                if entry.deleted:
+                    continue
+
+                evaluated += 1
+                distance = node_distance(entry.point,point,radius)
+
+                if distance <= radius:
+                    result.append((distance,entry))
+
+            if bucket != None:
+                continue
+
+            diff = point[node.disc] - node.point[node.disc]
+
+            if diff < 0:
+                (near,far) = (node.left,node.right)
+            else:
+                (near,far) = (node.right,node.left)
+
+            if far != None:
+                if axis_distance(node.disc,diff) <= radius:
+                    stack.append(far)
+                else:
+                    pruned += 1
+            if near != None:
+                stack.append(near)
+
+        if stats != None:
+            stats.nodes_visited += visited
+            stats.distance_evaluations += evaluated
+            stats.subtrees_pruned += pruned
+
+        return result
+
+    @staticmethod
+    def _iter_nearest(size,node,point,metric,predicate,lo,hi,stats):
+        node_distance = metric.distance
+        infinity = float("inf")
+        queue = [(0.0,0,0,node,None)] if node != None else []
+        pushed = 1
+
+        # The queue holds subtrees, keyed on the distance from "point" to their box, and
+        # points, keyed on their own distance. A point popped off the queue is no farther
+        # than anything left in it, so it is the next nearest and is yielded at once.
+        # On equal keys subtrees come first, as they might still hold a point at that
+        # distance, and points come out in insertion order, as for "find_nearest".
+        # Subtrees are only opened as the consumer asks for more, and the counts in
+        # "stats" grow with the work actually done.
+        #
+        # A constraint box "lo" to "hi" is pushed down: subtrees whose box misses it are
+        # skipped, the others are keyed on the distance to the part of their box inside
+        # it, and points outside it are never queued. The "predicate" is only called on
+        # a point about to be yielded, so on as few points as possible.
+        while queue:
+            (distance,_,_,node,entry) = heapq.heappop(queue)
+
+            if entry != None:
+                if predicate == None or predicate(entry.point):
+                    yield (distance,entry)
+                continue
+
+            bucket = node.bucket
+            (evaluated,pruned) = (0,0)
+
+            for entry in [node] + bucket if bucket else (node,):
+                if entry.deleted:
+                    continue
+                elif lo != None and not all(l <= x <= h for (l,x,h) in zip(lo,entry.point,hi)):
+                    continue
+
+                evaluated += 1
+                heapq.heappush(queue,(node_distance(entry.point,point,infinity),1,entry.index,None,entry))
+
+            for child in (node.left,node.right) if bucket == None else ():
+                if child == None:
+                    continue
+
+                (child_lo,child_hi) = (child.lo,child.hi)
+
+                if lo != None:
+                    child_lo = tuple(map(max,child_lo,lo))
+                    child_hi = tuple(map(min,child_hi,hi))
+
+                    if any(l > h for (l,h) in zip(child_lo,child_hi)):
+                        pruned += 1
+                        continue
+
+                nearest = tuple(child_lo[j] if point[j] < child_lo[j] else child_hi[j] if point[j] > child_hi[j] else point[j]
+                                for j in range(0,size))
+                heapq.heappush(queue,(node_distance(nearest,point,infinity),0,pushed,child,None))
+                pushed += 1
+
+            if stats != None:
+                stats.nodes_visited += 1
+                stats.distance_evaluations += evaluated
+                stats.subtrees_pruned += pruned
+
+    @staticmethod
+    def _batch_pays(points,queries):
+        return points >= KDTree.batch_points and queries * KDTree.batch_spread >= points
+
+    @staticmethod
+    def _group_by_leaf(root,queries):
+        groups = []
+        stack = [(root,list(range(0,len(queries))),None)]
+
+        # Routes all the queries down together, the way "_find_nearest" descends, and
+        # returns them grouped by the node they fall off the tree at, each group with
+        # the route to that node from the root. A query left alone stops being routed,
+        # at the node it got to, since its own search descends faster from there.
+        while stack:
+            (node,members,link) = stack.pop()
+            link = (node,link)
+
+            if node.bucket != None or len(members) == 1:
+                groups.append((link,members))
+                continue
+
+            left = [i for i in members if queries[i][node.disc] < node.point[node.disc]]
+            right = [i for i in members if queries[i][node.disc] >= node.point[node.disc]]
+
+            for (child,group) in ((node.right,right),(node.left,left)):
+                if len(group) == 0:
+                    continue
+                elif child == None:
+                    groups.append((link,group))
+                else:
+                    stack.append((child,group,link))
+
+        result = []
+
+        for (link,group) in groups:
+            path = []
+
+            while link != None:
+                path.append(link[0])
+                link = link[1]
+
+            path.reverse()
+            result.append((path,group))
+
+        return result
+
+    def __init__(self,size,leaf_size=1,metric=None,split='cycle'):
+        assert isinstance(size,int)
+        assert isinstance(leaf_size,int)
+        assert size > 1
+        assert leaf_size > 0
+        assert metric == None or (isinstance(metric,Metric) and metric.fits(size))
+        assert split in KDTree.splits
+
+        self.root = None
+        self.size = size
+        self.leaf_size = leaf_size
+        self.metric = metric if metric != None else Euclidean()
+        self.split = split
+        self.count = 0
+        self.dead = 0
+        self.lock = threading.Lock()
+        self.indexes = {}
+        self.hooks = []
+        self.ids = array.array('l')
+        self.cache = None
+
+    def __str__(self):
+        return KDTree._node_to_str(self.root,0,'*')
+
+    def __len__(self):
+        return KDTree._node_size(self.root) - self.dead
+
+    def shape(self):
+        """Measure the shape of the tree, as a "TreeShape"."""
+
+        (histogram,nodes,entries) = ([],0,0)
+        memory = sys.getsizeof(self) + sys.getsizeof(self.__dict__)
+        stack = [(self.root,0)] if self.root != None else []
+
+        while stack:
+            (node,depth) = stack.pop()
+            bucket = node.bucket
+
+            if depth == len(histogram):
+                histogram.append(0)
+
+            histogram[depth] += 1
+            nodes += 1
+
+            for entry in [node] + bucket if bucket else (node,):
+                entries += 1
+                memory += sys.getsizeof(entry) + sys.getsizeof(entry.point) + sum(sys.getsizeof(x) for x in entry.point)
+
+                if entry.lo is not entry.point:
+                    memory += sys.getsizeof(entry.lo) + sys.getsizeof(entry.hi)
+
+            if bucket != None:
+                memory += sys.getsizeof(bucket)
+                continue
+
+            if node.right != None:
+                stack.append((node.right,depth + 1))
+            if node.left != None:
+                stack.append((node.left,depth + 1))
+
+        for index in self.indexes.values():
+            memory += sys.getsizeof(index) + sum(sys.getsizeof(points) for points in index.values())
+
+        balance = float(len(histogram)) / max(1,int(math.ceil(math.log(nodes + 1,2))))
+
+        return KDTree.TreeShape(nodes,entries,len(histogram),histogram,balance,memory)
+
+    def add_hook(self,hook):
+        """Call "hook" after every query, with the name of the query method, a
+        "QueryStats" for the call and the seconds it took.
+
+        While any hook is installed, the query methods of this tree are replaced by
+        instrumented ones, and once the last hook is removed the plain methods are
+        restored, so a tree without hooks pays nothing for them. Hooks are called from
+        the querying threads."""
+
+        assert callable(hook)
+
+        with self.lock:
+            if len(self.hooks) == 0:
+                for (name,position) in KDTree.traced:
+                    setattr(self,name,self._traced(name,position))
+
+            self.hooks = self.hooks + [hook]
+
+        return self
+
+    def remove_hook(self,hook):
+        with self.lock:
+            hooks = list(self.hooks)
+            hooks.remove(hook)
+            self.hooks = hooks
+
+            if len(self.hooks) == 0:
+                for (name,_) in KDTree.traced:
+                    delattr(self,name)
+
+        return self
+
+    def enable_cache(self,capacity=1024):
+        """Cache the results of up to "capacity" plain "find_nearest", "find_k_nearest"
+        and "find_with_mask" calls, those asking for nothing beyond statistics and ids.
+
+        Repeated queries are answered from the cache, as a "QueryCache" in "cache" with
+        its "hits" and "misses" counted. A write only drops the cached results it could
+        change, checking each cached query against the point written."""
+
+        assert isinstance(capacity,int)
+        assert capacity > 0
+
+        with self.lock:
+            self.cache = KDTree.QueryCache(capacity)
+
+        return self
+
+    def disable_cache(self):
+        with self.lock:
+            self.cache = None
+
+        return self
+
+    def _traced(self,name,position):
+        method = getattr(KDTree,name)
+        clock = timeit.default_timer
+
+        # The query runs with fresh statistics, which are handed to the hooks and added
+        # to any statistics the caller passed.
+        def traced(*args,**kwargs):
+            stats = KDTree.QueryStats()
+
+            if len(args) > position:
+                (caller,args) = (args[position],args[:position] + (stats,) + args[position + 1:])
+            else:
+                (caller,kwargs['stats']) = (kwargs.get('stats'),stats)
+
+            assert caller == None or isinstance(caller,KDTree.QueryStats)
+
+            start = clock()
+            result = method(self,*args,**kwargs)
+            seconds = clock() - start
+
+            if caller != None:
+                caller.merge(stats)
+
+            for hook in self.hooks:
+                hook(name,stats,seconds)
+
+            return result
+
+        return traced
+
+    def _rebuild(self,path,depth):
+        node = path[depth]
+        entries = KDTree._entries(node)
+        live = [KDTree.KDNode(entry.point,0,entry.index) for entry in entries if not entry.deleted]
+        subtree = KDTree._build(self.size,live,node.disc,self.leaf_size,self.split)
+
+        if depth == 0:
+            self.root = subtree
+        elif path[depth - 1].left is node:
+            path[depth - 1].left = subtree
+        else:
+            path[depth - 1].right = subtree
+
+        # Tombstones inside the subtree are dropped for good.
+        for ancestor in path[:depth]:
+            ancestor.size -= len(entries) - len(live)
+
+        self.dead -= len(entries) - len(live)
+
+    @classmethod
+    def from_points(cls,points,size=None,leaf_size=1,metric=None,ids=None,split='cycle'):
+        points = list(points)
+        ids = list(ids) if ids != None else range(0,len(points))
+
+        if size == None:
+            assert len(points) > 0
+            size = len(points[0])
+
+        assert len(ids) == len(points)
+
+        tree = cls(size,leaf_size,metric,split)
+
+        for point in points:
+            assert isinstance(point,tuple)
+            assert len(point) == size
+
+        for id in ids:
+            tree._append_id(id)
+
+        tree.root = KDTree._build(size,[KDTree.KDNode(point,0,i) for (i,point) in enumerate(points)],0,leaf_size,split)
+        tree.count = len(points)
+
+        return tree
+
+    def insert(self,point,id=None):
+        """Insert "point", labelled with "id", which may be any object and defaults to
+        the insertion index of the point."""
+
+        assert isinstance(point,tuple)
+        assert len(point) == self.size
+
+        with self.lock:
+            self._insert_locked(point,id)
+
+        return self
+
+    def add_index(self,axis):
+        """Keep a hash index on the coordinate along "axis", for "find_with_mask".
+
+        The index maps each value taken along the axis to the live points having it,
+        keyed by their insertion indices. It holds no references into the tree, so
+        rebuilds leave it untouched."""
+
+        assert isinstance(axis,int)
+        assert axis >= 0 and axis < self.size
+
+        with self.lock:
+            if axis in self.indexes:
+                return self
+
+            index = {}
+
+            for entry in KDTree._entries(self.root):
+                if not entry.deleted:
+                    index.setdefault(entry.point[axis],{})[entry.index] = entry.point
+
+            self.indexes[axis] = index
+
+        return self
+
+    def _insert_locked(self,point,id=None):
+        entry = KDTree.KDNode(point,0,self.count)
+        self._append_id(id if id != None else self.count)
+
+        for (axis,index) in self.indexes.items():
+            index.setdefault(point[axis],{})[entry.index] = point
+
+        if self.root == None:
+            self.root = KDTree._make_leaf(self.size,entry,0,self.leaf_size)
+        else:
+            path = KDTree._insert(self.size,self.root,entry,self.leaf_size,self.split)
+
+            # The new entry landed too deep, so some subtree on its path is out of
+            # balance. Rebuild the topmost one whose heavier child is too heavy.
+            if len(path) > math.log(self.root.size,1 / KDTree.alpha):
+                for depth in range(0,len(path)):
+                    node = path[depth]
+
+                    if max(KDTree._node_size(node.left),KDTree._node_size(node.right)) > KDTree.alpha * node.size:
+                        self._rebuild(path,depth)
+                        break
+
+        self.count += 1
+
+        if self.cache != None:
+            self.cache.invalidate(point,self.metric)
+
+    def remove(self,point):
+        assert isinstance(point,tuple)
+        assert len(point) == self.size
+
+        with self.lock:
+            return self._remove_locked(point) != None
+
+    def _remove_locked(self,point):
+        (found,path) = KDTree._find_exact_path(self.size,self.root,point,None)
+
+        if found == None:
+            return None
+
+        # Removal leaves a tombstone that keeps routing queries. Once tombstones make up
+        # half the tree, the whole tree is rebuilt from the live entries. The entry is
+        # uncounted from every subtree on the route the search took to it.
+        found.deleted = True
+        self.dead += 1
+
+        for node in path:
+            if node is not found:
+                node.live -= 1
+
+        found.live -= 1
+
+        for (axis,index) in self.indexes.items():
+            del index[point[axis]][found.index]
+
+            if len(index[point[axis]]) == 0:
+                del index[point[axis]]
+
+        self._remove_id(found.index)
+
+        if 2 * self.dead >= self.root.size:
+            self._rebuild([self.root],0)
+
+        if self.cache != None:
+            self.cache.invalidate(point,self.metric)
+
+        return found
+
+    def find_exact(self,point,stats=None,with_ids=False):
+        assert isinstance(point,tuple)
+        assert len(point) == self.size
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        return self._result(KDTree._find_exact(self.size,self.root,point,stats),with_ids)
+
+    def find_with_mask(self,point,mask,stats=None,with_ids=False):
+        """Find all points equal to "point" on the axes set in "mask", in insertion order."""
+
+        assert isinstance(point,tuple)
+        assert isinstance(mask,tuple)
+        assert len(point) == self.size
+        assert len(mask) == self.size
+        assert all(map(lambda x: isinstance(x,bool),mask))
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        cache = self.cache
+
+        if cache == None:
+            return self._find_with_mask_planned(point,mask,stats,with_ids)
+
+        key = ('find_with_mask',point,mask,with_ids)
+        (hit,found,version) = cache.lookup(key)
+
+        if not hit:
+            found = tuple(self._find_with_mask_planned(point,mask,stats,with_ids))
+            cache.store(key,version,found,point,mask,None)
+
+        return list(found)
+
+    def _find_with_mask_planned(self,point,mask,stats,with_ids):
+        # Each index on a masked axis gives the points matching along that axis. When
+        # the smallest such set is smaller than the part of the tree a walk would
+        # visit, weighing candidates by "index_cost", it is filtered through the other
+        # sets and checked against the mask instead. Either way the matches are reported
+        # in insertion order, so the answer does not depend on the plan. A walk visits
+        # some n^(1-m/d) nodes with m of the d axes masked, but no fewer than the matches
+        # and the nodes above them, which matters for axes taking few distinct values.
+        # The matches are estimated from the sizes of the sets, taking each masked axis
+        # without an index to keep n^(-1/d) of them.
+        indexes = self.indexes
+        lookups = sorted((indexes[axis].get(point[axis],{}) for axis in range(0,self.size)
+                          if mask[axis] and axis in indexes),key=len)
+        count = len(self)
+        walk = 0
+
+        if len(lookups) > 0 and count > 0:
+            matches = count ** (1 - float(sum(mask) - len(lookups)) / self.size)
+
+            for lookup in lookups:
+                matches *= len(lookup) / float(count)
+
+            walk = max(count ** (1 - float(sum(mask)) / self.size),2 * matches)
+
+        if len(lookups) > 0 and KDTree.index_cost * len(lookups[0]) < walk:
+            if stats != None:
+                stats.plan = 'index'
+
+            # Writers may change the sets meanwhile, so the one enumerated is copied.
+            first = dict(lookups[0])
+            matches = sorted(first)
+
+            for other in lookups[1:]:
+                matches = [i for i in matches if i in other]
+
+            for j in range(0,self.size):
+                if mask[j] and j not in indexes:
+                    matches = [i for i in matches if first[i][j] == point[j]]
+
+            if with_ids:
+                ids = self.ids
+                return [(first[i],ids[i]) for i in matches]
+
+            return [first[i] for i in matches]
+
+        if stats != None:
+            stats.plan = 'tree'
+
+        found = KDTree._find_with_mask(self.size,self.root,point,mask,[],stats)
+        found.sort(key=lambda e: e.index)
+
+        return self._results(found,with_ids)
+
+    def find_in_range(self,lo,hi,stats=None,with_ids=False):
+        """Find all points inside the box with corners "lo" and "hi", bounds included."""
+
+        assert isinstance(lo,tuple)
+        assert isinstance(hi,tuple)
+        assert len(lo) == self.size
+        assert len(hi) == self.size
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        return self._results(KDTree._find_in_range(self.size,self.root,lo,hi,[],stats),with_ids)
+
+    def count_in_range(self,lo,hi,stats=None):
+        """Count the points inside the box with corners "lo" and "hi", bounds included."""
+
+        assert isinstance(lo,tuple)
+        assert isinstance(hi,tuple)
+        assert len(lo) == self.size
+        assert len(hi) == self.size
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        return KDTree._find_in_range(self.size,self.root,lo,hi,None,stats)
+
+    def _query_metric(self,metric):
+        assert metric == None or (isinstance(metric,Metric) and metric.fits(self.size))
+
+        return metric if metric != None else self.metric
+
+    def _query_filter(self,predicate,box):
+        assert predicate == None or callable(predicate)
+        assert box == None or (isinstance(box,tuple) and len(box) == 2)
+        assert box == None or all(isinstance(corner,tuple) and len(corner) == self.size for corner in box)
+
+        return (predicate,) + (box if box != None else (None,None))
+
+    def find_nearest(self,point,debug_path=False,count_nodes=False,stats=None,metric=None,eps=None,max_visits=None,
+                     predicate=None,box=None,with_ids=False):
+        """Find the point nearest to "point".
+
+        With "eps" or "max_visits" given, the search is approximate and returns a
+        "NearestResult" instead of just the point. The point found is no farther than
+        1+eps times the distance to the true nearest point, unless the search ran out of
+        its budget of "max_visits" nodes holding a live point first, which the result
+        reports by not being "exhausted".
+
+        With "predicate" given, only points it accepts are considered, and with "box"
+        given as a pair of corners "lo" and "hi", only points inside that box, bounds
+        included. A "find_with_mask" style constraint is the box whose corners agree
+        with the wanted point on the masked axes and are infinite on the others. A
+        filtered search is exact, and checks the box while descending the tree."""
+
+        assert isinstance(point,tuple)
+        assert isinstance(debug_path,bool)
+        assert len(point) == self.size
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+        assert eps == None or (isinstance(eps,(int,float)) and eps >= 0)
+        assert max_visits == None or (isinstance(max_visits,int) and max_visits > 0)
+
+        cache = self.cache
+
+        if cache != None and not debug_path and not count_nodes and (metric,eps,max_visits,predicate,box) == (None,) * 5:
+            key = ('find_nearest',point,with_ids)
+            (hit,found,version) = cache.lookup(key)
+
+            if not hit:
+                (best,distance) = KDTree._find_nearest(self.size,self.root,point,None,float("inf"),self.metric,False,stats)
+                found = self._result(best,with_ids)
+                cache.store(key,version,found,point,None,distance)
+
+            return found
+
+        metric = self._query_metric(metric)
+        (predicate,lo,hi) = self._query_filter(predicate,box)
+
+        assert (predicate == None and lo == None) or (eps == None and max_visits == None)
+
+        if count_nodes == True and stats == None:
+            stats = KDTree.QueryStats()
+
+        if predicate != None or lo != None:
+            best = next(KDTree._iter_nearest(self.size,self.root,point,metric,predicate,lo,hi,stats),(None,None))[1]
+            found = self._result(best,with_ids)
+        elif eps != None or max_visits != None:
+            (best,distance,exhausted) = KDTree._find_nearest_approximate(self.size,self.root,point,eps or 0,max_visits,
+                                                                         metric,debug_path,stats)
+            found = KDTree.NearestResult(self._result(best,with_ids),best.index if best != None else None,
+                                         metric.expand(distance),exhausted)
+        else:
+            best = KDTree._find_nearest(self.size,self.root,point,None,float("inf"),metric,debug_path,stats)[0]
+            found = self._result(best,with_ids)
+
+        if count_nodes == True:
+            return (found,stats.nodes_visited)
+
+        return found
+
+    def find_k_nearest(self,point,k,stats=None,metric=None,predicate=None,box=None,with_ids=False):
+        assert isinstance(point,tuple)
+        assert isinstance(k,int)
+        assert len(point) == self.size
+        assert k > 0
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        cache = self.cache
+
+        if cache != None and (metric,predicate,box) == (None,) * 3:
+            key = ('find_k_nearest',point,k,with_ids)
+            (hit,found,version) = cache.lookup(key)
+
+            if not hit:
+                heap = KDTree._find_k_nearest(self.size,self.root,point,k,self.metric,[],stats)
+                found = tuple(self._results((node for (_,_,node) in sorted(heap,key=lambda x: (-x[0],-x[1]))),with_ids))
+                cache.store(key,version,found,point,None,-heap[0][0] if len(heap) == k else float("inf"))
+
+            return list(found)
+
+        metric = self._query_metric(metric)
+        (predicate,lo,hi) = self._query_filter(predicate,box)
+
+        # Filtered searches take the first "k" points of the best first iteration.
+        if predicate != None or lo != None:
+            nodes = KDTree._iter_nearest(self.size,self.root,point,metric,predicate,lo,hi,stats)
+            return self._results((node for (_,node) in itertools.islice(nodes,k)),with_ids)
+
+        heap = KDTree._find_k_nearest(self.size,self.root,point,k,metric,[],stats)
+
+        return self._results((node for (_,_,node) in sorted(heap,key=lambda x: (-x[0],-x[1]))),with_ids)
+
+    def find_within_radius(self,point,radius,stats=None,metric=None,with_ids=False):
+        assert isinstance(point,tuple)
+        assert isinstance(radius,(int,float))
+        assert len(point) == self.size
+        assert radius >= 0
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        metric = self._query_metric(metric)
+        result = KDTree._find_within_radius(self.size,self.root,point,metric.reduce(radius),metric,[],stats)
+
+        return self._results((node for (_,node) in sorted(result,key=lambda x: (x[0],x[1].index))),with_ids)
+
+    def iter_nearest(self,point,stats=None,metric=None,predicate=None,box=None,with_ids=False):
+        """Yield the points in increasing distance from "point", lazily.
+
+        Only the nodes needed for the points consumed so far are visited, so stopping
+        early, at the first point passing some test for example, costs about as much as
+        a search for that many nearest points. The "predicate" and "box" filters are
+        as for "find_nearest". Hooks are not called for it, but "stats" grows as the
+        points are consumed."""
+
+        assert isinstance(point,tuple)
+        assert len(point) == self.size
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        (predicate,lo,hi) = self._query_filter(predicate,box)
+        nodes = KDTree._iter_nearest(self.size,self.root,point,self._query_metric(metric),predicate,lo,hi,stats)
+
+        return (self._result(node,with_ids) for (_,node) in nodes)
+
+    def find_nearest_batch(self,queries,stats=None,metric=None,with_ids=False):
+        """Find the nearest point for each of a sequence of query points.
+
+        Returns a pair of lists, the insertion indices, or with "with_ids" the ids, of
+        the nearest points and their distances, in the order of "queries". Queries are
+        first routed down the tree together, until they land in a leaf or are left alone,
+        and each search then starts at the end of its query's route, bounded by the
+        distance to the previous answer in its group, instead of descending from the
+        root. Trees smaller than "batch_points", or batches with fewer queries than one
+        for every "batch_spread" points, are searched one query at a time instead.
+        Statistics of all the searches accumulate into "stats", if given."""
+
+        queries = [tuple(query) for query in queries]
+
+        assert all(len(query) == self.size for query in queries)
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        metric = self._query_metric(metric)
+        (found,distances) = self._find_nearest_batch(queries,stats,metric)
+        indices = [best.index if best != None else None for best in found]
+        distances = [metric.expand(distance) if best != None else distance for (best,distance) in zip(found,distances)]
+
+        if with_ids:
+            ids = self.ids
+            indices = [ids[i] if i != None else None for i in indices]
+
+        return (indices,distances)
+
+    def _find_nearest_batch(self,queries,stats,metric):
+        found = [None] * len(queries)
+        distances = [float("inf")] * len(queries)
+
+        if self.root == None:
+            return (found,distances)
+
+        if not KDTree._batch_pays(len(self),len(queries)):
+            for (i,point) in enumerate(queries):
+                (found[i],distances[i]) = KDTree._find_nearest(self.size,self.root,point,None,float("inf"),metric,False,
+                                                               stats)
+
+            return (found,distances)
+
+        # The queries of a group share their route down the tree, walked once for all
+        # of them, so each search starts at the end of the route and works back up it.
+        # It is seeded with the answer for the query before in the group, usually a
+        # close one.
+        for (route,group) in KDTree._group_by_leaf(self.root,queries):
+            best = None
+
+            for i in group:
+                point = queries[i]
+                seed = metric.distance(best.point,point,float("inf")) if best != None else float("inf")
+                (best,distance) = KDTree._find_nearest(self.size,self.root,point,best,seed,metric,False,stats,route)
+                (found[i],distances[i]) = (best,distance)
+
+        return (found,distances)
+
+    def to_arrays(self):
+        """Return the ids and the coordinates of the points, in insertion order.
+
+        The coordinates are one flat array of doubles, "size" to a point. The ids are an
+        array of integers, or a list if some id is not an integer."""
+
+        return self._arrays(entry for entry in KDTree._entries(self.root) if not entry.deleted)
+
+    def flatten(self):
+        """Return a "FlatKDTree" holding the live points of this tree, and its metric."""
+
+        return FlatKDTree.from_tree(self)
+
+    def save(self,path):
+        self.flatten().save(path)
+
+    @staticmethod
+    def open(path,mmap=True):
+        """Open a tree written by "save", as a "FlatKDTree" answering the same queries."""
+
+        return FlatKDTree.open(path,mmap)
+
+class FlatKDTree(object):
+    """A KD tree stored in flat parallel arrays instead of linked "KDNode" objects.
+
+    Node "i" has its coordinates at "coords[i*size:(i+1)*size]", its discriminator at
+    "discs[i]", the indices of its children at "lefts[i]" and "rights[i]", with -1
+    standing for a missing child, the insertion index of its point at "indices[i]" and
+    its id at "ids[i]". Ids must be integers. The root, if any, is node 0. The columns
+    can be any indexable buffers, such as shared ctypes arrays, as long as the tree is
+    not inserted into. Nearest searches measure distances with "metric", which
+    "from_tree" takes from the source tree. As in "KDTree", "count" is the insertion
+    index the next inserted point gets, and its default id."""
+
+    columns = (('coords','d'),('discs','i'),('lefts','i'),('rights','i'),('indices','l'),('ids','l'))
+
+    # The file format is a header holding a magic string, a format version, the number
+    # of dimensions, the number of nodes, the metric as its position in "file_metrics"
+    # and the number of metric parameters, followed by a block of the parameters as
+    # doubles and one block per column in the order of "columns", each starting on an
+    # 8 byte boundary. Values are stored little-endian with the widths in
+    # "file_columns", so the blocks can be used in place once mapped.
+    file_magic = b'SKDT'
+    file_version = 3
+    file_header = struct.Struct('<4sIIQII')
+    file_columns = (ctypes.c_double,ctypes.c_int32,ctypes.c_int32,ctypes.c_int32,ctypes.c_int64,ctypes.c_int64)
+    file_metrics = (Euclidean,Manhattan,Chebyshev,WeightedEuclidean,Minkowski)
+
+    @staticmethod
+    def _file_metric_params(metric):
+        if isinstance(metric,WeightedEuclidean):
+            return tuple(map(float,metric.weights))
+        if isinstance(metric,Minkowski):
+            return (float(metric.p),)
+
+        return ()
+
+    @staticmethod
+    def _file_metric(kind,params):
+        if kind >= len(FlatKDTree.file_metrics):
+            return None
+
+        metric = FlatKDTree.file_metrics[kind]
+
+        if metric == WeightedEuclidean:
+            return WeightedEuclidean(params)
+        if metric == Minkowski:
+            return Minkowski(params[0]) if len(params) == 1 else None
+
+        return metric()
+
+    @staticmethod
+    def _file_layout(size,count,params):
+        offset = FlatKDTree.file_header.size
+        offset += -offset % 8 + 8 * params
+        layout = []
+
+        for (ctype,length) in zip(FlatKDTree.file_columns,(size * count,count,count,count,count,count)):
+            offset += -offset % 8
+            layout.append((ctype,offset,length))
+            offset += ctypes.sizeof(ctype) * length
+
+        return (layout,offset)
+
+    @staticmethod
+    def _node_equal_with_mask(coords,base,size,point,mask):
+        for j in range(0,size):
+            if mask[j] and coords[base + j] != point[j]:
+                return False
+
+        return True
+
+    @classmethod
+    def from_tree(cls,tree):
+        assert isinstance(tree,KDTree)
+        # Ids other than integers, kept by the tree in a list, have no column to go to.
+        assert isinstance(tree.ids,array.array)
+
+        flat = cls(tree.size,tree.metric)
+        flat.count = tree.count
+        root = tree.root
+
+        # Tombstones cannot be represented, so a tree holding any is flattened from a
+        # balanced copy of its live entries instead.
+        if tree.dead > 0:
+            root = KDTree._build(tree.size,[KDTree.KDNode(entry.point,0,entry.index)
+                                            for entry in KDTree._entries(root) if not entry.deleted],0,1)
+
+        if root == None:
+            return flat
+
+        # Lay the nodes out in preorder, patching each child link once the child has
+        # been given its index.
+        stack = [(root,-1,None)]
+
+        while stack:
+            (node,parent,links) = stack.pop()
+            index = len(flat.discs)
+
+            flat.coords.extend(map(float,node.point))
+            flat.discs.append(node.disc)
+            flat.lefts.append(-1)
+            flat.rights.append(-1)
+            flat.indices.append(node.index if node.index != None else -1)
+            flat.ids.append(tree.ids[node.index] if node.index != None else -1)
+
+            if parent != -1:
+                links[parent] = index
+
+            (left,right) = (node.left,node.right)
+
+            # Bucket entries are split around the leaf's own point into small balanced
+            # subtrees, built from copies so the source tree is left untouched.
+            if node.bucket:
+                entries = [KDTree.KDNode(entry.point,0,entry.index) for entry in node.bucket]
+                disc = (node.disc + 1) % tree.size
+
+                left = KDTree._build(tree.size,[e for e in entries if e.point[node.disc] <= node.point[node.disc]],disc,1)
+                right = KDTree._build(tree.size,[e for e in entries if e.point[node.disc] > node.point[node.disc]],disc,1)
+
+            if right != None:
+                stack.append((right,index,flat.rights))
+            if left != None:
+                stack.append((left,index,flat.lefts))
+
+        return flat
+
+    @classmethod
+    def from_points(cls,points,size=None,metric=None):
+        return cls.from_tree(KDTree.from_points(points,size,metric=metric))
+
+    @classmethod
+    def from_columns(cls,size,coords,discs,lefts,rights,indices,ids,metric=None):
+        assert len(coords) == size * len(discs)
+        assert len(discs) == len(lefts) == len(rights) == len(indices) == len(ids)
+
+        flat = cls(size,metric)
+        (flat.coords,flat.discs,flat.lefts,flat.rights,flat.indices,flat.ids) = (coords,discs,lefts,rights,indices,ids)
+        # Removed points leave gaps in the insertion indices, so the next one is past the
+        # largest in use rather than the number of nodes. It is only needed by "insert",
+        # so opening a mapped file does not scan the column for it.
+        flat.count = None
+
+        return flat
+
+    def __init__(self,size,metric=None):
+        assert isinstance(size,int)
+        assert size > 1
+        assert metric == None or (isinstance(metric,Metric) and metric.fits(size))
+
+        self.size = size
+        self.metric = metric if metric != None else Euclidean()
+        self.count = 0
+
+        for (name,typecode) in FlatKDTree.columns:
+            setattr(self,name,array.array(typecode))
+
+    @classmethod
+    def open(cls,path,mmap=True):
+        """Open a tree written by "save".
+
+        With "mmap" the file is memory-mapped copy-on-write and the columns are views of
+        the mapped pages, so opening costs no more than reading the header and processes
+        opening the same file share one copy through the page cache. Otherwise the
+        columns are read into ordinary arrays."""
+
+        assert sys.byteorder == 'little'
+
+        with open(path,'rb') as f:
+            header = f.read(FlatKDTree.file_header.size)
+
+            if len(header) != FlatKDTree.file_header.size:
+                raise ValueError('Truncated tree file ' + str(path))
+
+            (magic,version,size,count,kind,params) = FlatKDTree.file_header.unpack(header)
+
+            if magic != FlatKDTree.file_magic or version != FlatKDTree.file_version:
+                raise ValueError('Not a tree file ' + str(path))
+
+            (layout,total) = FlatKDTree._file_layout(size,count,params)
+            f.seek(0,2)
+
+            if f.tell() < total:
+                raise ValueError('Truncated tree file ' + str(path))
+
+            f.seek(layout[0][1] - 8 * params)
+            block = (ctypes.c_double * params)()
+            f.readinto(block)
+            metric = FlatKDTree._file_metric(kind,tuple(block))
+
+            if metric == None or not metric.fits(size):
+                raise ValueError('Unknown metric in tree file ' + str(path))
+
+            if mmap:
+                f.seek(0)
+                mapping = mmap_module.mmap(f.fileno(),0,access=mmap_module.ACCESS_COPY)
+                columns = [(ctype * length).from_buffer(mapping,offset) for (ctype,offset,length) in layout]
+            else:
+                columns = []
+
+                for ((_,typecode),(ctype,offset,length)) in zip(FlatKDTree.columns,layout):
+                    f.seek(offset)
+                    block = (ctype * length)()
+                    f.readinto(block)
+                    columns.append(array.array(typecode,block))
+
+        return cls.from_columns(size,*columns,metric=metric)
+
+    def save(self,path):
+        assert sys.byteorder == 'little'
+        # Only the metrics in "file_metrics" can be written down, and not subclasses of
+        # them, whose distances could differ.
+        assert type(self.metric) in FlatKDTree.file_metrics
+
+        kind = FlatKDTree.file_metrics.index(type(self.metric))
+        params = FlatKDTree._file_metric_params(self.metric)
+        (layout,total) = FlatKDTree._file_layout(self.size,len(self),len(params))
+
+        with open(path,'wb') as f:
+            f.write(FlatKDTree.file_header.pack(FlatKDTree.file_magic,FlatKDTree.file_version,self.size,len(self),
+                                                kind,len(params)))
+            f.write(b'\0' * (layout[0][1] - 8 * len(params) - f.tell()))
+            f.write(bytearray((ctypes.c_double * len(params))(*params)))
+
+            for ((name,_),(ctype,offset,length)) in zip(FlatKDTree.columns,layout):
+                column = getattr(self,name)
+                block = (ctype * length)()
+
+                if isinstance(column,array.array) and column.itemsize == ctypes.sizeof(ctype):
+                    ctypes.memmove(block,column.buffer_info()[0],ctypes.sizeof(block))
+                else:
+                    block[:] = column[:]
+
+                f.write(b'\0' * (offset - f.tell()))
+                f.write(bytearray(block))
+
+    def __len__(self):
+        return len(self.discs)
+
+    def point(self,index):
+        return tuple(self.coords[index * self.size:(index + 1) * self.size])
+
+    def _result(self,node,with_ids):
+        if node == -1:
+            return None
+        elif with_ids:
+            return (self.point(node),self.ids[node])
+        else:
+            return self.point(node)
+
+    def insert(self,point,id=None):
+        assert isinstance(point,tuple)
+        assert len(point) == self.size
+        assert id == None or (isinstance(id,int) and not isinstance(id,bool))
+
+        # Columns mapped from a file or shared between processes are fixed-size buffers.
+        if not all(hasattr(getattr(self,name),'extend') for (name,_) in FlatKDTree.columns):
+            raise TypeError('Cannot insert into a flat tree whose columns cannot grow')
+
+        if self.count == None:
+            self.count = max(self.indices) + 1 if len(self.indices) > 0 else 0
+
+        index = len(self.discs)
+        coords = self.coords
+        size = self.size
+
+        if index == 0:
+            disc = 0
+        else:
+            node = 0
+
+            while True:
+                disc = self.discs[node]
+                links = self.lefts if point[disc] <= coords[node * size + disc] else self.rights
+
+                if links[node] == -1:
+                    links[node] = index
+                    disc = (disc + 1) % size
+                    break
+
+                node = links[node]
+
+        coords.extend(map(float,point))
+        self.discs.append(disc)
+        self.lefts.append(-1)
+        self.rights.append(-1)
+        self.indices.append(self.count)
+        self.ids.append(id if id != None else self.count)
+        self.count += 1
+
+        return self
+
+    def find_exact(self,point,with_ids=False):
+        assert isinstance(point,tuple)
+        assert len(point) == self.size
+
+        coords = self.coords
+        size = self.size
+        stack = [0] if len(self.discs) > 0 else []
+
+        # Points equal to a node's point along its axis may lie on either side of it.
+        while stack:
+            node = stack.pop()
+            base = node * size
+
+            if all(coords[base + j] == point[j] for j in range(0,size)):
+                return self._result(node,with_ids)
+
+            disc = self.discs[node]
+
+            if point[disc] >= coords[base + disc] and self.rights[node] != -1:
+                stack.append(self.rights[node])
+            if point[disc] <= coords[base + disc] and self.lefts[node] != -1:
+                stack.append(self.lefts[node])
+
+        return None
+
+    def find_with_mask(self,point,mask,with_ids=False):
+        assert isinstance(point,tuple)
+        assert isinstance(mask,tuple)
+        assert len(point) == self.size
+        assert len(mask) == self.size
+        assert all(map(lambda x: isinstance(x,bool),mask))
+
+        coords = self.coords
+        size = self.size
+        result = []
+        stack = [0] if len(self.discs) > 0 else []
+
+        while stack:
+            node = stack.pop()
+            base = node * size
+            disc = self.discs[node]
+
+            if FlatKDTree._node_equal_with_mask(coords,base,size,point,mask):
+                result.append(node)
+
+            (left,right) = (self.lefts[node],self.rights[node])
+
+            if mask[disc] and point[disc] < coords[base + disc]:
+                right = -1
+            elif mask[disc] and point[disc] > coords[base + disc]:
+                left = -1
+
+            if right != -1:
+                stack.append(right)
+            if left != -1:
+                stack.append(left)
+
+        # Matches are reported in insertion order, as in "KDTree".
+        result.sort(key=lambda node: self.indices[node])
+
+        return [self._result(node,with_ids) for node in result]
+
+    def _find_nearest(self,point,debug_path,best=-1,distance=float("inf"),route=None):
+        (coords,discs,lefts,rights,indices) = (self.coords,self.discs,self.lefts,self.rights,self.indices)
+        (size,node_distance,axis_distance) = (self.size,self.metric.distance,self.metric.axis_distance)
+        count = 0
+        stack = [(0,0.0,False)] if len(discs) > 0 else []
+
+        # Each stack entry carries a lower bound on the reduced distance from "point" to
+        # any point in the subtree, from the splitting planes the subtree was reached
+        # across. As in "KDTree._find_nearest", a node is entered on the way down and
+        # evaluated once its near subtree is done, unless its plane is already farther
+        # than the best distance, and the search may be seeded with a "best" node and
+        # its "distance", and start at the end of a "route" from the root already
+        # walked. Ties go to the point inserted first, as in "KDTree.find_nearest", so
+        # subtrees that could hold a tie are visited too.
+        if route != None:
+            stack = [(node,0.0,True) for node in route[:-1]] + [(route[-1],0.0,False)]
+
+        while stack:
+            (node,bound,entered) = stack.pop()
+
+            if bound > distance:
+                continue
+
+            disc = discs[node]
+            base = node * size
+            diff = point[disc] - coords[base + disc]
+
+            if not entered:
+                if debug_path:
+                    print('(' + str(disc) + '|' + ','.join(map(str,self.point(node))) + ')')
+
+                count += 1
+                near = lefts[node] if diff < 0 else rights[node]
+                stack.append((node,bound,True))
+
+                if near != -1:
+                    stack.append((near,bound,False))
+
+                continue
+
+            plane = axis_distance(disc,diff)
+
+            if plane > distance:
+                continue
+
+            if node != best:
+                entry_distance = node_distance(coords[base:base + size],point,distance)
+
+                if entry_distance < distance or (entry_distance == distance and indices[node] < indices[best]):
+                    (best,distance) = (node,entry_distance)
+
+            far = rights[node] if diff < 0 else lefts[node]
+
+            if far != -1:
+                stack.append((far,max(bound,plane),False))
+
+        return (best,distance,count)
+
+    def _group_by_leaf(self,queries):
+        (discs,lefts,rights,coords,size) = (self.discs,self.lefts,self.rights,self.coords,self.size)
+        groups = []
+        stack = [(0,list(range(0,len(queries))),None)]
+
+        # Routes all the queries down together, as "KDTree._group_by_leaf" does, and
+        # returns them grouped by the node they fall off the tree at, each group with
+        # the route to that node from the root.
+        while stack:
+            (node,members,link) = stack.pop()
+            link = (node,link)
+
+            if len(members) == 1 or lefts[node] == rights[node] == -1:
+                groups.append((link,members))
+                continue
+
+            (disc,split) = (discs[node],coords[node * size + discs[node]])
+            left = [i for i in members if queries[i][disc] < split]
+            right = [i for i in members if queries[i][disc] >= split]
+
+            for (child,group) in ((rights[node],right),(lefts[node],left)):
+                if len(group) == 0:
+                    continue
+                elif child == -1:
+                    groups.append((link,group))
+                else:
+                    stack.append((child,group,link))
+
+        result = []
+
+        for (link,group) in groups:
+            route = []
+
+            while link != None:
+                route.append(link[0])
+                link = link[1]
+
+            route.reverse()
+            result.append((route,group))
+
+        return result
+
+    def find_nearest(self,point,debug_path=False,count_nodes=False,with_ids=False):
+        assert isinstance(point,tuple)
+        assert isinstance(debug_path,bool)
+        assert len(point) == self.size
+
+        (best,_,count) = self._find_nearest(point,debug_path)
+        found = self._result(best,with_ids)
+
+        if count_nodes == True:
+            return (found,count)
+
+        return found
+
+    def find_nearest_batch(self,queries,with_ids=False):
+        queries = [tuple(query) for query in queries]
+
+        assert all(len(query) == self.size for query in queries)
+
+        (labels,metric,infinity) = (self.ids if with_ids else self.indices,self.metric,float("inf"))
+        indices = [None] * len(queries)
+        distances = [infinity] * len(queries)
+
+        if len(self.discs) == 0:
+            return (indices,distances)
+
+        if not KDTree._batch_pays(len(self),len(queries)):
+            for (i,point) in enumerate(queries):
+                (best,distance,_) = self._find_nearest(point,False)
+                (indices[i],distances[i]) = (labels[best],metric.expand(distance))
+
+            return (indices,distances)
+
+        # As in "KDTree.find_nearest_batch", the queries of a group share their route
+        # down the tree, and each search starts at its end, seeded with the answer for
+        # the query before in the group, unless the tree or the batch is too small.
+        for (route,group) in self._group_by_leaf(queries):
+            best = -1
+
+            for i in group:
+                point = queries[i]
+                seed = metric.distance(self.point(best),point,infinity) if best != -1 else infinity
+                (best,distance,_) = self._find_nearest(point,False,best,seed,route)
+                (indices[i],distances[i]) = (labels[best],metric.expand(distance))
+
+        return (indices,distances)
+
+# The tree each "ParallelKDTree" worker process answers queries from, set up once when
+# the worker starts.
+_worker_tree = None
+
+def _worker_init(size,columns,metric):
+    global _worker_tree
+    _worker_tree = FlatKDTree.from_columns(size,*columns,metric=metric)
+
+def _worker_find_nearest_batch(queries,with_ids=False):
+    return _worker_tree.find_nearest_batch(queries,with_ids)
+
+class ParallelKDTree(object):
+    """Answers batches of queries from a pool of worker processes.
+
+    The tree is flattened once into shared memory, one shared ctypes array per column of
+    "FlatKDTree", which the workers inherit when they start. Only query points and
+    results travel between processes, never the tree itself. Use it as a context
+    manager, or call "close" to stop the workers."""
+
+    @staticmethod
+    def _share(column,typecode):
+        shared = multiprocessing.sharedctypes.RawArray(typecode,len(column))
+
+        if isinstance(column,array.array):
+            ctypes.memmove(shared,column.buffer_info()[0],len(column) * column.itemsize)
+        else:
+            shared[:] = column[:]
+
+        return shared
+
+    def __init__(self,tree,workers=None):
+        assert isinstance(tree,(KDTree,FlatKDTree))
+        assert workers == None or (isinstance(workers,int) and workers > 0)
+
+        flat = tree.flatten() if isinstance(tree,KDTree) else tree
+
+        self.size = flat.size
+        self.metric = flat.metric
+        self.workers = workers if workers != None else multiprocessing.cpu_count()
+        self.columns = tuple(ParallelKDTree._share(getattr(flat,name),typecode)
+                             for (name,typecode) in FlatKDTree.columns)
+        self.pool = multiprocessing.Pool(self.workers,_worker_init,(self.size,self.columns,self.metric))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+    def close(self):
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def find_nearest_batch(self,queries,chunk_size=None,with_ids=False):
+        """Find the nearest point for each of a sequence of query points.
+
+        Returns the insertion indices, or with "with_ids" the ids, of the nearest points
+        and their distances, like "KDTree.find_nearest_batch". Queries are split into
+        chunks, by default a few per worker so that uneven chunks balance out, and
+        results are merged in order."""
+
+        queries = [tuple(query) for query in queries]
+
+        assert self.pool != None
+        assert all(len(query) == self.size for query in queries)
+        assert chunk_size == None or (isinstance(chunk_size,int) and chunk_size > 0)
+
+        if chunk_size == None:
+            chunk_size = max(1,-(-len(queries) // (4 * self.workers)))
+
+        chunks = [queries[i:i + chunk_size] for i in range(0,len(queries),chunk_size)]
+        (indices,distances) = ([],[])
+
+        for (chunk_indices,chunk_distances) in self.pool.map(functools.partial(_worker_find_nearest_batch,with_ids=with_ids),chunks):
+            indices.extend(chunk_indices)
+            distances.extend(chunk_distances)
+
+        return (indices,distances)
+
+class StreamingKDTree(_IdStore):
+    """A KD tree for points arriving as a stream, after the logarithmic method of Bentley
+    and Saxe.
+
+    New points go to a buffer of up to "buffer_size" points, searched by linear scan.
+    When the buffer fills, its points are merged with those of the run of occupied levels
+    at the bottom into one balanced tree, built in bulk, which takes the first free
+    level. Level i is either empty or a tree of at most "buffer_size" * 2^i points, so
+    every level stays balanced whatever order the points arrive in, and a point is
+    rebuilt into a new level O(log n) times, for O(log^2 n) amortized work per insert.
+    Queries visit the buffer and every level and merge what they find.
+
+    Writers serialize on "lock" and readers take no lock. The buffer and the levels are
+    published together in "state", which a merge or a removal from the buffer replaces
+    whole, so a reader sees every point exactly once. Ids are kept in "ids" by insertion
+    index, as in "KDTree", so merges never copy them."""
+
+    def __init__(self,size,buffer_size=64,leaf_size=1,metric=None,split='cycle'):
+        assert isinstance(size,int)
+        assert isinstance(buffer_size,int)
+        assert isinstance(leaf_size,int)
+        assert size > 1
+        assert buffer_size > 0
+        assert leaf_size > 0
+        assert metric == None or (isinstance(metric,Metric) and metric.fits(size))
+        assert split in KDTree.splits
+
+        self.size = size
+        self.buffer_size = buffer_size
+        self.leaf_size = leaf_size
+        self.metric = metric if metric != None else Euclidean()
+        self.split = split
+        self.count = 0
+        self.state = ([],())
+        self.lock = threading.Lock()
+        self.ids = array.array('l')
+
+    def __len__(self):
+        (buffer,levels) = self.state
+
+        return len(buffer) + sum(len(level) for level in levels if level != None)
+
+    def _merge(self):
+        (buffer,levels) = self.state
+        entries = [KDTree.KDNode(entry.point,0,entry.index) for entry in buffer]
+        levels = list(levels)
+        level = 0
+
+        while level < len(levels) and levels[level] != None:
+            entries.extend(KDTree.KDNode(entry.point,0,entry.index)
+                           for entry in KDTree._entries(levels[level].root) if not entry.deleted)
+            levels[level] = None
+            level += 1
+
+        if level == len(levels):
+            levels.append(None)
+
+        tree = KDTree(self.size,self.leaf_size,self.metric,self.split)
+        tree.root = KDTree._build(self.size,entries,0,self.leaf_size,self.split)
+        tree.count = self.count
+        levels[level] = tree
+
+        self.state = ([],tuple(levels))
+
+    def insert(self,point,id=None):
+        """Insert "point", labelled with "id", which may be any object and defaults to
+        the insertion index of the point."""
+
+        assert isinstance(point,tuple)
+        assert len(point) == self.size
+
+        with self.lock:
+            (buffer,_) = self.state
+            self._append_id(id if id != None else self.count)
+            buffer.append(KDTree.KDNode(point,0,self.count))
+            self.count += 1
+
+            if len(buffer) >= self.buffer_size:
+                self._merge()
+
+        return self
+
+    def remove(self,point):
+        assert isinstance(point,tuple)
+        assert len(point) == self.size
+
+        with self.lock:
+            (buffer,levels) = self.state
+
+            for entry in buffer:
+                if entry.point == point:
+                    self.state = ([other for other in buffer if other is not entry],levels)
+                    self._remove_id(entry.index)
+                    return True
+
+            for level in levels:
+                found = level._remove_locked(point) if level != None else None
+
+                if found != None:
+                    self._remove_id(found.index)
+                    return True
+
+        return False
+
+    def to_arrays(self):
+        """Return the ids and the coordinates of the points, in insertion order, as
+        "KDTree.to_arrays" does."""
+
+        (buffer,levels) = self.state
+        entries = list(buffer)
+
+        for level in levels:
+            if level != None:
+                entries.extend(entry for entry in KDTree._entries(level.root) if not entry.deleted)
+
+        return self._arrays(entries)
+
+    def find_exact(self,point,stats=None,with_ids=False):
+        assert isinstance(point,tuple)
+        assert len(point) == self.size
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        (buffer,levels) = self.state
+
+        for entry in buffer:
+            if entry.point == point:
+                return self._result(entry,with_ids)
+
+        for level in levels:
+            found = KDTree._find_exact(self.size,level.root,point,stats) if level != None else None
+
+            if found != None:
+                return self._result(found,with_ids)
+
+        return None
+
+    def find_with_mask(self,point,mask,stats=None,with_ids=False):
+        assert isinstance(point,tuple)
+        assert isinstance(mask,tuple)
+        assert len(point) == self.size
+        assert len(mask) == self.size
+        assert all(map(lambda x: isinstance(x,bool),mask))
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        (buffer,levels) = self.state
+        result = [entry for entry in buffer if KDTree._node_equal_with_mask(entry,point,mask)]
+
+        for level in levels:
+            if level != None:
+                KDTree._find_with_mask(self.size,level.root,point,mask,result,stats)
+
+        result.sort(key=lambda e: e.index)
+
+        return self._results(result,with_ids)
+
+    def find_in_range(self,lo,hi,stats=None,with_ids=False):
+        assert isinstance(lo,tuple)
+        assert isinstance(hi,tuple)
+        assert len(lo) == self.size
+        assert len(hi) == self.size
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        (buffer,levels) = self.state
+        result = [entry for entry in buffer if all(l <= x <= h for (l,x,h) in zip(lo,entry.point,hi))]
+
+        for level in levels:
+            if level != None:
+                KDTree._find_in_range(self.size,level.root,lo,hi,result,stats)
+
+        return self._results(result,with_ids)
+
+    def count_in_range(self,lo,hi,stats=None):
+        assert isinstance(lo,tuple)
+        assert isinstance(hi,tuple)
+        assert len(lo) == self.size
+        assert len(hi) == self.size
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+
+        (buffer,levels) = self.state
+
+        return (sum(all(l <= x <= h for (l,x,h) in zip(lo,entry.point,hi)) for entry in buffer) +
+                sum(KDTree._find_in_range(self.size,level.root,lo,hi,None,stats) for level in levels if level != None))
+
+    def find_nearest(self,point,stats=None,metric=None,with_ids=False):
+        assert isinstance(point,tuple)
+        assert len(point) == self.size
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+        assert metric == None or (isinstance(metric,Metric) and metric.fits(self.size))
+
+        metric = metric if metric != None else self.metric
+        (buffer,levels) = self.state
+        (best,distance) = (None,float("inf"))
+
+        for entry in buffer:
+            entry_distance = metric.distance(entry.point,point,distance)
+
+            if entry_distance < distance:
+                (best,distance) = (entry,entry_distance)
+
+        if stats != None:
+            stats.distance_evaluations += len(buffer)
+
+        # Each level is searched bounded by the best distance found so far, from the
+        # largest level down, since it most likely holds the nearest point.
+        for level in reversed(levels):
+            if level != None:
+                (best,distance) = KDTree._find_nearest(self.size,level.root,point,best,distance,metric,False,stats)
+
+        return self._result(best,with_ids)
+
+    def find_k_nearest(self,point,k,stats=None,metric=None,with_ids=False):
+        assert isinstance(point,tuple)
+        assert isinstance(k,int)
+        assert len(point) == self.size
+        assert k > 0
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+        assert metric == None or (isinstance(metric,Metric) and metric.fits(self.size))
+
+        metric = metric if metric != None else self.metric
+        (buffer,levels) = self.state
+        heap = []
+
+        for entry in buffer:
+            distance = metric.distance(entry.point,point,-heap[0][0] if len(heap) == k else float("inf"))
+
+            if len(heap) < k:
+                heapq.heappush(heap,(-distance,-entry.index,entry))
+            elif distance < -heap[0][0] or (distance == -heap[0][0] and entry.index < -heap[0][1]):
+                heapq.heapreplace(heap,(-distance,-entry.index,entry))
+
+        if stats != None:
+            stats.distance_evaluations += len(buffer)
+
+        for level in reversed(levels):
+            if level != None:
+                KDTree._find_k_nearest(self.size,level.root,point,k,metric,heap,stats)
+
+        return self._results((node for (_,_,node) in sorted(heap,key=lambda x: (-x[0],-x[1]))),with_ids)
+
+    def find_within_radius(self,point,radius,stats=None,metric=None,with_ids=False):
+        assert isinstance(point,tuple)
+        assert isinstance(radius,(int,float))
+        assert len(point) == self.size
+        assert radius >= 0
+        assert stats == None or isinstance(stats,KDTree.QueryStats)
+        assert metric == None or (isinstance(metric,Metric) and metric.fits(self.size))
+
+        metric = metric if metric != None else self.metric
+        radius = metric.reduce(radius)
+        (buffer,levels) = self.state
+        result = []
+
+        for entry in buffer:
+            distance = metric.distance(entry.point,point,radius)
+
+            if distance <= radius:
+                result.append((distance,entry))
+
+        if stats != None:
+            stats.distance_evaluations += len(buffer)
+
+        for level in levels:
+            if level != None:
+                KDTree._find_within_radius(self.size,level.root,point,radius,metric,result,stats)
+
+        return self._results((node for (_,node) in sorted(result,key=lambda x: (x[0],x[1].index))),with_ids)
+
+class AsyncKDTreeService(object):
+    """Nearest point queries against a "KDTree" for asyncio code.
+
+    "nearest" returns a future at once instead of blocking the event loop. Requests
+    gather in a batch until it holds "max_batch" of them or the first has waited
+    "linger" seconds, and the whole batch is then answered by one batched search,
+    routed down the tree together as in "find_nearest_batch", on "executor", or the
+    loop's default one. A longer linger makes larger batches, trading latency for
+    throughput. Requests must come from the event loop's thread, while the searches
+    read the tree without a lock, as any reader may, so writers can keep writing.
+
+    "batches" and "requests" count what was answered, for tuning the two."""
+
+    def __init__(self,tree,max_batch=64,linger=0.001,executor=None):
+        assert asyncio != None
+        assert isinstance(tree,KDTree)
+        assert isinstance(max_batch,int)
+        assert isinstance(linger,(int,float))
+        assert max_batch > 0
+        assert linger >= 0
+
+        self.tree = tree
+        self.max_batch = max_batch
+        self.linger = linger
+        self.executor = executor
+        self.pending = []
+        self.timer = None
+        self.batches = 0
+        self.requests = 0
+
+    def nearest(self,point,with_ids=False):
+        'Return a future for the point nearest to "point", as "find_nearest" finds it.'
+
+        point = tuple(point)
+
+        assert len(point) == self.tree.size
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((point,with_ids,future))
+
+        if len(self.pending) >= self.max_batch:
+            self._flush(loop)
+        elif self.timer == None:
+            self.timer = loop.call_later(self.linger,self._flush,loop)
+
+        return future
+
+    def _flush(self,loop):
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+
+        # Requests whose callers stopped waiting are dropped before searching.
+        batch = [request for request in self.pending if not request[2].done()]
+        self.pending = []
+
+        if not batch:
+            return
+
+        tree = self.tree
+        search = lambda: tree._find_nearest_batch([point for (point,_,_) in batch],None,tree.metric)[0]
+        loop.run_in_executor(self.executor,search).add_done_callback(lambda done: self._resolve(batch,done))
+
+    def _resolve(self,batch,done):
+        (self.batches,self.requests) = (self.batches + 1,self.requests + len(batch))
+
+        for (i,(_,with_ids,future)) in enumerate(batch):
+            if future.done():
+                continue
+            elif done.cancelled():
+                future.cancel()
+            elif done.exception() != None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(self.tree._result(done.result()[i],with_ids))
 
 def make_for_test1():
     q = KDTree(2)
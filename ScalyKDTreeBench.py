@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+"""Benchmarks for "KDTree".
+
+Run without arguments for a quick suite over every distribution, a couple of sizes
+and dimensions, printing a table and writing the results as JSON. Pass "--compare" with
+an earlier JSON file to see the ratio of every timing to the old one, "--kernels" for
+the distance kernel micro-benchmarks, or "--parallel" for the throughput of
+"ParallelKDTree" over a range of worker counts."""
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+import timeit
+
+from ScalyKDTree import Euclidean,KDTree,ParallelKDTree
+
+# The metric of the benchmarked trees. The linear scans and the answer checks measure
+# distances with it on the raw tuples, so that the baseline pays for nothing a search
+# does not.
+metric = Euclidean()
+
+# The report flags a "find_nearest_batch" whose speedup over the loop falls below this.
+# Where the searches are long, the descent the queries share is a small part of them,
+# and the two run about even, so this leaves room for the noise in timing them.
+batch_tolerance = 0.95
+
+def legacy_node_point_distance(node,point):
+    'The distance computation the nearest search used before squared distances.'
+
+    return math.sqrt(sum(map(lambda t: (t[0] - t[1])*(t[0] - t[1]),zip(node.point,point))))
+
+def bench_distance(size,pairs=1000,repeat=5):
+    """Time the legacy distance and "Euclidean.distance", which the searches call, on
+    random pairs of points in "size" dimensions.
+
+    The bound handed to the early-exit kernel is the first quartile of the squared
+    distances, as in a search that has already found a good candidate, so that most
+    evaluations can stop early."""
+
+    rng = random.Random(size)
+    nodes = [KDTree.KDNode(tuple(rng.random() for _ in range(0,size)),0) for _ in range(0,pairs)]
+    points = [tuple(rng.random() for _ in range(0,size)) for _ in range(0,pairs)]
+    bound = sorted(metric.distance(n.point,p,float("inf")) for (n,p) in zip(nodes,points))[pairs // 4]
+    infinity = float("inf")
+
+    def legacy():
+        for (node,point) in zip(nodes,points):
+            legacy_node_point_distance(node,point)
+
+    def squared():
+        for (node,point) in zip(nodes,points):
+            metric.distance(node.point,point,infinity)
+
+    def early_exit():
+        for (node,point) in zip(nodes,points):
+            metric.distance(node.point,point,bound)
+
+    return dict((name,min(timeit.repeat(kernel,number=1,repeat=repeat)) / pairs)
+                for (name,kernel) in [('legacy',legacy),('squared',squared),('early_exit',early_exit)])
+
+def bench_nearest(size,count=5000,queries=100,repeat=3):
+    'Time "find_nearest" per query on uniform random points in "size" dimensions.'
+
+    rng = random.Random(size)
+    tree = KDTree.from_points([tuple(rng.random() for _ in range(0,size)) for _ in range(0,count)])
+    points = [tuple(rng.random() for _ in range(0,size)) for _ in range(0,queries)]
+
+    def nearest():
+        for point in points:
+            tree.find_nearest(point)
+
+    return min(timeit.repeat(nearest,number=1,repeat=repeat)) / queries
+
+def kernels():
+    print('%5s %14s %14s %14s %10s %14s' % ('dims','legacy (us)','squared (us)','early (us)','speedup','nearest (us)'))
+
+    for size in [2,8,64]:
+        kernels = bench_distance(size)
+
+        print('%5d %14.3f %14.3f %14.3f %9.2fx %14.1f' % (size,kernels['legacy'] * 1e6,kernels['squared'] * 1e6,
+                                                         kernels['early_exit'] * 1e6,kernels['legacy'] / kernels['early_exit'],
+                                                         bench_nearest(size) * 1e6))
+
+def parallel(count,size,queries,workers):
+    """Time "ParallelKDTree.find_nearest_batch" with each number of "workers".
+
+    The baseline is "find_nearest_batch" of the flat tree the workers share, answered in
+    this process, and the scaling of each worker count is its throughput over that.
+    Starting the pool is not timed."""
+
+    rng = random.Random(size)
+    tree = KDTree.from_points(uniform_points(rng,count,size))
+    batch = uniform_points(rng,queries,size)
+    flat = tree.flatten()
+
+    start = timeit.default_timer()
+    expected = flat.find_nearest_batch(batch)
+    single = timeit.default_timer() - start
+
+    print('%5s %12s %14s %10s' % ('workers','seconds','queries/s','scaling'))
+    print('%5s %12.3f %14.0f %9.2fx' % ('-',single,queries / single,1.0))
+
+    for number in workers:
+        with ParallelKDTree(flat,workers=number) as engine:
+            engine.find_nearest_batch(batch[:number])
+            start = timeit.default_timer()
+            found = engine.find_nearest_batch(batch)
+            elapsed = timeit.default_timer() - start
+
+        print('%5d %12.3f %14.0f %9.2fx%s' % (number,elapsed,queries / elapsed,single / elapsed,
+                                              '  MISMATCHES' if found != expected else ''))
+
+# Each distribution draws "count" points in "size" dimensions from "rng". The
+# "clusters" points gather around a handful of centres, "sorted" points arrive in
+# increasing order along the first axis, an adversarial order for incremental inserts,
+# and "skewed" points spread a thousand times less along every other axis, which
+# round robin splits waste half their levels on.
+
+def uniform_points(rng,count,size):
+    return [tuple(rng.random() for _ in range(0,size)) for _ in range(0,count)]
+
+def clustered_points(rng,count,size,clusters=10,spread=0.02):
+    centres = uniform_points(rng,clusters,size)
+
+    return [tuple(rng.gauss(c,spread) for c in rng.choice(centres)) for _ in range(0,count)]
+
+def sorted_points(rng,count,size):
+    return sorted(uniform_points(rng,count,size))
+
+def skewed_points(rng,count,size):
+    return [tuple(x * (0.001 if j % 2 else 1) for (j,x) in enumerate(point)) for point in uniform_points(rng,count,size)]
+
+distributions = (('uniform',uniform_points),('clusters',clustered_points),('sorted',sorted_points),
+                 ('skewed',skewed_points))
+
+def percentiles(samples):
+    'Summarize per-call timings, in seconds, as microsecond percentiles.'
+
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1,int(q * len(samples)))] * 1e6
+
+    return {'mean_us': sum(samples) / len(samples) * 1e6,'p50_us': pick(0.5),'p90_us': pick(0.9),'p99_us': pick(0.99)}
+
+def time_calls(function,arguments):
+    'Call "function" once per argument tuple, returning the results and the time each call took.'
+
+    (results,timings) = ([],[])
+    clock = timeit.default_timer
+
+    for args in arguments:
+        start = clock()
+        results.append(function(*args))
+        timings.append(clock() - start)
+
+    return (results,timings)
+
+def distance(a,b):
+    return metric.expand(metric.distance(a,b,float("inf")))
+
+def brute_nearest(points,query):
+    infinity = float("inf")
+
+    return min(points,key=lambda p: metric.distance(p,query,infinity))
+
+def brute_exact(points,query):
+    for point in points:
+        if point == query:
+            return point
+
+    return None
+
+def brute_with_mask(points,query,mask):
+    return [p for p in points if all(p[j] == query[j] for j in range(0,len(query)) if mask[j])]
+
+def bench_suite(distribution,count,size,queries=200,brute=20,seed=0,split='cycle',batch=5000,repeat=3):
+    """Measure one configuration of the suite.
+
+    The tree is built both in bulk and by one insert per point, in the order the points
+    were drawn, with the "split" policy. Nearest queries are drawn uniformly from the box
+    around the points. The queries are timed one call at a time, for latency percentiles,
+    and the nodes each visits are averaged. A sample of "brute" queries of each kind is
+    also answered by a linear scan, as a baseline and to check the answers. Another
+    "batch" nearest queries are answered together by "find_nearest_batch", and by a
+    loop, the faster of "repeat" runs of each timed."""
+
+    rng = random.Random('%s-%d-%d-%d' % (distribution,count,size,seed))
+    points = dict(distributions)[distribution](rng,count,size)
+    (lo,hi) = (list(map(min,*points)),list(map(max,*points)))
+    near = [tuple(l + x * (h - l) for (l,x,h) in zip(lo,point,hi)) for point in uniform_points(rng,queries,size)]
+    exact = [points[rng.randrange(0,count)] if i % 2 == 0 else near[i] for i in range(0,queries)]
+    masked = [(points[rng.randrange(0,count)],(True,) + (False,) * (size - 1)) for _ in range(0,queries)]
+    result = {'distribution': distribution,'count': count,'dims': size,'queries': queries,'split': split}
+
+    start = timeit.default_timer()
+    tree = KDTree.from_points(points,split=split)
+    result['build'] = {'seconds': timeit.default_timer() - start}
+
+    incremental = KDTree(size,split=split)
+    start = timeit.default_timer()
+
+    for point in points:
+        incremental.insert(point)
+
+    elapsed = timeit.default_timer() - start
+    result['insert'] = {'seconds': elapsed,'points_per_second': count / elapsed,'mean_us': elapsed / count * 1e6}
+    del incremental
+
+    for (name,function,brute_function,arguments) in [
+            ('find_exact',tree.find_exact,brute_exact,[(q,) for q in exact]),
+            ('find_with_mask',tree.find_with_mask,brute_with_mask,masked),
+            ('find_nearest',tree.find_nearest,brute_nearest,[(q,) for q in near])]:
+        stats = KDTree.QueryStats()
+        (found,timings) = time_calls(lambda *args: function(*args,stats=stats),arguments)
+        (expected,brute_timings) = time_calls(lambda *args: brute_function(points,*args),arguments[:brute])
+
+        if name == 'find_with_mask':
+            mismatches = sum(sorted(f) != sorted(e) for (f,e) in zip(found,expected))
+        elif name == 'find_nearest':
+            mismatches = sum(distance(f,a[0]) != distance(e,a[0]) for (f,e,a) in zip(found,expected,arguments))
+        else:
+            mismatches = sum(f != e for (f,e) in zip(found,expected))
+
+        result[name] = percentiles(timings)
+        result[name]['nodes_visited'] = float(stats.nodes_visited) / len(arguments)
+        result[name]['brute_force'] = percentiles(brute_timings)
+        result[name]['speedup'] = result[name]['brute_force']['mean_us'] / result[name]['mean_us']
+        result[name]['mismatches'] = mismatches
+
+    # The batch answers "batch" nearest queries in one call. Its speedup is over the
+    # same queries answered by a plain loop of "find_nearest" calls, which it should
+    # never fall behind, since the queries share their descent through the tree, or
+    # are searched one at a time where that would not pay. Each is timed "repeat"
+    # times, in turn, and the fastest run kept, to steady the ratio.
+    batched = [tuple(l + x * (h - l) for (l,x,h) in zip(lo,point,hi)) for point in uniform_points(rng,batch,size)]
+    stats = KDTree.QueryStats()
+    (_,distances) = tree.find_nearest_batch(batched,stats=stats)
+    found = [tree.find_nearest(q) for q in batched]
+    (elapsed,loop) = (float("inf"),float("inf"))
+
+    for _ in range(0,repeat):
+        start = timeit.default_timer()
+        tree.find_nearest_batch(batched)
+        elapsed = min(elapsed,timeit.default_timer() - start)
+
+        start = timeit.default_timer()
+        [tree.find_nearest(q) for q in batched]
+        loop = min(loop,timeit.default_timer() - start)
+
+    result['find_nearest_batch'] = {'queries': batch,'mean_us': elapsed / batch * 1e6,'loop_mean_us': loop / batch * 1e6,
+                                    'nodes_visited': float(stats.nodes_visited) / batch,'speedup': loop / elapsed,
+                                    'mismatches': sum(d != distance(f,q) for (d,f,q) in zip(distances,found,batched))}
+
+    return result
+
+def flatten(result,prefix=''):
+    'Yield the numeric leaves of a result as pairs of dotted names and values.'
+
+    for (name,value) in sorted(result.items()):
+        if isinstance(value,dict):
+            for item in flatten(value,prefix + name + '.'):
+                yield item
+        elif isinstance(value,float):
+            yield (prefix + name,value)
+
+def key(result):
+    return (result['distribution'],result['count'],result['dims'],result.get('split','cycle'))
+
+def compare(old,new):
+    'Print the ratio of every timing in "new" to the same one in "old".'
+
+    old = dict((key(result),dict(flatten(result))) for result in old['results'])
+
+    for result in new['results']:
+        if key(result) not in old:
+            continue
+
+        print('%s n=%d d=%d split=%s' % key(result))
+
+        for (name,value) in flatten(result):
+            if name.endswith('_us') or name.endswith('seconds'):
+                before = old[key(result)].get(name)
+
+                if before:
+                    print('  %-36s %12.4g %12.4g %8.2fx' % (name,before,value,value / before))
+
+def report(result):
+    print('%-9s n=%-8d d=%-3d %-16s build %8.3fs  insert %8.1fus' % (key(result) + (result['build']['seconds'],
+                                                                                   result['insert']['mean_us'])))
+
+    for name in ['find_exact','find_with_mask','find_nearest']:
+        timing = result[name]
+        print('  %-15s p50 %9.1fus p90 %9.1fus p99 %9.1fus visits %9.1f brute %10.1fus speedup %8.1fx%s' % (
+            name,timing['p50_us'],timing['p90_us'],timing['p99_us'],timing['nodes_visited'],
+            timing['brute_force']['mean_us'],timing['speedup'],
+            '  MISMATCHES %d' % timing['mismatches'] if timing['mismatches'] else ''))
+
+    timing = result['find_nearest_batch']
+    print('  %-15s mean %8.1fus loop %8.1fus visits %9.1f speedup %8.2fx%s%s' % (
+        'nearest_batch',timing['mean_us'],timing['loop_mean_us'],timing['nodes_visited'],timing['speedup'],
+        '  SLOWER THAN LOOP' if timing['speedup'] < batch_tolerance else '',
+        '  MISMATCHES %d' % timing['mismatches'] if timing['mismatches'] else ''))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark KDTree across distributions, sizes and dimensions.')
+    parser.add_argument('--distributions',nargs='+',default=[name for (name,_) in distributions],
+                        choices=[name for (name,_) in distributions])
+    parser.add_argument('--counts',nargs='+',type=int,default=[1000,10000],help='point counts, up to 1e7')
+    parser.add_argument('--dims',nargs='+',type=int,default=[2,8])
+    parser.add_argument('--queries',type=int,default=200,help='timed queries of each kind')
+    parser.add_argument('--brute',type=int,default=20,help='queries of each kind also answered by brute force')
+    parser.add_argument('--batch',type=int,default=5000,help='queries answered together by "find_nearest_batch"')
+    parser.add_argument('--splits',nargs='+',default=['cycle'],choices=KDTree.splits,help='split axis policies')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--output',default='bench_output.json',help='where to write the results as JSON')
+    parser.add_argument('--compare',help='an earlier JSON output to compare the results against')
+    parser.add_argument('--kernels',action='store_true',help='only run the distance kernel micro-benchmarks')
+    parser.add_argument('--parallel',action='store_true',
+                        help='only time "ParallelKDTree" on the first count and dims, with "--batch" queries')
+    parser.add_argument('--workers',nargs='+',type=int,default=[1,2,4,8],help='worker counts for "--parallel"')
+    args = parser.parse_args(argv)
+
+    if args.kernels:
+        kernels()
+        return
+
+    if args.parallel:
+        parallel(args.counts[0],args.dims[0],args.batch,args.workers)
+        return
+
+    results = []
+
+    for distribution in args.distributions:
+        for count in args.counts:
+            for size in args.dims:
+                for split in args.splits:
+                    results.append(bench_suite(distribution,count,size,args.queries,args.brute,args.seed,split,
+                                               args.batch))
+                    report(results[-1])
+
+    output = {'python': platform.python_version(),'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),'seed': args.seed,'results': results}
+
+    with open(args.output,'w') as f:
+        json.dump(output,f,indent=1,sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f),output)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
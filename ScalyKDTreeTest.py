@@ -1,6 +1,17 @@
+import array
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
-from ScalyKDTree import KDTree
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from ScalyKDTree import KDTree, FlatKDTree, ParallelKDTree, StreamingKDTree, AsyncKDTreeService
+from ScalyKDTree import Metric, Euclidean, Manhattan, Chebyshev, WeightedEuclidean, Minkowski
 
 class KDNodeTest(unittest.TestCase):
     'Test harness for "KDNode".'
@@ -63,6 +74,138 @@ class KDNodeTest(unittest.TestCase):
         self.assertNotEqual(a,(1,2,3))
         self.assertNotEqual(a,'hello')
 
+    def test_slots(self):
+        'Nodes carry no per-instance dictionary.'
+
+        a = KDTree.KDNode((1,2),0)
+
+        self.assertFalse(hasattr(a,'__dict__'))
+        self.assertRaises(AttributeError,setattr,a,'extra',1)
+
+class QueryStatsTest(unittest.TestCase):
+    'Test harness for "QueryStats".'
+
+    def test_ctor(self):
+        'Constructor.'
+
+        a = KDTree.QueryStats()
+
+        self.assertEqual(a.nodes_visited,0)
+        self.assertEqual(a.distance_evaluations,0)
+        self.assertEqual(a.subtrees_pruned,0)
+        self.assertEqual(a.plan,None)
+        self.assertFalse(hasattr(a,'__dict__'))
+
+    def test_repr(self):
+        'Python representation.'
+
+        a = KDTree.QueryStats()
+        a.nodes_visited = 3
+
+        self.assertEqual(repr(a),'KDTree.QueryStats(nodes_visited=3,distance_evaluations=0,subtrees_pruned=0,plan=None)')
+
+    def test_merge(self):
+        'Adding up statistics.'
+
+        a = KDTree.QueryStats()
+        b = KDTree.QueryStats()
+        (b.nodes_visited,b.distance_evaluations,b.subtrees_pruned,b.plan) = (3,2,1,'tree')
+
+        self.assertEqual(a.merge(b),a)
+        self.assertEqual(a.merge(b).merge(KDTree.QueryStats()),a)
+        self.assertEqual((a.nodes_visited,a.distance_evaluations,a.subtrees_pruned,a.plan),(6,4,2,'tree'))
+
+class QueryCacheTest(unittest.TestCase):
+    'Test harness for "QueryCache".'
+
+    def test_ctor(self):
+        'Constructor.'
+
+        a = KDTree.QueryCache(3)
+
+        self.assertEqual((a.capacity,a.hits,a.misses,a.version),(3,0,0,0))
+        self.assertEqual(len(a),0)
+        self.assertEqual(repr(a),'KDTree.QueryCache(capacity=3,hits=0,misses=0,version=0)')
+        self.assertFalse(hasattr(a,'__dict__'))
+
+    def test_lookup(self):
+        'Store and look up results, evicting the least recently used.'
+
+        a = KDTree.QueryCache(2)
+
+        self.assertEqual(a.lookup('x'),(False,None,0))
+        a.store('x',0,1,(0,0),None,1)
+        a.store('y',0,2,(5,5),None,1)
+        self.assertEqual(a.lookup('x'),(True,1,0))
+        a.store('z',0,3,(9,9),None,1)
+
+        self.assertEqual(list(a.entries),['x','z'])
+        self.assertEqual((a.hits,a.misses),(1,1))
+
+        # Results computed before a write are not stored after it.
+        (_,_,version) = a.lookup('w')
+        a.invalidate((100,100),Euclidean())
+        a.store('w',version,4,(0,0),None,1)
+
+        self.assertEqual(list(a.entries),['x','z'])
+        self.assertEqual(a.version,1)
+
+    def test_invalidate(self):
+        'Drop only the entries a written point could change.'
+
+        a = KDTree.QueryCache(10)
+        a.store('ball',0,None,(0,0),None,4)
+        a.store('far',0,None,(10,10),None,1)
+        a.store('all',0,None,(20,20),None,float("inf"))
+        a.store('mask',0,None,(1,7),(True,False),None)
+
+        a.invalidate((1,1),Euclidean())
+
+        self.assertEqual(sorted(a.entries),['far'])
+
+        a.invalidate((10,11),Manhattan())
+
+        self.assertEqual(len(a),0)
+
+class MetricTest(unittest.TestCase):
+    'Test harness for "Metric".'
+
+    def test_distance(self):
+        'Distances between points.'
+
+        for (metric,distance) in [(Euclidean(),5),(Manhattan(),7),(Chebyshev(),4),
+                                  (WeightedEuclidean((4,1)),52 ** 0.5),(Minkowski(3),91 ** (1.0 / 3))]:
+            reduced = metric.distance((1,2),(4,-2),float("inf"))
+
+            self.assertAlmostEqual(metric.expand(reduced),distance)
+            self.assertAlmostEqual(metric.reduce(distance),reduced)
+            self.assertEqual(metric.distance((1,2),(1,2),float("inf")),0)
+            self.assertTrue(metric.distance((1,2),(4,-2),metric.axis_distance(0,3)) > metric.axis_distance(0,3))
+
+    def test_axis_distance(self):
+        'Lower bounds across a splitting plane.'
+
+        for metric in [Euclidean(),Manhattan(),Chebyshev(),WeightedEuclidean((4,1)),Minkowski(3)]:
+            for (a,b) in [((1,2),(4,-2)),((0,0),(-3,1)),((2.5,7),(2,7))]:
+                for axis in [0,1]:
+                    self.assertTrue(metric.axis_distance(axis,a[axis] - b[axis]) <= metric.distance(a,b,float("inf")))
+                    self.assertEqual(metric.axis_distance(axis,a[axis] - b[axis]),
+                                     metric.distance(a,tuple(a[j] if j != axis else b[j] for j in (0,1)),float("inf")))
+
+    def test_ctor(self):
+        'Constructor.'
+
+        self.assertEqual(repr(WeightedEuclidean([1,2])),'WeightedEuclidean((1, 2))')
+        self.assertEqual(repr(Minkowski(3)),'Minkowski(3)')
+        self.assertTrue(WeightedEuclidean((1,2)).fits(2))
+        self.assertFalse(WeightedEuclidean((1,2)).fits(3))
+        self.assertTrue(isinstance(Chebyshev(),Metric))
+
+        self.assertRaises(AssertionError,WeightedEuclidean,(1,0))
+        self.assertRaises(AssertionError,WeightedEuclidean,(1,'w'))
+        self.assertRaises(AssertionError,Minkowski,0.5)
+        self.assertRaises(AssertionError,Minkowski,float("inf"))
+
 class KDTreeTest(unittest.TestCase):
     'Test harness for "KDTree".'
 
@@ -73,9 +216,19 @@ class KDTreeTest(unittest.TestCase):
 
         self.assertEqual(a.root,None)
         self.assertEqual(a.size,2)
+        self.assertEqual(a.count,0)
+
+        self.assertEqual(a.leaf_size,1)
+
+        b = KDTree(3,leaf_size=8)
+
+        self.assertEqual(b.size,3)
+        self.assertEqual(b.leaf_size,8)
 
         self.assertRaises(AssertionError,KDTree,'t')
         self.assertRaises(AssertionError,KDTree,0)
+        self.assertRaises(AssertionError,KDTree,2,0)
+        self.assertRaises(AssertionError,KDTree,2,'l')
 
     def test_insert(self):
         'Insertion.'
@@ -117,6 +270,262 @@ class KDTreeTest(unittest.TestCase):
         self.assertRaises(AssertionError,KDTree.insert,c,'hello')
         self.assertRaises(AssertionError,KDTree.insert,c,(1,2))
 
+    def test_from_points(self):
+        'Bulk construction.'
+
+        def depth(node):
+            if node == None:
+                return 0
+            return 1 + max(depth(node.left),depth(node.right))
+
+        points = [(x,y) for x in range(0,32) for y in range(0,32)]
+        a = KDTree.from_points(points)
+
+        self.assertEqual(a.size,2)
+        self.assertTrue(depth(a.root) <= 11)
+
+        for point in points:
+            self.assertEqual(a.find_exact(point),point)
+
+        self.assertEqual(a.find_exact((40,40)),None)
+        self.assertEqual(a.find_nearest((3.1,7.2)),(3,7))
+        self.assertEqual(sorted(a.find_with_mask((5,-1),(True,False))),[(5,y) for y in range(0,32)])
+
+        b = KDTree.from_points([(1,1),(1,2),(1,1),(0,5),(1,3)])
+
+        self.assertEqual(b.find_exact((1,1)),(1,1))
+        self.assertEqual(b.find_exact((1,3)),(1,3))
+        self.assertEqual(b.find_exact((0,5)),(0,5))
+        self.assertEqual(b.find_with_mask((1,1),(True,True)),[(1,1),(1,1)])
+
+        # Duplicates split around the median like any other points.
+        d = KDTree.from_points([(1.0,2.0)] * 2000 + [(x % 2,x // 2 % 2) for x in range(0,2000)])
+
+        self.assertTrue(depth(d.root) <= 12)
+        self.assertEqual(len(d.find_with_mask((1.0,2.0),(True,True))),2000)
+        self.assertEqual(len(d.find_with_mask((1,1),(True,True))),500)
+        self.assertEqual(d.find_nearest((1.1,2.1)),(1.0,2.0))
+
+        for x in range(0,2000):
+            self.assertTrue(d.remove((1.0,2.0)))
+
+        self.assertEqual(d.find_exact((1.0,2.0)),None)
+        self.assertEqual(d.find_exact((0,1)),(0,1))
+        self.assertEqual(len(d),2000)
+
+        c = KDTree.from_points([],size=3)
+
+        self.assertEqual(c.root,None)
+        self.assertEqual(c.size,3)
+
+        self.assertRaises(AssertionError,KDTree.from_points,[])
+        self.assertRaises(AssertionError,KDTree.from_points,[(1,2),(1,2,3)])
+        self.assertRaises(AssertionError,KDTree.from_points,['hello'],2)
+
+    def test_leaf_size(self):
+        'Leaf buckets.'
+
+        def leaves(node):
+            if node == None:
+                return []
+            elif node.bucket != None:
+                return [node]
+            return leaves(node.left) + leaves(node.right)
+
+        a = KDTree(2,leaf_size=4)
+
+        a.insert((5,5))
+        a.insert((2,3))
+        a.insert((2,4))
+
+        self.assertEqual(a.root,(5,5))
+        self.assertEqual(a.root.bucket,[(2,3),(2,4)])
+        self.assertEqual(a.root.left,None)
+
+        a.insert((8,2))
+        a.insert((3,6))
+
+        self.assertEqual(a.root.bucket,None)
+        self.assertEqual(a.root.left,(2,3))
+        self.assertEqual(a.root.left.bucket,[(2,4),(3,6)])
+        self.assertEqual(a.root.right,(8,2))
+        self.assertEqual(a.root.right.bucket,[])
+
+        points = [(x * 7 % 13,x * 5 % 11,x % 3) for x in range(0,200)]
+        queries = [(0,0,0),(6.5,5.2,1.1),(12,-3,4),(3.3,3.3,3.3)]
+
+        b = KDTree(3,leaf_size=6)
+
+        for point in points:
+            b.insert(point)
+
+        c = KDTree.from_points(points,leaf_size=6)
+
+        for tree in [b,c]:
+            self.assertTrue(all(len(leaf.bucket) < 6 for leaf in leaves(tree.root)))
+            self.assertEqual(sum(len(leaf.bucket) for leaf in leaves(tree.root)) > 0,True)
+
+            for point in points:
+                self.assertEqual(tree.find_exact(point),point)
+
+            self.assertEqual(tree.find_exact((1,1,1)),None)
+            self.assertEqual(sorted(tree.find_with_mask((0,-1,-1),(True,False,False))),
+                             sorted(p for p in points if p[0] == 0))
+
+            flat = tree.flatten()
+
+            self.assertEqual(len(flat),200)
+
+            for query in queries:
+                expected = min(KDTree._node_point_distance(KDTree.KDNode(p,0),query) for p in points)
+
+                self.assertEqual(KDTree._node_point_distance(KDTree.KDNode(tree.find_nearest(query),0),query),expected)
+                self.assertEqual(KDTree._node_point_distance(KDTree.KDNode(flat.find_nearest(query),0),query),expected)
+                self.assertEqual(len(tree.find_k_nearest(query,7)),7)
+                self.assertEqual(sorted(tree.find_within_radius(query,3)),
+                                 sorted(p for p in points if KDTree._node_point_distance(KDTree.KDNode(p,0),query) <= 3))
+
+            (indices,distances) = tree.find_nearest_batch(queries)
+
+            self.assertEqual(distances,[KDTree._node_point_distance(KDTree.KDNode(tree.find_nearest(q),0),q) for q in queries])
+
+    def test_deep(self):
+        'Trees deeper than the recursion limit.'
+
+        a = KDTree(2)
+
+        for i in range(0,5000):
+            a.insert((i,i))
+
+        self.assertEqual(a.find_exact((4999,4999)),(4999,4999))
+        self.assertEqual(a.find_with_mask((4998,-1),(True,False)),[(4998,4998)])
+        self.assertEqual(a.find_nearest((4999.2,4999.1)),(4999,4999))
+        self.assertEqual(a.find_k_nearest((5000,5000),2),[(4999,4999),(4998,4998)])
+        self.assertEqual(a.find_within_radius((6000,6000),1416),[(4999,4999)])
+        self.assertEqual(len(str(a).split('\n')),5000)
+        self.assertEqual(len(a.flatten()),5000)
+
+        b = KDTree.from_points([(1,1)] * 5000)
+
+        self.assertEqual(len(b.find_with_mask((1,1),(True,True))),5000)
+
+    def test_rebalance(self):
+        'Scapegoat rebuilds on insertion.'
+
+        def depth(node):
+            if node == None:
+                return 0
+            return 1 + max(depth(node.left),depth(node.right))
+
+        a = KDTree(2)
+
+        for i in range(0,500):
+            a.insert((i,i))
+
+        self.assertEqual(len(a),500)
+        self.assertEqual(a.root.size,500)
+        self.assertTrue(depth(a.root) <= 20)
+
+        for i in range(0,500):
+            self.assertEqual(a.find_exact((i,i)),(i,i))
+
+        # Inserting one point over and over keeps the tree balanced too.
+        for leaf_size in [1,4]:
+            b = KDTree(2,leaf_size=leaf_size)
+            c = KDTree(2,leaf_size=leaf_size)
+
+            for i in range(0,3000):
+                b.insert((1.0,2.0))
+                c.insert((i % 2,i // 2 % 2))
+
+            self.assertTrue(depth(b.root) <= 20)
+            self.assertTrue(depth(c.root) <= 20)
+            self.assertEqual(len(b.find_with_mask((1.0,2.0),(True,True))),3000)
+            self.assertEqual(len(c.find_with_mask((0,1),(True,True))),750)
+
+            for i in range(0,1500):
+                self.assertTrue(b.remove((1.0,2.0)))
+
+            self.assertEqual(len(b),1500)
+            self.assertEqual(b.find_nearest((0,0)),(1.0,2.0))
+
+    def test_remove(self):
+        'Removal.'
+
+        a = KDTree(2)
+
+        a.insert((5,5))
+        a.insert((2,3))
+        a.insert((2,4))
+        a.insert((3,6))
+        a.insert((8,2))
+        a.insert((6,7))
+        a.insert((8,4))
+        a.insert((8,1))
+        a.insert((6,2))
+        a.insert((9,2))
+        a.insert((4.95,0.25))
+
+        self.assertEqual(len(a),11)
+        self.assertEqual(a.remove((8,2)),True)
+        self.assertEqual(a.remove((8,2)),False)
+        self.assertEqual(a.remove((7,7)),False)
+        self.assertEqual(len(a),10)
+        self.assertEqual(a.dead,1)
+        self.assertEqual(a.find_exact((8,2)),None)
+        self.assertEqual(a.find_exact((8,1)),(8,1))
+        self.assertEqual(a.find_nearest((7.9,1.9)),(8,1))
+        self.assertEqual(a.find_with_mask((8,-1),(True,False)),[(8,4),(8,1)])
+        self.assertEqual(a.find_k_nearest((8,2),2),[(8,1),(9,2)])
+        self.assertEqual(sorted(a.find_within_radius((8,2),1)),[(8,1),(9,2)])
+
+        for point in [(5,5),(2,3),(2,4),(3,6),(6,7)]:
+            self.assertEqual(a.remove(point),True)
+
+        self.assertEqual(len(a),5)
+        self.assertEqual(a.dead,0)
+        self.assertEqual(a.root.size,5)
+        self.assertEqual(sorted(a.find_with_mask((0,0),(False,False))),[(4.95,0.25),(6,2),(8,1),(8,4),(9,2)])
+
+        b = KDTree(2)
+
+        b.insert((1,1))
+        b.insert((1,1))
+
+        self.assertEqual(b.remove((1,1)),True)
+        self.assertEqual(b.find_exact((1,1)),(1,1))
+        self.assertEqual(b.remove((1,1)),True)
+        self.assertEqual(b.find_exact((1,1)),None)
+        self.assertEqual(len(b),0)
+        self.assertEqual(b.root,None)
+
+        for leaf_size in [1,5]:
+            c = KDTree(3,leaf_size=leaf_size)
+            live = []
+
+            for i in range(0,600):
+                point = (i * 7 % 13,i * 5 % 11,i % 17)
+                c.insert(point)
+                live.append(point)
+
+                if i % 3 == 2:
+                    removed = live.pop((i * 31) % len(live))
+
+                    self.assertEqual(c.remove(removed),True)
+
+            self.assertEqual(len(c),len(live))
+            self.assertEqual(sorted(c.find_with_mask((0,0,0),(False,False,False))),sorted(live))
+
+            for query in [(0,0,0),(6.5,5.2,1.1),(12,-3,4)]:
+                expected = min(KDTree._node_point_distance(KDTree.KDNode(p,0),query) for p in live)
+
+                self.assertEqual(KDTree._node_point_distance(KDTree.KDNode(c.find_nearest(query),0),query),expected)
+
+            self.assertEqual(len(c.flatten()),len(live))
+
+        self.assertRaises(AssertionError,KDTree.remove,a,'hello')
+        self.assertRaises(AssertionError,KDTree.remove,a,(1,2,3))
+
     def test_find_exact(self):
         'Find exact match.'
 
@@ -158,20 +567,744 @@ class KDTreeTest(unittest.TestCase):
         a.insert((9,2))
         a.insert((4.95,0.25))
 
-        self.assertEqual(a.find_with_mask((8,-1),(True,False)),[(8,2),(8,1),(8,4)])
-        self.assertEqual(a.find_with_mask((6,-1),(True,False)),[(6,2),(6,7)])
+        self.assertEqual(a.find_with_mask((8,-1),(True,False)),[(8,2),(8,4),(8,1)])
+        self.assertEqual(a.find_with_mask((6,-1),(True,False)),[(6,7),(6,2)])
         self.assertEqual(a.find_with_mask((8,1),(True,True)),[(8,1)])
         self.assertEqual(a.find_with_mask((1,2),(True,True)),[])
 
-        self.assertRaises(AssertionError,KDTree.find_with_mask,a,'helo',(True,False))
-        self.assertRaises(AssertionError,KDTree.find_with_mask,a,(1,2),'j')
-        self.assertRaises(AssertionError,KDTree.find_with_mask,a,'helo','j')
-        self.assertRaises(AssertionError,KDTree.find_with_mask,a,(1,2,3),(True,False))
-        self.assertRaises(AssertionError,KDTree.find_with_mask,a,(1,2),(True,True,False))
-        self.assertRaises(AssertionError,KDTree.find_with_mask,a,(1,2),(True,True,'true'))
+        self.assertRaises(AssertionError,KDTree.find_with_mask,a,'helo',(True,False))
+        self.assertRaises(AssertionError,KDTree.find_with_mask,a,(1,2),'j')
+        self.assertRaises(AssertionError,KDTree.find_with_mask,a,'helo','j')
+        self.assertRaises(AssertionError,KDTree.find_with_mask,a,(1,2,3),(True,False))
+        self.assertRaises(AssertionError,KDTree.find_with_mask,a,(1,2),(True,True,False))
+        self.assertRaises(AssertionError,KDTree.find_with_mask,a,(1,2),(True,True,'true'))
+
+    def test_add_index(self):
+        'Find matches with a mask through per-axis indexes.'
+
+        points = [(i % 4,i * 7 % 101,i * 13 % 97,i % 3) for i in range(0,2000)]
+        a = KDTree.from_points(points)
+        b = KDTree.from_points(points)
+
+        self.assertEqual(a.add_index(0),a)
+        self.assertEqual(a.add_index(3),a)
+        self.assertEqual(a.add_index(3),a)
+        self.assertEqual(sorted(a.indexes.keys()),[0,3])
+        self.assertEqual(sorted(a.indexes[3].keys()),[0,1,2])
+
+        stats = KDTree.QueryStats()
+
+        self.assertEqual(a.find_with_mask((1,20,35,2),(True,True,True,False),stats),
+                         b.find_with_mask((1,20,35,2),(True,True,True,False)))
+        self.assertEqual(stats.plan,'tree')
+
+        # A single categorical axis leaves the tree walk visiting most nodes, which the
+        # index avoids.
+        for (point,mask) in [((1,0,0,0),(True,False,False,False)),((0,0,0,2),(False,False,False,True)),
+                             ((3,5,0,0),(True,False,False,False)),((2,0,0,1),(True,False,False,True))]:
+            stats = KDTree.QueryStats()
+            found = a.find_with_mask(point,mask,stats)
+
+            self.assertEqual(stats.plan,'index')
+            self.assertEqual(stats.nodes_visited,0)
+            self.assertEqual(found,b.find_with_mask(point,mask))
+
+        for i in range(0,2000,3):
+            self.assertEqual(a.remove(points[i]),True)
+
+        a.insert((1,1,1,1))
+        a.insert((1,1,1,1))
+        self.assertEqual(a.find_with_mask((1,0,0,1),(True,False,False,True)),
+                         [p for (i,p) in enumerate(points) if i % 3 != 0 and p[0] == 1 and p[3] == 1] + [(1,1,1,1),(1,1,1,1)])
+        self.assertEqual(a.remove((1,1,1,1)),True)
+        self.assertEqual(a.find_with_mask((1,1,1,1),(True,False,False,True))[-1:],[(1,1,1,1)])
+        self.assertEqual(a.remove((1,1,1,1)),True)
+        self.assertEqual(a.find_with_mask((1,1,1,1),(True,False,False,True))[-1:],
+                         [p for (i,p) in enumerate(points) if i % 3 != 0 and p[0] == 1 and p[3] == 1][-1:])
+
+        c = KDTree(2).add_index(1)
+
+        self.assertEqual(c.find_with_mask((1,1),(False,True)),[])
+
+        c.insert((2,1))
+        c.insert((3,1))
+        c.insert((3,2))
+
+        self.assertEqual(c.find_with_mask((0,1),(False,True)),[(2,1),(3,1)])
+        self.assertEqual(c.remove((3,2)),True)
+        self.assertEqual(c.indexes,{1:{1:{0:(2,1),1:(3,1)}}})
+
+        # Adding an index changes the plan but not the order of the matches.
+        d = KDTree.from_points([(8,2),(1,1),(8,4),(8,1),(2,2),(3,3),(4,4),(5,5)])
+        stats = KDTree.QueryStats()
+
+        self.assertEqual(d.find_with_mask((8,0),(True,False),stats),[(8,2),(8,4),(8,1)])
+        self.assertEqual(stats.plan,'tree')
+        self.assertEqual(d.add_index(0).find_with_mask((8,0),(True,False),stats),[(8,2),(8,4),(8,1)])
+        self.assertEqual(stats.plan,'index')
+
+        self.assertRaises(AssertionError,KDTree.add_index,c,2)
+        self.assertRaises(AssertionError,KDTree.add_index,c,'axis')
+
+    def test_find_in_range(self):
+        'Find and count matches inside a box.'
+
+        a = KDTree(2)
+
+        a.insert((5,5))
+        a.insert((2,3))
+        a.insert((2,4))
+        a.insert((3,6))
+        a.insert((8,2))
+        a.insert((6,7))
+        a.insert((8,4))
+        a.insert((8,1))
+        a.insert((6,2))
+        a.insert((9,2))
+        a.insert((4.95,0.25))
+
+        self.assertEqual(sorted(a.find_in_range((6,1),(8,4))),[(6,2),(8,1),(8,2),(8,4)])
+        self.assertEqual(a.count_in_range((6,1),(8,4)),4)
+        self.assertEqual(a.find_in_range((2,3),(2,3)),[(2,3)])
+        self.assertEqual(a.find_in_range((10,10),(20,20)),[])
+        self.assertEqual(a.find_in_range((5,5),(4,6)),[])
+        self.assertEqual(a.count_in_range((0,0),(10,10)),11)
+        self.assertEqual(KDTree(2).find_in_range((0,0),(1,1)),[])
+        self.assertEqual(KDTree(2).count_in_range((0,0),(1,1)),0)
+
+        stats = KDTree.QueryStats()
+
+        self.assertEqual(a.count_in_range((-1,-1),(10,10),stats),11)
+        self.assertEqual(stats.nodes_visited,1)
+
+        for leaf_size in [1,4]:
+            b = KDTree(3,leaf_size=leaf_size)
+            live = []
+
+            for i in range(0,500):
+                point = (i * 7 % 13,i * 5 % 11,i % 17)
+                b.insert(point)
+                live.append(point)
+
+                if i % 4 == 3:
+                    removed = live.pop((i * 31) % len(live))
+
+                    self.assertEqual(b.remove(removed),True)
+
+            # Every box covers its subtree and every count matches it.
+            stack = [b.root]
+
+            while stack:
+                node = stack.pop()
+                entries = KDTree._entries(node)
+
+                self.assertEqual(node.live,len([e for e in entries if not e.deleted]))
+                self.assertTrue(all(node.lo[j] <= e.point[j] <= node.hi[j] for e in entries for j in range(0,3)))
+
+                stack.extend(child for child in (node.left,node.right) if child != None)
+
+            for (lo,hi) in [((0,0,0),(12,10,16)),((2,3,4),(9,7,11)),((5,5,5),(5,5,5)),((3,0,0),(4,10,16)),((20,0,0),(30,5,5))]:
+                expected = [p for p in live if all(l <= x <= h for (l,x,h) in zip(lo,p,hi))]
+
+                self.assertEqual(sorted(b.find_in_range(lo,hi)),sorted(expected))
+                self.assertEqual(b.count_in_range(lo,hi),len(expected))
+
+        self.assertRaises(AssertionError,KDTree.find_in_range,a,'hello',(1,2))
+        self.assertRaises(AssertionError,KDTree.find_in_range,a,(1,2),(1,2,3))
+        self.assertRaises(AssertionError,KDTree.count_in_range,a,(1,2,3),(1,2))
+        self.assertRaises(AssertionError,KDTree.count_in_range,a,(1,2),'world')
+
+    def test_find_nearest(self):
+        'Find nearest match.'
+
+        a = KDTree(2)
+
+        a.insert((5,5))
+        a.insert((2,3))
+        a.insert((2,4))
+        a.insert((3,6))
+        a.insert((8,2))
+        a.insert((6,7))
+        a.insert((8,4))
+        a.insert((8,1))
+        a.insert((6,2))
+        a.insert((9,2))
+        a.insert((4.95,0.25))
+
+        self.assertEqual(a.find_nearest((7.5,2.5)),(8,2))
+        self.assertEqual(a.find_nearest((5.01,0.22)),(4.95,0.25))
+        self.assertEqual(a.find_nearest((3,6)),(3,6))
+        self.assertEqual(a.find_nearest((5,5)),(5,5))
+
+        # Ties go to the point inserted first: (8,2) before (8,1) and (8,4).
+        self.assertEqual(a.find_nearest((7.5,1.5)),(8,2))
+        self.assertEqual(a.find_nearest((8,3)),(8,2))
+
+        self.assertRaises(AssertionError,KDTree.find_nearest,a,'hello')
+        self.assertRaises(AssertionError,KDTree.find_nearest,a,(1,2,3))
+        self.assertRaises(AssertionError,KDTree.find_nearest,a,(1,2),'yello')
+
+    def test_find_nearest_approximate(self):
+        'Find approximate nearest matches.'
+
+        a = KDTree(2)
+
+        a.insert((5,5))
+        a.insert((2,3))
+        a.insert((2,4))
+        a.insert((3,6))
+        a.insert((8,2))
+        a.insert((6,7))
+        a.insert((8,4))
+        a.insert((8,1))
+        a.insert((6,2))
+        a.insert((9,2))
+        a.insert((4.95,0.25))
+
+        found = a.find_nearest((7.5,2.5),eps=0)
+
+        self.assertEqual((found.point,found.index,found.exhausted),((8,2),4,True))
+        self.assertAlmostEqual(found.distance,0.5 ** 0.5)
+        self.assertEqual(a.find_nearest((3,6),eps=0.5).distance,0)
+        self.assertEqual(a.find_nearest((8,3.2),max_visits=100).point,(8,4))
+        self.assertEqual(a.find_nearest((8,3.2),max_visits=1).exhausted,False)
+        self.assertEqual(a.find_nearest((8,3.2),max_visits=1).point,(5,5))
+        self.assertEqual(repr(KDTree(2).find_nearest((1,1),eps=1)),
+                         'KDTree.NearestResult(point=None,index=None,distance=inf,exhausted=True)')
+
+        points = [((i * 37) % 101 / 10.0,(i * 59) % 103 / 10.0,(i * 17) % 97 / 10.0,i % 7) for i in range(0,1000)]
+        b = KDTree.from_points(points,leaf_size=3)
+
+        for query in [(0,0,0,0),(5.1,4.9,5.3,3),(12,-3,4,8),(2.2,8.1,0.3,1)]:
+            nearest = min(KDTree._node_point_distance(KDTree.KDNode(p,0),query) for p in points)
+            exact = KDTree.QueryStats()
+
+            self.assertEqual(b.find_nearest(query,eps=0,stats=exact).distance,nearest)
+
+            for eps in [0.1,0.5,2]:
+                stats = KDTree.QueryStats()
+                found = b.find_nearest(query,eps=eps,stats=stats)
+
+                self.assertTrue(found.exhausted)
+                self.assertTrue(found.distance <= (1 + eps) * nearest + 1e-9)
+                self.assertEqual(found.distance,KDTree._node_point_distance(KDTree.KDNode(found.point,0),query))
+                self.assertEqual(points[found.index],found.point)
+                self.assertTrue(stats.nodes_visited <= exact.nodes_visited)
+
+            for max_visits in [1,5,20]:
+                stats = KDTree.QueryStats()
+                found = b.find_nearest(query,max_visits=max_visits,stats=stats)
+
+                self.assertTrue(stats.nodes_visited <= max_visits)
+                self.assertTrue(found.point != None)
+                self.assertTrue(found.distance >= nearest)
+                self.assertTrue(found.exhausted or stats.nodes_visited == max_visits)
+
+            self.assertEqual(b.find_nearest(query,max_visits=10000).distance,nearest)
+            self.assertTrue(b.find_nearest(query,max_visits=10000).exhausted)
+
+        # Tombstones left by removals are not charged to the budget, so a search with
+        # any budget at all finds a live point.
+        for leaf_size in [1,3]:
+            c = KDTree.from_points(points,leaf_size=leaf_size)
+            removed = set(points[i] for i in range(0,1000) if i % 5 < 2)
+
+            for point in removed:
+                c.remove(point)
+
+            for query in [(0,0,0,0),(5.1,4.9,5.3,3),(12,-3,4,8),(2.2,8.1,0.3,1)] + sorted(removed)[:50]:
+                for max_visits in [1,3]:
+                    found = c.find_nearest(query,max_visits=max_visits)
+
+                    self.assertTrue(found.point != None)
+                    self.assertTrue(found.point not in removed)
+
+        self.assertRaises(AssertionError,KDTree.find_nearest,a,(1,2),eps=-1)
+        self.assertRaises(AssertionError,KDTree.find_nearest,a,(1,2),eps='e')
+        self.assertRaises(AssertionError,KDTree.find_nearest,a,(1,2),max_visits=0)
+        self.assertRaises(AssertionError,KDTree.find_nearest,a,(1,2),max_visits=1.5)
+
+    def test_find_k_nearest(self):
+        'Find k nearest matches.'
+
+        a = KDTree(2)
+
+        a.insert((5,5))
+        a.insert((2,3))
+        a.insert((2,4))
+        a.insert((3,6))
+        a.insert((8,2))
+        a.insert((6,7))
+        a.insert((8,4))
+        a.insert((8,1))
+        a.insert((6,2))
+        a.insert((9,2))
+        a.insert((4.95,0.25))
+
+        self.assertEqual(a.find_k_nearest((7.5,2.5),1),[(8,2)])
+        self.assertEqual(a.find_k_nearest((7.6,1.4),3),[(8,1),(8,2),(9,2)])
+        self.assertEqual(a.find_k_nearest((2,3),2),[(2,3),(2,4)])
+        self.assertEqual(len(a.find_k_nearest((0,0),20)),11)
+        self.assertEqual(KDTree(2).find_k_nearest((0,0),3),[])
+
+        points = [(x * 7 % 13,x * 5 % 11,x % 3) for x in range(0,200)]
+        b = KDTree.from_points(points)
+
+        for query in [(0,0,0),(6.5,5.2,1.1),(12,-3,4)]:
+            distances = sorted(KDTree._node_point_distance(KDTree.KDNode(p,0),query) for p in points)
+            found = b.find_k_nearest(query,10)
+
+            self.assertEqual([KDTree._node_point_distance(KDTree.KDNode(p,0),query) for p in found],
+                             distances[:10])
+
+        # Ties go to the point inserted first, and are listed in insertion order.
+        for query in [(6,5,1),(3,3,0),(7.5,2,1)]:
+            order = sorted(range(0,len(points)),key=lambda i: (Euclidean().distance(points[i],query,float("inf")),i))
+
+            self.assertEqual(b.find_k_nearest(query,10,with_ids=True),[(points[i],i) for i in order[:10]])
+
+        self.assertRaises(AssertionError,KDTree.find_k_nearest,a,'hello',2)
+        self.assertRaises(AssertionError,KDTree.find_k_nearest,a,(1,2,3),2)
+        self.assertRaises(AssertionError,KDTree.find_k_nearest,a,(1,2),0)
+        self.assertRaises(AssertionError,KDTree.find_k_nearest,a,(1,2),'k')
+
+    def test_find_within_radius(self):
+        'Find matches within a radius.'
+
+        a = KDTree(2)
+
+        a.insert((5,5))
+        a.insert((2,3))
+        a.insert((2,4))
+        a.insert((3,6))
+        a.insert((8,2))
+        a.insert((6,7))
+        a.insert((8,4))
+        a.insert((8,1))
+        a.insert((6,2))
+        a.insert((9,2))
+        a.insert((4.95,0.25))
+
+        self.assertEqual(sorted(a.find_within_radius((8,2),1)),[(8,1),(8,2),(9,2)])
+        self.assertEqual(a.find_within_radius((8,2),0),[(8,2)])
+        self.assertEqual(a.find_within_radius((0,9),2),[])
+        self.assertEqual(len(a.find_within_radius((5,5),100)),11)
+
+        points = [(x * 7 % 13,x * 5 % 11,x % 3) for x in range(0,200)]
+        b = KDTree.from_points(points)
+
+        for query in [(0,0,0),(6.5,5.2,1.1),(12,-3,4)]:
+            expected = [p for p in points if KDTree._node_point_distance(KDTree.KDNode(p,0),query) <= 4]
+
+            self.assertEqual(sorted(b.find_within_radius(query,4)),sorted(expected))
+
+        # Points at equal distances are listed in insertion order.
+        for query in [(6,5,1),(3,3,0),(7.5,2,1)]:
+            order = sorted(range(0,len(points)),key=lambda i: (Euclidean().distance(points[i],query,float("inf")),i))
+            within = [i for i in order if Euclidean().distance(points[i],query,float("inf")) <= 16]
+
+            self.assertEqual(b.find_within_radius(query,4,with_ids=True),[(points[i],i) for i in within])
+
+        self.assertRaises(AssertionError,KDTree.find_within_radius,a,'hello',2)
+        self.assertRaises(AssertionError,KDTree.find_within_radius,a,(1,2,3),2)
+        self.assertRaises(AssertionError,KDTree.find_within_radius,a,(1,2),-1)
+        self.assertRaises(AssertionError,KDTree.find_within_radius,a,(1,2),'r')
+
+    def test_iter_nearest(self):
+        'Iterate over points in increasing distance, doing only the work needed.'
+
+        points = [(x * 7 % 13,x * 5 % 11,x % 3) for x in range(0,200)]
+        queries = [(0,0,0),(6.5,5.2,1.1),(12,-3,4)]
+
+        for leaf_size in [1,4]:
+            a = KDTree.from_points(points,leaf_size=leaf_size)
+            a.remove(points[10])
+            a.insert((20,20,20))
+            live = points[:10] + points[11:] + [(20,20,20)]
+
+            for metric in [Euclidean(),Manhattan(),Chebyshev()]:
+                for query in queries:
+                    distances = sorted(metric.distance(p,query,float("inf")) for p in live)
+                    found = list(a.iter_nearest(query,metric=metric))
+
+                    self.assertEqual(sorted(found),sorted(live))
+                    self.assertEqual([metric.distance(p,query,float("inf")) for p in found],distances)
+
+        b = KDTree.from_points(points)
+        (first,all) = (KDTree.QueryStats(),KDTree.QueryStats())
+        nearest = b.iter_nearest((6.5,5.2,1.1),stats=first)
+
+        self.assertEqual(first.nodes_visited,0)
+        self.assertEqual(next(nearest),b.find_nearest((6.5,5.2,1.1)))
+        self.assertEqual([next(nearest) for _ in range(0,4)],list(b.iter_nearest((6.5,5.2,1.1),stats=all))[1:5])
+        self.assertTrue(0 < first.nodes_visited < all.nodes_visited)
+        self.assertEqual(all.nodes_visited,200)
+
+        self.assertEqual(list(KDTree(2).iter_nearest((1,2))),[])
+
+        self.assertRaises(AssertionError,KDTree.iter_nearest,b,(1,2))
+        self.assertRaises(AssertionError,KDTree.iter_nearest,b,(1,2,3),metric=WeightedEuclidean((1,2)))
+
+    def test_find_nearest_filtered(self):
+        'Find nearest matches among the points passing a predicate or inside a box.'
+
+        points = [(x * 7 % 13,x * 5 % 11,x % 3) for x in range(0,200)]
+        infinity = float("inf")
+        filters = [(lambda p: p[0] % 2 == 1,None),
+                   (None,((2,3,-infinity),(6,infinity,1))),
+                   (lambda p: p[1] > p[0],((-infinity,-infinity,2),(infinity,infinity,2))),
+                   (lambda p: False,None),
+                   (None,((20,20,20),(30,30,30)))]
+
+        for leaf_size in [1,4]:
+            a = KDTree.from_points(points,leaf_size=leaf_size)
+
+            for (predicate,box) in filters:
+                accepted = [p for p in points if (predicate == None or predicate(p)) and
+                            (box == None or all(l <= x <= h for (l,x,h) in zip(box[0],p,box[1])))]
+
+                for query in [(0,0,0),(6.5,5.2,1.1),(12,-3,4)]:
+                    distances = sorted(Euclidean().distance(p,query,infinity) for p in accepted)
+                    found = a.find_nearest(query,predicate=predicate,box=box)
+                    k_found = a.find_k_nearest(query,5,predicate=predicate,box=box)
+
+                    self.assertEqual(Euclidean().distance(found,query,infinity) if found != None else None,
+                                     distances[0] if distances else None)
+                    self.assertEqual([Euclidean().distance(p,query,infinity) for p in k_found],distances[:5])
+                    self.assertTrue(all(p in accepted for p in k_found))
+                    self.assertEqual(sorted(a.iter_nearest(query,predicate=predicate,box=box)),sorted(accepted))
+
+        # A filter accepting everything changes nothing, ties included: on a grid with
+        # repeated points, tied matches come out in insertion order.
+        grid = [(float(x % 5),float(x // 5 % 5)) for x in range(0,60)]
+        everything = ((-infinity,-infinity),(infinity,infinity))
+
+        for leaf_size in [1,4]:
+            c = KDTree.from_points(grid,leaf_size=leaf_size)
+
+            for query in [(1.5,2.5),(1,2),(2.5,2.5),(-1,0.5),(4.5,4.5)]:
+                expected = c.find_nearest(query,with_ids=True)
+                k_expected = c.find_k_nearest(query,7,with_ids=True)
+
+                self.assertEqual(c.find_nearest(query,predicate=lambda p: True,with_ids=True),expected)
+                self.assertEqual(c.find_nearest(query,box=everything,with_ids=True),expected)
+                self.assertEqual(c.find_k_nearest(query,7,predicate=lambda p: True,with_ids=True),k_expected)
+                self.assertEqual(c.find_k_nearest(query,7,box=everything,with_ids=True),k_expected)
+
+        # Subtrees outside the box are skipped, and the predicate is called only on the
+        # points up for being returned.
+        b = KDTree.from_points(points)
+        (calls,stats,unfiltered) = ([],KDTree.QueryStats(),KDTree.QueryStats())
+
+        b.find_nearest((0,0,0),stats=stats,predicate=lambda p: calls.append(p) or True,box=((10,8,0),(12,10,2)))
+        b.find_nearest((0,0,0),stats=unfiltered)
+
+        self.assertEqual(len(calls),1)
+        self.assertTrue(stats.subtrees_pruned > 0)
+        self.assertEqual(b.find_nearest((0,0,0),count_nodes=True,box=((10,8,0),(12,10,2))),((10,8,0),stats.nodes_visited))
+
+        self.assertEqual(KDTree(2).find_nearest((1,2),predicate=lambda p: True),None)
+        self.assertEqual(KDTree(2).find_k_nearest((1,2),3,box=((0,0),(1,1))),[])
+
+        self.assertRaises(AssertionError,KDTree.find_nearest,b,(1,2,3),predicate=1)
+        self.assertRaises(AssertionError,KDTree.find_nearest,b,(1,2,3),box=((1,2),(3,4)))
+        self.assertRaises(AssertionError,KDTree.find_nearest,b,(1,2,3),box=((1,2,3),))
+        self.assertRaises(AssertionError,KDTree.find_nearest,b,(1,2,3),eps=0.5,predicate=lambda p: True)
+        self.assertRaises(AssertionError,KDTree.find_k_nearest,b,(1,2,3),2,box=(1,2))
+
+    def test_ids(self):
+        'Label points with ids, returned by queries and kept apart from the nodes.'
+
+        a = KDTree(2)
+
+        a.insert((5,5),id=50)
+        a.insert((2,3))
+        a.insert((2,3),id=23)
+        a.insert((8,2),id=82)
+
+        self.assertTrue(isinstance(a.ids,array.array))
+        self.assertEqual(list(a.ids),[50,1,23,82])
+        self.assertEqual(a.find_exact((5,5),with_ids=True),((5,5),50))
+        self.assertEqual(a.find_exact((9,9),with_ids=True),None)
+        self.assertEqual(sorted(a.find_with_mask((2,0),(True,False),with_ids=True)),[((2,3),1),((2,3),23)])
+        self.assertEqual(sorted(a.find_in_range((0,0),(6,6),with_ids=True)),[((2,3),1),((2,3),23),((5,5),50)])
+        self.assertEqual(a.find_nearest((7,2),with_ids=True),((8,2),82))
+        self.assertEqual(a.find_nearest((7,2),with_ids=True,eps=0.5).point,((8,2),82))
+        self.assertEqual(a.find_nearest((7,2),with_ids=True,box=((0,0),(6,6))),((5,5),50))
+        self.assertEqual(sorted(a.find_k_nearest((2,3),2,with_ids=True)),[((2,3),1),((2,3),23)])
+        self.assertEqual(sorted(a.find_within_radius((2,3),0,with_ids=True)),[((2,3),1),((2,3),23)])
+        self.assertEqual(next(a.iter_nearest((8,1),with_ids=True)),((8,2),82))
+        self.assertEqual(a.find_nearest_batch([(8,1),(5,6)],with_ids=True),([82,50],[1.0,1.0]))
+        self.assertEqual(a.find_nearest_batch([(8,1),(5,6)]),([3,0],[1.0,1.0]))
+
+        a.add_index(0)
+
+        self.assertEqual(a.find_with_mask((2,0),(True,False),with_ids=True),[((2,3),1),((2,3),23)])
+
+        (ids,coords) = a.to_arrays()
+
+        self.assertEqual(ids,array.array('l',[50,1,23,82]))
+        self.assertEqual(coords,array.array('d',[5,5,2,3,2,3,8,2]))
+
+        # Ids other than integers turn the store into a list, which lets go of the ids
+        # of removed points.
+        a.insert((1,1),id='one')
+        a.remove((5,5))
+
+        self.assertEqual(a.ids,[None,1,23,82,'one'])
+        self.assertEqual(a.find_nearest((0,0),with_ids=True),((1,1),'one'))
+        self.assertEqual(a.to_arrays(),([1,23,82,'one'],array.array('d',[2,3,2,3,8,2,1,1])))
+
+        b = KDTree.from_points([(x,x % 3) for x in range(0,20)],ids=['p%d' % x for x in range(0,20)])
+
+        self.assertEqual(b.find_exact((7,1),with_ids=True),((7,1),'p7'))
+        self.assertEqual(KDTree.from_points([(1,2),(3,4)]).to_arrays()[0],array.array('l',[0,1]))
+        self.assertEqual(KDTree(2).to_arrays(),(array.array('l'),array.array('d')))
+
+        c = KDTree(2)
+        c.insert((1,1),id=2 ** 70)
+
+        self.assertEqual(c.find_exact((1,1),with_ids=True),((1,1),2 ** 70))
+
+        self.assertRaises(AssertionError,KDTree.from_points,[(1,2),(3,4)],ids=[1])
+
+    def test_split(self):
+        'Choose split axes by policy, in bulk and incrementally.'
+
+        # The points spread a hundred times wider along the second and fourth axes.
+        points = [(x * 7 % 13 * 0.01,x * 5 % 11,x % 3 * 0.01,x * 3 % 17) for x in range(0,300)]
+        queries = [(x * 0.37 % 13 * 0.01,x * 0.91 % 11,x * 0.13 % 3 * 0.01,x * 0.71 % 17) for x in range(0,50)]
+        visits = {}
+
+        for split in KDTree.splits:
+            for leaf_size in [1,4]:
+                a = KDTree.from_points(points,leaf_size=leaf_size,split=split)
+                b = KDTree(4,leaf_size=leaf_size,split=split)
+
+                for point in points:
+                    b.insert(point)
+
+                self.assertEqual(a.split,split)
+                self.assertEqual(b.split,split)
+                self.assertEqual(a.root.disc,0 if split == 'cycle' else 3)
+
+                for c in [a,b]:
+                    stats = KDTree.QueryStats()
+
+                    for query in queries:
+                        distances = sorted(Euclidean().distance(p,query,float("inf")) for p in points)
+
+                        self.assertEqual(Euclidean().distance(c.find_nearest(query,stats=stats),query,float("inf")),
+                                         distances[0])
+
+                    for point in points[::7]:
+                        self.assertEqual(c.find_exact(point),point)
+
+                    self.assertEqual(sorted(c.find_with_mask((0,3,0,0),(False,True,False,False))),
+                                     sorted(p for p in points if p[1] == 3))
+
+                    visits[(split,leaf_size,c is a)] = stats.nodes_visited
+
+                if split != 'cycle':
+                    self.assertTrue(set(node.disc for node in KDTree._entries(a.root) if node.size >= 20) <= set([1,3]))
+
+        for split in KDTree.splits[1:]:
+            for leaf_size in [1,4]:
+                for bulk in [True,False]:
+                    self.assertTrue(visits[(split,leaf_size,bulk)] < visits[('cycle',leaf_size,bulk)])
+
+        # Sliding midpoint splits away from the median on skewed data, but stays within
+        # the balance the rebuilds keep.
+        skewed = [(x * x,x % 5) for x in range(0,200)]
+        c = KDTree.from_points(skewed,split='sliding_midpoint')
+
+        self.assertTrue(KDTree._node_size(c.root.left) > 100)
+        self.assertTrue(KDTree._node_size(c.root.left) <= KDTree.alpha * 200)
+
+        d = StreamingKDTree(4,buffer_size=8,split='max_spread')
+
+        for point in points:
+            d.insert(point)
+
+        self.assertTrue(all(level.root.disc == 3 for level in d.state[1] if level != None and len(level) > 100))
+
+        self.assertRaises(AssertionError,KDTree,2,1,None,'round_robin')
+        self.assertRaises(AssertionError,KDTree.from_points,points,split='median')
+        self.assertRaises(AssertionError,StreamingKDTree,2,split='median')
+
+    def test_cache(self):
+        'Answer repeated queries from the cache, kept exact across writes.'
+
+        points = [(x * 7 % 13,x * 5 % 11) for x in range(0,150)]
+        queries = [(x * 0.37 % 13,x * 0.91 % 11) for x in range(0,20)]
+        masks = [((x % 13,0),(True,False)) for x in range(0,5)] + [((3,x % 11),(False,True)) for x in range(0,5)]
+        a = KDTree.from_points(points,leaf_size=2).enable_cache(100)
+        b = KDTree.from_points(points,leaf_size=2)
+
+        def check():
+            for query in queries:
+                self.assertEqual(a.find_nearest(query),b.find_nearest(query))
+                self.assertEqual(a.find_nearest(query,with_ids=True),b.find_nearest(query,with_ids=True))
+                self.assertEqual(a.find_k_nearest(query,4),b.find_k_nearest(query,4))
+            for (point,mask) in masks:
+                self.assertEqual(a.find_with_mask(point,mask),b.find_with_mask(point,mask))
+
+        check()
+
+        self.assertEqual((a.cache.hits,a.cache.misses,len(a.cache)),(0,70,70))
+
+        check()
+
+        self.assertEqual((a.cache.hits,a.cache.misses),(70,70))
+
+        for (x,point) in enumerate(points[:40]):
+            a.remove(point)
+            b.remove(point)
+            a.insert((x * 0.3,x * 0.2),id=x)
+            b.insert((x * 0.3,x * 0.2),id=x)
+            check()
+
+        self.assertTrue(a.cache.hits > 70 + 40 * 35)
+
+        # A write far from every cached query leaves their results cached.
+        entries = len(a.cache)
+        a.insert((1000,1000))
+
+        self.assertEqual(len(a.cache),entries)
+
+        # Uncacheable calls leave the cache alone, and results handed out can be changed
+        # freely.
+        stats = KDTree.QueryStats()
+        a.find_nearest(queries[0],stats=stats)
+
+        self.assertEqual(stats.nodes_visited,0)
+        self.assertEqual(a.find_nearest(queries[0],count_nodes=True)[0],b.find_nearest(queries[0]))
+        self.assertEqual(a.find_nearest(queries[0],metric=Manhattan()),b.find_nearest(queries[0],metric=Manhattan()))
+
+        a.find_k_nearest(queries[0],4).append('junk')
+
+        self.assertEqual(len(a.find_k_nearest(queries[0],4)),4)
+
+        c = KDTree(2).enable_cache(2)
+
+        self.assertEqual(c.find_nearest((1,1)),None)
+        c.insert((5,5))
+        self.assertEqual(c.find_nearest((1,1)),(5,5))
+        self.assertEqual(c.find_k_nearest((1,1),3),[(5,5)])
+        c.insert((50,50))
+        self.assertEqual(c.find_k_nearest((1,1),3),[(5,5),(50,50)])
+
+        self.assertEqual(c.disable_cache().cache,None)
+
+        self.assertRaises(AssertionError,KDTree.enable_cache,c,0)
+        self.assertRaises(AssertionError,KDTree.enable_cache,c,'big')
+
+    def test_metric(self):
+        'Queries under other metrics.'
+
+        points = [(x * 7 % 13,x * 5 % 11 * 0.5,x % 3) for x in range(0,200)]
+        metrics = [Manhattan(),Chebyshev(),WeightedEuclidean((1,4,0.25)),Minkowski(3)]
+
+        for leaf_size in [1,4]:
+            for metric in metrics:
+                a = KDTree.from_points(points,leaf_size=leaf_size,metric=metric)
+                b = KDTree.from_points(points,leaf_size=leaf_size)
+
+                for query in [(0,0,0),(6.5,5.2,1.1),(12,-3,4),(3.3,2.1,0.4)]:
+                    distances = sorted(metric.expand(metric.distance(p,query,float("inf"))) for p in points)
+                    within = [p for p in points if metric.expand(metric.distance(p,query,float("inf"))) <= 3]
+
+                    self.assertAlmostEqual(metric.expand(metric.distance(a.find_nearest(query),query,float("inf"))),
+                                           distances[0])
+                    self.assertEqual([metric.expand(metric.distance(p,query,float("inf"))) for p in a.find_k_nearest(query,10)],
+                                     distances[:10])
+                    self.assertEqual(sorted(a.find_within_radius(query,3)),sorted(within))
+                    self.assertEqual([metric.distance(p,query,float("inf")) for p in b.find_k_nearest(query,10,metric=metric)],
+                                     [metric.distance(p,query,float("inf")) for p in a.find_k_nearest(query,10)])
+                    self.assertEqual(sorted(b.find_within_radius(query,3,metric=metric)),sorted(within))
+
+                (indices,distances) = a.find_nearest_batch([(0,0,0),(6.5,5.2,1.1)])
+
+                self.assertEqual([points[i] for i in indices],[a.find_nearest((0,0,0)),a.find_nearest((6.5,5.2,1.1))])
+                self.assertEqual(distances,[metric.expand(metric.distance(points[i],q,float("inf")))
+                                            for (i,q) in zip(indices,[(0,0,0),(6.5,5.2,1.1)])])
+
+        self.assertEqual(KDTree(2,metric=Manhattan()).find_nearest((1,2)),None)
+        self.assertEqual(KDTree.from_points([(1,1),(1.5,0),(5,5)]).find_nearest((0,0)),(1,1))
+        self.assertEqual(KDTree.from_points([(1,1),(1.5,0),(5,5)],metric=Manhattan()).find_nearest((0,0)),(1.5,0))
+        self.assertEqual(KDTree.from_points([(1,1),(1.5,0),(5,5)],metric=Chebyshev()).find_nearest((0,0)),(1,1))
+        self.assertEqual(KDTree.from_points([(1,1),(1.5,0),(5,5)]).find_nearest((0,0),metric=WeightedEuclidean((1,4))),(1.5,0))
+
+        self.assertRaises(AssertionError,KDTree,2,1,'metric')
+        self.assertRaises(AssertionError,KDTree,3,1,WeightedEuclidean((1,2)))
+        self.assertRaises(AssertionError,KDTree.find_nearest,KDTree(2),(1,2),False,False,None,Minkowski)
+        self.assertRaises(AssertionError,KDTree.find_k_nearest,KDTree(2),(1,2),1,None,WeightedEuclidean((1,2,3)))
+
+    def test_find_nearest_batch(self):
+        'Find nearest matches for a batch of queries.'
+
+        points = [(x * 7 % 13,x * 5 % 11,x % 3) for x in range(0,200)]
+        queries = [(x * 0.37 % 13,x * 0.91 % 11,x * 0.13 % 3) for x in range(0,150)]
+
+        a = KDTree(3)
+
+        for point in points:
+            a.insert(point)
+
+        for tree in [a,KDTree.from_points(points)]:
+            (indices,distances) = tree.find_nearest_batch(queries)
+
+            self.assertEqual(len(indices),150)
+            self.assertEqual(len(distances),150)
+
+            for (query,index,distance) in zip(queries,indices,distances):
+                expected = KDTree._node_point_distance(KDTree.KDNode(tree.find_nearest(query),0),query)
+
+                self.assertEqual(distance,expected)
+                self.assertEqual(KDTree._node_point_distance(KDTree.KDNode(points[index],0),query),expected)
+
+        # On a grid most queries are tied between several points, and the seeded searches
+        # of the batch still pick the same one as "find_nearest".
+        grid = [(x,y) for x in range(0,16) for y in range(0,16)]
+        halves = [(x * 0.5,y * 0.5) for x in range(-1,32) for y in range(-1,32)]
+
+        for tree in [KDTree.from_points(grid),KDTree.from_points(grid,leaf_size=4)]:
+            (indices,_) = tree.find_nearest_batch(halves)
+
+            self.assertEqual(indices,[tree.find_nearest(query,with_ids=True)[1] for query in halves])
+
+        # The queries share their descent, so the batch visits fewer nodes than the
+        # same searches one at a time.
+        for leaf_size in [1,4]:
+            b = KDTree.from_points(points,leaf_size=leaf_size)
+            (batch,loop) = (KDTree.QueryStats(),KDTree.QueryStats())
+
+            (_,distances) = b.find_nearest_batch(queries,stats=batch)
+
+            for query in queries:
+                b.find_nearest(query,stats=loop)
+
+            self.assertEqual(distances,[KDTree._node_point_distance(KDTree.KDNode(b.find_nearest(q),0),q) for q in queries])
+            self.assertTrue(batch.nodes_visited < 0.8 * loop.nodes_visited)
+
+        # Too small a tree, or too few queries for its size, and the batch is answered
+        # by the same searches one at a time.
+        for (tree,batched) in [(KDTree.from_points(grid[:100]),halves),(KDTree.from_points(points),queries[:10])]:
+            (batch,loop) = (KDTree.QueryStats(),KDTree.QueryStats())
+
+            (indices,_) = tree.find_nearest_batch(batched,stats=batch)
+
+            self.assertEqual(indices,[tree.find_nearest(query,stats=loop,with_ids=True)[1] for query in batched])
+            self.assertEqual(batch.nodes_visited,loop.nodes_visited)
+
+        self.assertEqual(a.find_nearest_batch([]),([],[]))
+        self.assertEqual(KDTree(2).find_nearest_batch([(1,2)]),([None],[float("inf")]))
+        self.assertEqual(a.find_nearest_batch([[7,5,1]]),([points.index((7,5,1))],[0]))
 
-    def test_find_nearest(self):
-        'Find nearest match.'
+        self.assertRaises(AssertionError,KDTree.find_nearest_batch,a,[(1,2)])
+
+    def test_stats(self):
+        'Per-call query statistics.'
 
         a = KDTree(2)
 
@@ -187,16 +1320,208 @@ class KDTreeTest(unittest.TestCase):
         a.insert((9,2))
         a.insert((4.95,0.25))
 
-        self.assertEqual(a.find_nearest((7.5,2.5)),(8,2))
-        self.assertEqual(a.find_nearest((7.5,1.5)),(8,1))
-        self.assertEqual(a.find_nearest((5.01,0.22)),(4.95,0.25))
-        self.assertEqual(a.find_nearest((3,6)),(3,6))
-        self.assertEqual(a.find_nearest((5,5)),(5,5))
-        self.assertEqual(a.find_nearest((8,3)),(8,4))
+        stats = KDTree.QueryStats()
 
-        self.assertRaises(AssertionError,KDTree.find_nearest,a,'hello')
-        self.assertRaises(AssertionError,KDTree.find_nearest,a,(1,2,3))
-        self.assertRaises(AssertionError,KDTree.find_nearest,a,(1,2),'yello')
+        self.assertEqual(a.find_nearest((3,6),stats=stats),(3,6))
+        self.assertEqual(stats.nodes_visited,4)
+        self.assertEqual(stats.distance_evaluations,0)
+        self.assertEqual(a.find_nearest((3,6),count_nodes=True),((3,6),4))
+
+        stats = KDTree.QueryStats()
+
+        self.assertEqual(a.find_nearest((7.6,1.4),stats=stats),(8,1))
+        self.assertTrue(stats.nodes_visited > 0)
+        self.assertTrue(stats.distance_evaluations > 0)
+        self.assertTrue(stats.subtrees_pruned > 0)
+
+        stats = KDTree.QueryStats()
+
+        self.assertEqual(a.find_exact((9,2),stats=stats),(9,2))
+        self.assertEqual(stats.nodes_visited,4)
+
+        stats = KDTree.QueryStats()
+
+        a.find_with_mask((8,-1),(True,False),stats=stats)
+        a.find_k_nearest((8,2),3,stats=stats)
+        a.find_within_radius((8,2),1,stats=stats)
+        a.find_nearest_batch([(1,1),(8,2)],stats=stats)
+
+        self.assertTrue(stats.nodes_visited > 0)
+        self.assertTrue(stats.distance_evaluations > 0)
+        self.assertTrue(stats.subtrees_pruned > 0)
+
+        self.assertRaises(AssertionError,KDTree.find_nearest,a,(1,2),stats='stats')
+        self.assertRaises(AssertionError,KDTree.find_exact,a,(1,2),stats=3)
+
+    def test_shape(self):
+        'Tree shape.'
+
+        a = KDTree(2)
+        shape = a.shape()
+
+        self.assertEqual((shape.nodes,shape.entries,shape.depth,shape.histogram,shape.balance),(0,0,0,[],0.0))
+
+        for point in [(5,5),(2,3),(2,4),(3,6),(8,2),(6,7),(8,4),(8,1),(6,2),(9,2),(4.95,0.25)]:
+            a.insert(point)
+
+        shape = a.shape()
+
+        self.assertEqual((shape.nodes,shape.entries,shape.depth,shape.histogram),(11,11,4,[1,2,4,4]))
+        self.assertEqual(shape.balance,1.0)
+        self.assertTrue(shape.memory > 11 * 100)
+        self.assertTrue(repr(shape).startswith('KDTree.TreeShape(nodes=11,entries=11,depth=4,histogram=[1, 2, 4, 4],balance=1.0,'))
+
+        b = KDTree.from_points([(x,y) for x in range(0,32) for y in range(0,32)],leaf_size=8)
+        shape = b.shape()
+
+        self.assertEqual(shape.entries,1024)
+        self.assertEqual(sum(shape.histogram),shape.nodes)
+        self.assertTrue(shape.nodes < 1024)
+        self.assertTrue(shape.balance <= 1.2)
+
+        c = KDTree(2)
+
+        for i in range(0,200):
+            c.root = KDTree.KDNode((i,i),0) if c.root == None else c.root
+            node = c.root
+
+            while node.right != None:
+                node = node.right
+
+            if i > 0:
+                node.right = KDTree.KDNode((i,i),0)
+
+        self.assertEqual(c.shape().depth,200)
+        self.assertEqual(c.shape().histogram,[1] * 200)
+        self.assertTrue(c.shape().balance > 20)
+        self.assertTrue(c.shape().memory > b.shape().memory / 10)
+
+    def test_hooks(self):
+        'Per-query hooks.'
+
+        a = KDTree(2)
+
+        for point in [(5,5),(2,3),(2,4),(3,6),(8,2),(6,7),(8,4),(8,1),(6,2),(9,2),(4.95,0.25)]:
+            a.insert(point)
+
+        calls = []
+        hook = lambda name,stats,seconds: calls.append((name,stats,seconds))
+
+        self.assertFalse('find_nearest' in vars(a))
+        self.assertEqual(a.add_hook(hook),a)
+        self.assertTrue('find_nearest' in vars(a))
+
+        self.assertEqual(a.find_nearest((7.6,1.4)),(8,1))
+        self.assertEqual(a.find_exact((9,2)),(9,2))
+        self.assertEqual(sorted(a.find_with_mask((8,-1),(True,False))),[(8,1),(8,2),(8,4)])
+        self.assertEqual(a.find_k_nearest((8,2),1),[(8,2)])
+        self.assertEqual(a.find_within_radius((8,2),0),[(8,2)])
+        self.assertEqual(a.count_in_range((0,0),(10,10)),11)
+        self.assertEqual(a.find_in_range((9,2),(9,2)),[(9,2)])
+        self.assertEqual(a.find_nearest_batch([(1,1)])[0],[1])
+        self.assertEqual([name for (name,_,_) in calls],['find_nearest','find_exact','find_with_mask','find_k_nearest',
+                                                         'find_within_radius','count_in_range','find_in_range',
+                                                         'find_nearest_batch'])
+        self.assertTrue(all(seconds >= 0 for (_,_,seconds) in calls))
+        self.assertEqual(calls[1][1].nodes_visited,4)
+        self.assertEqual(calls[2][1].plan,'tree')
+        self.assertTrue(calls[0][1].distance_evaluations > 0)
+        self.assertTrue(calls[0][1].subtrees_pruned > 0)
+
+        # Statistics passed in by the caller still add up, one call at a time.
+        stats = KDTree.QueryStats()
+
+        a.find_exact((9,2),stats)
+        a.find_exact((9,2),stats=stats)
+
+        self.assertEqual(stats.nodes_visited,8)
+        self.assertEqual(calls[-1][1].nodes_visited,4)
+        self.assertEqual(a.find_nearest((3,6),count_nodes=True),((3,6),4))
+
+        others = []
+        other = lambda name,stats,seconds: others.append(name)
+
+        a.add_hook(other)
+        a.find_exact((9,2))
+        a.remove_hook(hook)
+        a.find_exact((9,2))
+
+        self.assertEqual(others,['find_exact','find_exact'])
+        self.assertEqual(len(calls),12)
+        self.assertEqual(a.remove_hook(other),a)
+        self.assertFalse('find_nearest' in vars(a))
+
+        a.find_exact((9,2))
+
+        self.assertEqual(len(others),2)
+
+        self.assertRaises(AssertionError,KDTree.add_hook,a,'hook')
+        self.assertRaises(ValueError,KDTree.remove_hook,a,hook)
+
+    def test_concurrent_readers(self):
+        'Many reader threads alongside a single writer.'
+
+        points = [(x * 7 % 101,x * 5 % 103,x % 7) for x in range(0,500)]
+        queries = [(x * 0.37 % 101,x * 0.91 % 103,x * 0.13 % 7) for x in range(0,50)]
+
+        for leaf_size in [1,4]:
+            a = KDTree.from_points(points,leaf_size=leaf_size)
+            expected = [a.find_nearest(query) for query in queries]
+            errors = []
+
+            def read():
+                try:
+                    for _ in range(0,5):
+                        for (query,nearest) in zip(queries,expected):
+                            found = a.find_nearest(query)
+
+                            # Writes only add points far away and then remove them
+                            # again, so stable points always stay reachable.
+                            if found != nearest or a.find_exact(nearest) != nearest:
+                                errors.append((query,found))
+                except Exception as e:
+                    errors.append(e)
+
+            def write():
+                try:
+                    for i in range(0,300):
+                        a.insert((1000 + i,1000 + i,1000 + i))
+                    for i in range(0,300):
+                        a.remove((1000 + i,1000 + i,1000 + i))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=read) for _ in range(0,4)] + [threading.Thread(target=write)]
+
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors,[])
+            self.assertEqual(len(a),500)
+
+            serial = []
+
+            for query in queries:
+                stats = KDTree.QueryStats()
+                a.find_nearest(query,stats=stats)
+                serial.append(stats.nodes_visited)
+
+            stats = [None] * len(queries)
+
+            def count(i):
+                stats[i] = KDTree.QueryStats()
+                a.find_nearest(queries[i],stats=stats[i])
+
+            threads = [threading.Thread(target=count,args=(i,)) for i in range(0,len(queries))]
+
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual([s.nodes_visited for s in stats],serial)
 
     def test_iris(self):
         'A test with the IRIS dataset.'
@@ -419,3 +1744,542 @@ class KDTreeTest(unittest.TestCase):
                 self.assertEqual(fnd,found[i])
 
         # print sum(counts)
+
+class FlatKDTreeTest(unittest.TestCase):
+    'Test harness for "FlatKDTree".'
+
+    def make_tree(self):
+        a = KDTree(2)
+
+        a.insert((5,5))
+        a.insert((2,3))
+        a.insert((2,4))
+        a.insert((3,6))
+        a.insert((8,2))
+        a.insert((6,7))
+        a.insert((8,4))
+        a.insert((8,1))
+        a.insert((6,2))
+        a.insert((9,2))
+        a.insert((4.95,0.25))
+
+        return a
+
+    def test_ctor(self):
+        'Constructor.'
+
+        a = FlatKDTree(3)
+
+        self.assertEqual(a.size,3)
+        self.assertEqual(len(a),0)
+        self.assertEqual(a.find_exact((1,2,3)),None)
+        self.assertEqual(a.find_nearest((1,2,3)),None)
+        self.assertEqual(a.find_with_mask((1,2,3),(True,False,False)),[])
+
+        self.assertEqual(repr(a.metric),'Euclidean()')
+        self.assertEqual(repr(FlatKDTree(2,Chebyshev()).metric),'Chebyshev()')
+
+        self.assertRaises(AssertionError,FlatKDTree,'t')
+        self.assertRaises(AssertionError,FlatKDTree,0)
+        self.assertRaises(AssertionError,FlatKDTree,2,'metric')
+        self.assertRaises(AssertionError,FlatKDTree,2,WeightedEuclidean((1,2,3)))
+
+    def test_from_tree(self):
+        'Flattening a linked tree.'
+
+        a = self.make_tree()
+        b = a.flatten()
+
+        self.assertEqual(len(b),11)
+        self.assertEqual(list(b.indices),[0,1,10,2,3,4,7,8,9,5,6])
+        self.assertEqual(b.point(0),(5,5))
+        self.assertEqual(b.point(b.lefts[0]),(2,3))
+        self.assertEqual(b.point(b.rights[0]),(8,2))
+        self.assertEqual(b.discs[b.rights[0]],1)
+        self.assertEqual(b.point(b.lefts[b.rights[0]]),(8,1))
+        self.assertEqual(b.point(b.rights[b.lefts[b.rights[0]]]),(9,2))
+
+        c = KDTree.from_points([(2,2),(0,2.5),(9,9)],metric=Chebyshev(),ids=[20,25,99])
+        d = c.flatten()
+
+        self.assertEqual(repr(d.metric),'Chebyshev()')
+        self.assertEqual(c.find_nearest((0,0)),(2,2))
+        self.assertEqual(d.find_nearest((0,0)),(2.0,2.0))
+        self.assertEqual(d.find_nearest_batch([(0,0)]),c.find_nearest_batch([(0,0)]))
+
+        self.assertEqual(list(d.ids),[c.ids[i] for i in d.indices])
+        self.assertEqual(d.find_exact((0,2.5),with_ids=True),((0.0,2.5),25))
+        self.assertEqual(d.find_with_mask((9,0),(True,False),with_ids=True),[((9.0,9.0),99)])
+        self.assertEqual(d.find_nearest((0,0),with_ids=True),((2.0,2.0),20))
+        self.assertEqual(d.find_nearest_batch([(0,0),(8,8)],with_ids=True),([20,99],[2.0,1.0]))
+
+        e = KDTree.from_points([(1,2),(3,4)],ids=['a','b'])
+
+        self.assertRaises(AssertionError,KDTree.flatten,e)
+
+    def test_insert(self):
+        'Insertion.'
+
+        a = self.make_tree().flatten()
+        b = FlatKDTree(2)
+
+        for point in [(5,5),(2,3),(2,4),(3,6),(8,2),(6,7),(8,4),(8,1),(6,2),(9,2),(4.95,0.25)]:
+            b.insert(point)
+
+        self.assertEqual(sorted(b.coords),sorted(a.coords))
+
+        for i in range(0,len(a)):
+            j = [b.point(k) for k in range(0,len(b))].index(a.point(i))
+
+            self.assertEqual(a.discs[i],b.discs[j])
+
+        self.assertEqual(list(b.ids),list(range(0,11)))
+
+        b.insert((7,7),id=77)
+
+        self.assertEqual(b.find_exact((7,7),with_ids=True),((7.0,7.0),77))
+
+        # Removed points leave gaps in the insertion indices, and new points go past
+        # the largest one in use, also in columns not built by "from_tree".
+        c = KDTree(2)
+
+        for i in range(0,10):
+            c.insert((float(i),0.0))
+
+        c.remove((3.0,0.0))
+        c.remove((5.0,0.0))
+
+        for d in [c.flatten(),FlatKDTree.from_columns(2,*[getattr(c.flatten(),name) for (name,_) in FlatKDTree.columns])]:
+            d.insert((100.0,0.0))
+            d.insert((-1.0,0.0),id=5000)
+
+            self.assertEqual(sorted(d.indices),[0,1,2,4,6,7,8,9,10,11])
+            self.assertEqual(sorted(d.ids),[0,1,2,4,6,7,8,9,10,5000])
+            self.assertEqual(d.find_exact((100.0,0.0),with_ids=True),((100.0,0.0),10))
+            self.assertEqual(d.find_exact((8.0,0.0),with_ids=True),((8.0,0.0),8))
+
+        self.assertRaises(AssertionError,FlatKDTree.insert,b,'hello')
+        self.assertRaises(AssertionError,FlatKDTree.insert,b,(1,2,3))
+        self.assertRaises(AssertionError,FlatKDTree.insert,b,(1,2),'id')
+
+    def test_find_exact(self):
+        'Find exact match.'
+
+        a = self.make_tree().flatten()
+
+        self.assertEqual(a.find_exact((5,5)),(5,5))
+        self.assertEqual(a.find_exact((2,3)),(2,3))
+        self.assertEqual(a.find_exact((4.95,0.25)),(4.95,0.25))
+        self.assertEqual(a.find_exact((5,8)),None)
+
+        # Points equal to a splitting point along its axis may sit on either side.
+        b = FlatKDTree.from_points([(x % 3,x % 4) for x in range(0,60)])
+
+        for x in range(0,12):
+            self.assertEqual(b.find_exact((x % 3,x % 4)),(x % 3,x % 4))
+
+        self.assertRaises(AssertionError,FlatKDTree.find_exact,a,'hello')
+        self.assertRaises(AssertionError,FlatKDTree.find_exact,a,(1,2,3))
+
+    def test_find_with_mask(self):
+        'Find masked match.'
+
+        a = self.make_tree().flatten()
+
+        self.assertEqual(a.find_with_mask((8,-1),(True,False)),[(8,2),(8,4),(8,1)])
+        self.assertEqual(a.find_with_mask((6,-1),(True,False)),[(6,7),(6,2)])
+        self.assertEqual(a.find_with_mask((8,1),(True,True)),[(8,1)])
+        self.assertEqual(a.find_with_mask((1,2),(True,True)),[])
+
+        self.assertRaises(AssertionError,FlatKDTree.find_with_mask,a,(1,2),'j')
+        self.assertRaises(AssertionError,FlatKDTree.find_with_mask,a,(1,2,3),(True,False))
+        self.assertRaises(AssertionError,FlatKDTree.find_with_mask,a,(1,2),(True,True,'true'))
+
+    def test_find_nearest(self):
+        'Find nearest match.'
+
+        a = self.make_tree().flatten()
+
+        self.assertEqual(a.find_nearest((7.5,2.5)),(8,2))
+        self.assertEqual(a.find_nearest((7.6,1.4)),(8,1))
+        self.assertEqual(a.find_nearest((5.01,0.22)),(4.95,0.25))
+        self.assertEqual(a.find_nearest((3,6)),(3,6))
+        self.assertEqual(a.find_nearest((8,3.1)),(8,4))
+        self.assertEqual(a.find_nearest((3,6),count_nodes=True),((3,6),4))
+
+        points = [(x * 7 % 13,x * 5 % 11,x % 3) for x in range(0,200)]
+        b = KDTree.from_points(points)
+        c = FlatKDTree.from_points(points)
+
+        for query in [(0,0,0),(6.5,5.2,1.1),(12,-3,4),(3.3,3.3,3.3)]:
+            self.assertEqual(KDTree._node_point_distance(KDTree.KDNode(c.find_nearest(query),0),query),
+                             KDTree._node_point_distance(KDTree.KDNode(b.find_nearest(query),0),query))
+
+        self.assertRaises(AssertionError,FlatKDTree.find_nearest,a,'hello')
+        self.assertRaises(AssertionError,FlatKDTree.find_nearest,a,(1,2,3))
+        self.assertRaises(AssertionError,FlatKDTree.find_nearest,a,(1,2),'yello')
+
+    def test_save_open(self):
+        'Saving to and opening from a file.'
+
+        directory = tempfile.mkdtemp()
+
+        try:
+            path = os.path.join(directory,'tree.skdt')
+            points = [(x * 7 % 13,x * 5 % 11,x % 3) for x in range(0,200)]
+            queries = [(0,0,0),(6.5,5.2,1.1),(12,-3,4),(3.3,3.3,3.3)]
+
+            a = KDTree.from_points(points,ids=[1000 + x for x in range(0,200)])
+            a.save(path)
+
+            for mmap in [True,False]:
+                b = KDTree.open(path,mmap=mmap)
+
+                self.assertTrue(isinstance(b,FlatKDTree))
+                self.assertEqual(b.size,3)
+                self.assertEqual(len(b),200)
+                self.assertEqual(isinstance(b.coords,array.array),not mmap)
+
+                if mmap:
+                    self.assertRaises(TypeError,FlatKDTree.insert,b,(1,2,3))
+                self.assertEqual(list(b.indices),list(a.flatten().indices))
+                self.assertEqual(list(b.ids),list(a.flatten().ids))
+                self.assertEqual(b.find_nearest_batch(queries,with_ids=True),a.flatten().find_nearest_batch(queries,with_ids=True))
+
+                for point in points[:20]:
+                    self.assertEqual(b.find_exact(point),point)
+
+                self.assertEqual(b.find_exact((1,1,1)),None)
+                self.assertEqual([b.find_nearest(query) for query in queries],
+                                 [a.flatten().find_nearest(query) for query in queries])
+                self.assertEqual(b.find_nearest_batch(queries),a.flatten().find_nearest_batch(queries))
+                self.assertEqual(sorted(b.find_with_mask((0,-1,-1),(True,False,False))),
+                                 sorted(p for p in points if p[0] == 0))
+
+                with ParallelKDTree(b,workers=1) as c:
+                    self.assertEqual(c.find_nearest_batch(queries),b.find_nearest_batch(queries))
+                    self.assertEqual(c.find_nearest_batch(queries,with_ids=True),b.find_nearest_batch(queries,with_ids=True))
+
+            for metric in [Manhattan(),Chebyshev(),WeightedEuclidean((1,4,9)),Minkowski(3)]:
+                a = KDTree.from_points(points,metric=metric)
+                a.save(path)
+
+                for mmap in [True,False]:
+                    b = KDTree.open(path,mmap=mmap)
+
+                    self.assertEqual(type(b.metric),type(metric))
+                    self.assertEqual(b.find_nearest_batch(queries),a.flatten().find_nearest_batch(queries))
+                    self.assertEqual(b.find_nearest_batch(queries)[1],a.find_nearest_batch(queries)[1])
+
+            a = KDTree.from_points(points,metric=type('Custom',(Euclidean,),{})())
+
+            self.assertRaises(AssertionError,KDTree.save,a,path)
+
+            KDTree(4).save(path)
+
+            self.assertEqual(len(KDTree.open(path)),0)
+            self.assertEqual(KDTree.open(path).size,4)
+            self.assertEqual(KDTree.open(path,mmap=False).find_nearest((1,2,3,4)),None)
+
+            with open(path,'wb') as f:
+                f.write(b'hello world')
+
+            self.assertRaises(ValueError,KDTree.open,path)
+
+            with open(path,'wb') as f:
+                f.write(FlatKDTree.file_header.pack(FlatKDTree.file_magic,FlatKDTree.file_version,2,10,0,0))
+
+            self.assertRaises(ValueError,KDTree.open,path)
+
+            with open(path,'wb') as f:
+                f.write(FlatKDTree.file_header.pack(FlatKDTree.file_magic,FlatKDTree.file_version,2,0,99,0))
+
+            self.assertRaises(ValueError,KDTree.open,path)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_find_nearest_batch(self):
+        'Find nearest matches for a batch of queries.'
+
+        points = [(x * 7 % 13,x * 5 % 11,x % 3) for x in range(0,200)]
+        queries = [(x * 0.37 % 13,x * 0.91 % 11,x * 0.13 % 3) for x in range(0,150)]
+
+        a = KDTree.from_points(points)
+        b = a.flatten()
+
+        (indices,distances) = b.find_nearest_batch(queries)
+
+        self.assertEqual(distances,a.find_nearest_batch(queries)[1])
+
+        for (query,index,distance) in zip(queries,indices,distances):
+            self.assertEqual(KDTree._node_point_distance(KDTree.KDNode(points[index],0),query),distance)
+
+        grid = KDTree.from_points([(x,y) for x in range(0,16) for y in range(0,16)])
+        halves = [(x * 0.5,y * 0.5) for x in range(-1,32) for y in range(-1,32)]
+
+        self.assertEqual(grid.flatten().find_nearest_batch(halves),grid.find_nearest_batch(halves))
+        self.assertEqual(grid.flatten().find_nearest_batch(halves[:10]),grid.find_nearest_batch(halves[:10]))
+
+        self.assertEqual(FlatKDTree(2).find_nearest_batch([(1,2)]),([None],[float("inf")]))
+
+        self.assertRaises(AssertionError,FlatKDTree.find_nearest_batch,b,[(1,2)])
+
+class ParallelKDTreeTest(unittest.TestCase):
+    'Test harness for "ParallelKDTree".'
+
+    def test_find_nearest_batch(self):
+        'Find nearest matches for a batch of queries in worker processes.'
+
+        points = [(x * 7 % 13,x * 5 % 11,x % 3) for x in range(0,200)]
+        queries = [(x * 0.37 % 13,x * 0.91 % 11,x * 0.13 % 3) for x in range(0,150)]
+
+        a = KDTree.from_points(points)
+
+        with ParallelKDTree(a,workers=2) as b:
+            self.assertEqual(b.workers,2)
+            self.assertEqual(b.find_nearest_batch(queries),a.flatten().find_nearest_batch(queries))
+            self.assertEqual(b.find_nearest_batch(queries,chunk_size=7),a.flatten().find_nearest_batch(queries))
+            self.assertEqual(b.find_nearest_batch([]),([],[]))
+
+            self.assertRaises(AssertionError,ParallelKDTree.find_nearest_batch,b,[(1,2)])
+            self.assertRaises(AssertionError,ParallelKDTree.find_nearest_batch,b,queries,0)
+
+        self.assertEqual(b.pool,None)
+
+        with ParallelKDTree(KDTree(2),workers=1) as c:
+            self.assertEqual(c.find_nearest_batch([(1,2)]),([None],[float("inf")]))
+
+        d = KDTree.from_points([(2,2),(0,2.5),(9,9)],metric=Chebyshev(),ids=[20,25,99])
+
+        with ParallelKDTree(d,workers=1) as e:
+            self.assertEqual(repr(e.metric),'Chebyshev()')
+            self.assertEqual(e.find_nearest_batch([(0,0)]),([0],[2.0]))
+            self.assertEqual(e.find_nearest_batch([(0,0),(8,8)],with_ids=True),([20,99],[2.0,1.0]))
+
+        self.assertRaises(AssertionError,ParallelKDTree,'tree')
+        self.assertRaises(AssertionError,ParallelKDTree,a,0)
+
+class StreamingKDTreeTest(unittest.TestCase):
+    'Test harness for "StreamingKDTree".'
+
+    def test_ctor(self):
+        'Construct an empty streaming tree.'
+
+        a = StreamingKDTree(2)
+
+        self.assertEqual(a.size,2)
+        self.assertEqual(a.buffer_size,64)
+        self.assertEqual(a.leaf_size,1)
+        self.assertTrue(isinstance(a.metric,Euclidean))
+        self.assertEqual(a.count,0)
+        self.assertEqual(a.state,([],()))
+        self.assertEqual(len(a),0)
+
+        b = StreamingKDTree(3,buffer_size=4,leaf_size=2,metric=Manhattan())
+
+        self.assertEqual(b.buffer_size,4)
+        self.assertEqual(b.leaf_size,2)
+        self.assertTrue(isinstance(b.metric,Manhattan))
+
+        self.assertRaises(AssertionError,StreamingKDTree,'2')
+        self.assertRaises(AssertionError,StreamingKDTree,1)
+        self.assertRaises(AssertionError,StreamingKDTree,2,0)
+        self.assertRaises(AssertionError,StreamingKDTree,2,4,0)
+        self.assertRaises(AssertionError,StreamingKDTree,2,4,1,WeightedEuclidean((1,2,3)))
+
+    def test_insert(self):
+        'Insert points, merging full buffers into balanced levels of doubling size.'
+
+        a = StreamingKDTree(2,buffer_size=2)
+
+        for x in range(0,11):
+            a.insert((x,x * 3 % 7))
+
+        (buffer,levels) = a.state
+
+        self.assertEqual([entry.point for entry in buffer],[(10,2)])
+        self.assertEqual([len(level) if level != None else None for level in levels],[2,None,8])
+        self.assertEqual(len(a),11)
+        self.assertEqual(a.count,11)
+        self.assertEqual(sorted(entry.index for entry in KDTree._entries(levels[2].root)),list(range(0,8)))
+
+        # Points arriving in order still end up in balanced levels.
+        b = StreamingKDTree(2,buffer_size=4)
+
+        for x in range(0,4 * 15):
+            b.insert((x,x * 5 % 11))
+
+        self.assertEqual([len(level) for level in b.state[1]],[4,8,16,32])
+        self.assertEqual([level.shape().depth for level in b.state[1]],[3,4,5,6])
+
+        self.assertRaises(AssertionError,StreamingKDTree.insert,a,(1,2,3))
+        self.assertRaises(AssertionError,StreamingKDTree.insert,a,[1,2])
+
+    def test_remove(self):
+        'Remove points from the buffer and from the levels.'
+
+        a = StreamingKDTree(2,buffer_size=3)
+
+        for x in range(0,8):
+            a.insert((x,x))
+
+        self.assertTrue(a.remove((7,7)))
+        self.assertTrue(a.remove((1,1)))
+        self.assertFalse(a.remove((1,1)))
+        self.assertFalse(a.remove((9,9)))
+        self.assertEqual(len(a),6)
+        self.assertEqual(a.find_exact((1,1)),None)
+        self.assertEqual(a.find_exact((7,7)),None)
+        self.assertEqual(a.find_exact((6,6)),(6,6))
+
+        # Removed points are dropped when their level is merged.
+        for x in range(8,14):
+            a.insert((x,x))
+
+        self.assertEqual([level != None for level in a.state[1]],[False,False,True])
+        self.assertEqual(sorted(entry.point for entry in KDTree._entries(a.state[1][2].root)),
+                         [(x,x) for x in range(0,13) if x not in (1,7)])
+        self.assertEqual(len(a),12)
+
+    def test_ids(self):
+        'Label points with ids, kept by insertion index across merges.'
+
+        a = StreamingKDTree(2,buffer_size=2)
+
+        for x in range(0,7):
+            a.insert((x,x * 3 % 7),id=100 + x if x != 3 else None)
+
+        self.assertEqual(list(a.ids),[100,101,102,3,104,105,106])
+        self.assertEqual(a.find_exact((2,6),with_ids=True),((2,6),102))
+        self.assertEqual(a.find_exact((6,4),with_ids=True),((6,4),106))
+        self.assertEqual(a.find_exact((9,9),with_ids=True),None)
+        self.assertEqual(a.find_with_mask((3,0),(True,False),with_ids=True),[((3,2),3)])
+        self.assertEqual(sorted(a.find_in_range((0,0),(2,9),with_ids=True)),[((0,0),100),((1,3),101),((2,6),102)])
+        self.assertEqual(a.find_nearest((6,5),with_ids=True),((6,4),106))
+        self.assertEqual(a.find_k_nearest((0,1),2,with_ids=True),[((0,0),100),((1,3),101)])
+        self.assertEqual(a.find_within_radius((4,5),0,with_ids=True),[((4,5),104)])
+        self.assertEqual(a.to_arrays(),(array.array('l',[100,101,102,3,104,105,106]),
+                                        array.array('d',[0,0,1,3,2,6,3,2,4,5,5,1,6,4])))
+
+        a.insert((7,0),id='seven')
+        a.remove((7,0))
+        a.remove((1,3))
+
+        self.assertEqual(a.ids,[100,None,102,3,104,105,106,None])
+        self.assertEqual(a.to_arrays()[0],[100,102,3,104,105,106])
+        self.assertEqual(a.find_nearest((0,1),with_ids=True),((0,0),100))
+
+    def test_queries(self):
+        'Answer every kind of query as a single tree over the same points would.'
+
+        points = [(x * 7 % 13,x * 5 % 11) for x in range(0,100)]
+        queries = [(x * 0.37 % 13,x * 0.91 % 11) for x in range(0,30)] + [(6,5),(3,3),(7,2)]
+        a = StreamingKDTree(2,buffer_size=5,leaf_size=2)
+        b = KDTree.from_points(points)
+
+        for point in points:
+            a.insert(point)
+
+        for metric in [None,Manhattan(),Chebyshev()]:
+            distance = (metric if metric != None else Euclidean()).distance
+
+            for query in queries:
+                self.assertEqual(distance(a.find_nearest(query,metric=metric),query,float("inf")),
+                                 distance(b.find_nearest(query,metric=metric),query,float("inf")))
+                self.assertEqual(a.find_k_nearest(query,4,metric=metric),b.find_k_nearest(query,4,metric=metric))
+                self.assertEqual(a.find_within_radius(query,2.5,metric=metric),b.find_within_radius(query,2.5,metric=metric))
+
+        for point in [(3,6),(0,0),(12,10),(20,20)]:
+            self.assertEqual(a.find_exact(point),b.find_exact(point))
+            self.assertEqual(sorted(a.find_with_mask(point,(True,False))),sorted(b.find_with_mask(point,(True,False))))
+
+        for (lo,hi) in [((2,3),(6,8)),((0,0),(12,10)),((5,5),(4,4))]:
+            self.assertEqual(sorted(a.find_in_range(lo,hi)),sorted(b.find_in_range(lo,hi)))
+            self.assertEqual(a.count_in_range(lo,hi),b.count_in_range(lo,hi))
+
+        stats = KDTree.QueryStats()
+        a.find_nearest((3.5,3.5),stats=stats)
+
+        self.assertTrue(stats.distance_evaluations > 0)
+        self.assertTrue(stats.nodes_visited > 0)
+
+        c = StreamingKDTree(2)
+
+        self.assertEqual(c.find_nearest((1,2)),None)
+        self.assertEqual(c.find_k_nearest((1,2),3),[])
+        self.assertEqual(c.find_within_radius((1,2),3),[])
+        self.assertEqual(c.find_exact((1,2)),None)
+        self.assertEqual(c.count_in_range((0,0),(1,1)),0)
+
+        self.assertRaises(AssertionError,StreamingKDTree.find_nearest,a,(1,2,3))
+        self.assertRaises(AssertionError,StreamingKDTree.find_k_nearest,a,(1,2),0)
+        self.assertRaises(AssertionError,StreamingKDTree.find_within_radius,a,(1,2),-1)
+        self.assertRaises(AssertionError,StreamingKDTree.find_with_mask,a,(1,2),(True,))
+
+@unittest.skipIf(asyncio == None,'asyncio is not available')
+class AsyncKDTreeServiceTest(unittest.TestCase):
+    'Test harness for "AsyncKDTreeService".'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_ctor(self):
+        'Constructor.'
+
+        a = AsyncKDTreeService(KDTree(2),max_batch=8,linger=0.01)
+
+        self.assertEqual(a.max_batch,8)
+        self.assertEqual(a.linger,0.01)
+        self.assertEqual((a.batches,a.requests),(0,0))
+
+        self.assertRaises(AssertionError,AsyncKDTreeService,[(1,2)])
+        self.assertRaises(AssertionError,AsyncKDTreeService,KDTree(2),0)
+        self.assertRaises(AssertionError,AsyncKDTreeService,KDTree(2),8,-1)
+
+    def test_nearest(self):
+        'Answer concurrent requests in batches.'
+
+        points = [(x * 7 % 13,x * 5 % 11) for x in range(0,100)]
+        queries = [(x * 0.37 % 13,x * 0.91 % 11) for x in range(0,10)]
+        tree = KDTree.from_points(points,ids=['p%d' % x for x in range(0,100)])
+        a = AsyncKDTreeService(tree,max_batch=4,linger=0.01)
+
+        # Two full batches go at once, and the last two requests after the linger.
+        futures = [a.nearest(query) for query in queries]
+
+        self.assertEqual(a.batches,0)
+        self.assertEqual(len(a.pending),2)
+        self.assertEqual(self.loop.run_until_complete(asyncio.gather(*futures)),[tree.find_nearest(q) for q in queries])
+        self.assertEqual((a.batches,a.requests),(3,10))
+
+        found = self.loop.run_until_complete(a.nearest(queries[0],with_ids=True))
+
+        self.assertEqual(found,tree.find_nearest(queries[0],with_ids=True))
+        self.assertEqual((a.batches,a.requests),(4,11))
+
+        # Requests given up on are dropped.
+        futures = [a.nearest(query) for query in queries[:3]]
+        futures[1].cancel()
+
+        self.assertEqual(self.loop.run_until_complete(asyncio.gather(futures[0],futures[2])),
+                         [tree.find_nearest(queries[0]),tree.find_nearest(queries[2])])
+        self.assertEqual((a.batches,a.requests),(5,13))
+
+        # Queries tied between grid points get the same answer batched as on their own.
+        grid = KDTree.from_points([(x,y) for x in range(0,4) for y in range(0,4)])
+        halves = [(x * 0.5,y * 0.5) for x in range(-1,8) for y in range(-1,8)]
+        b = AsyncKDTreeService(grid,max_batch=len(halves))
+        futures = [b.nearest(query,with_ids=True) for query in halves]
+
+        self.assertEqual(self.loop.run_until_complete(asyncio.gather(*futures)),
+                         [grid.find_nearest(query,with_ids=True) for query in halves])
+        self.assertEqual((b.batches,b.requests),(1,len(halves)))
+
+        self.assertEqual(self.loop.run_until_complete(AsyncKDTreeService(KDTree(2)).nearest((1,1))),None)
+
+        self.assertRaises(AssertionError,a.nearest,(1,2,3))